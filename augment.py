@@ -0,0 +1,130 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from argparse import Namespace
+from typing import Optional, Tuple
+
+
+class BatchAugmentation(nn.Module):
+    def __init__(self, opt: Namespace) -> None:
+        super(BatchAugmentation, self).__init__()
+        self.noise = opt.noise
+        self.rot_ang = opt.rot_ang
+        self.seed = opt.aug_seed
+        self.generator = None
+
+        # 3x3 gaussian, same taps as cv2.GaussianBlur(img, (3, 3), 0)
+        k = torch.tensor([0.25, 0.5, 0.25])
+        self.register_buffer('kernel', (k.view(3, 1) * k.view(1, 3)).expand(3, 1, 3, 3).clone())
+
+    def uniform(self, n: int, low: float, high: float, device: torch.device) -> Tensor:
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return torch.rand(n, generator=self.generator, device=device) * (high - low) + low
+
+    def blur(self, x: Tensor) -> Tensor:
+        x = F.pad(x, (1, 1, 1, 1), mode='reflect')
+        return F.conv2d(x, self.kernel.to(x.dtype), groups=x.size(1))
+
+    def forward(
+        self,
+        input_image: Tensor,
+        ref: Tensor,
+        tar: Tensor,
+        masks: Tensor,
+        rhos: Tensor,
+        flows: Tensor
+        ) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+        # input_image: [n, 3, sh, sw], ref/tar: [n, 3, h, w], masks/rhos: [n, h, w], flows: [n, 3, h, w]
+        n = ref.size(0)
+        device = ref.device
+        masks = masks.unsqueeze(1)
+        rhos = rhos.unsqueeze(1)
+
+        # brighten the dark (strongly attenuated) regions of the target
+        dark = rhos.lt(0.7)
+        tar = tar + dark * self.uniform(n, 0.01, 0.2, device).view(n, 1, 1, 1)
+
+        # blur the object boundary and the dark regions
+        eroded = -F.max_pool2d(-masks, 3, 1, 1)
+        dilated = F.max_pool2d(masks, 3, 1, 1)
+        widen = self.uniform(n, 0, 1, device).gt(0.5).view(n, 1, 1, 1)
+        roi = torch.where(widen, dilated, masks) - eroded
+        roi = (roi + dark).clamp(0, 1)
+        tar = roi * self.blur(tar) + (1 - roi) * tar
+
+        down_roi = F.interpolate(roi, input_image.size()[2:], mode='bicubic', align_corners=True).clamp(0, 1)
+        input_image = down_roi * self.blur(input_image) + (1 - down_roi) * input_image
+
+        flows = flows.clone()
+        flows[:, 2:3][dark] = 0
+
+        noise = (torch.rand(ref.size(), generator=self.generator, device=device) - 0.5) * self.noise
+        ref = ref + noise
+        tar = tar + noise
+
+        input_image, ref, tar, masks, rhos, flows = self.flip(input_image, ref, tar, masks, rhos, flows)
+        if self.rot_ang:
+            input_image, ref, tar, masks, rhos, flows = self.rotate(input_image, ref, tar, masks, rhos, flows)
+
+        return input_image, ref, tar, masks.squeeze(1), rhos.squeeze(1), flows
+
+    def flip(self, *x: Tensor) -> Tuple[Tensor, ...]:
+        input_image, ref, tar, masks, rhos, flows = x
+        n = ref.size(0)
+        device = ref.device
+        need_flip = self.uniform(n, 0, 1, device).gt(0.5)
+        vertical = self.uniform(n, 0, 1, device).gt(0.8)
+        flip_v = (need_flip & vertical).view(n, 1, 1, 1)
+        flip_h = (need_flip & ~vertical).view(n, 1, 1, 1)
+
+        # flow channel 0 is the vertical and channel 1 the horizontal displacement
+        sign = torch.ones(n, 3, 1, 1, device=device)
+        sign[:, 0:1] = 1 - 2 * flip_v.float()
+        sign[:, 1:2] = 1 - 2 * flip_h.float()
+
+        out = []
+        for t in [input_image, ref, tar, masks, rhos, flows]:
+            t = torch.where(flip_v, t.flip(2), t)
+            t = torch.where(flip_h, t.flip(3), t)
+            out.append(t)
+        out[5] = out[5] * sign
+        return tuple(out)
+
+    def rotate(self, *x: Tensor) -> Tuple[Tensor, ...]:
+        # rotation about the image centre, assumes square images
+        input_image, ref, tar, masks, rhos, flows = x
+        n = ref.size(0)
+        angle = self.uniform(n, -self.rot_ang, self.rot_ang, ref.device)
+        cos = torch.cos(angle)
+        sin = torch.sin(angle)
+
+        # output pixel q samples the input at A q
+        theta = torch.zeros(n, 2, 3, device=ref.device)
+        theta[:, 0, 0] = cos
+        theta[:, 0, 1] = -sin
+        theta[:, 1, 0] = sin
+        theta[:, 1, 1] = cos
+
+        def warp(t: Tensor, mode: str, padding_mode: str) -> Tensor:
+            grid = F.affine_grid(theta, list(t.size()), align_corners=True)
+            return F.grid_sample(t, grid, mode=mode, padding_mode=padding_mode, align_corners=True)
+
+        input_image = warp(input_image, 'bilinear', 'border')
+        ref = warp(ref, 'bilinear', 'border')
+        tar = warp(tar, 'bilinear', 'border')
+        masks = warp(masks, 'nearest', 'zeros')
+        rhos = warp(rhos, 'bilinear', 'border')
+        flows = warp(flows, 'bilinear', 'zeros')
+
+        # tar'(q) = ref'(q + A^T f(A q)), so the flow vectors rotate by A^T
+        dy = flows[:, 0]
+        dx = flows[:, 1]
+        cos = cos.view(n, 1, 1)
+        sin = sin.view(n, 1, 1)
+        flows = torch.stack([-sin * dx + cos * dy, cos * dx + sin * dy, flows[:, 2]], 1)
+
+        return input_image, ref, tar, masks, rhos, flows
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import argparse
+import torch
+from argparse import Namespace
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.CoarseNet import CoarseNet
+
+
+def measure(model: CoarseNet, x: torch.Tensor, repeat: int) -> float:
+    with torch.no_grad():
+        model(x) # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(x)
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CoarseNet branch parallel latency')
+    parser.add_argument('--modes', type=str, default='none,threads',
+                        help='comma separated branch parallel modes')
+    parser.add_argument('--threads', type=str, default='1,2,4,8',
+                        help='comma separated intra-op thread counts')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='mini-batch size')
+    parser.add_argument('--ms_num', type=int, default=4,
+                        help='multiscale level')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed forward passes per setting')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = CoarseNet(Namespace(ms_num=opt.ms_num)).eval()
+    x = torch.rand(opt.batch_size, 3, 256, 256)
+
+    print(f'{"mode":<10}{"threads":>8}{"ms/forward":>14}')
+    for mode in opt.modes.split(','):
+        model.set_branch_parallel(mode)
+        for n in [int(t) for t in opt.threads.split(',')]:
+            torch.set_num_threads(n)
+            print(f'{mode:<10}{n:>8}{measure(model, x, opt.repeat):>14.2f}')
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import argparse
+import torch
+from torch import Tensor
+from typing import Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+
+
+def get_mask_reshape(masks: Tensor) -> Tensor:
+    # previous implementation, kept for comparison
+    n, c, h, w = list(masks.size())
+    m = masks.transpose(1, 3).transpose(1,2)
+    m = m.reshape(int(m.numel()/m.size(3)), m.size(3))
+    _, pred = m.max(1)
+    pred = pred.reshape(n, 1, h, w)
+    return pred
+
+
+def get_final_pred_mul(ref_img: Tensor, pred_img: Tensor, pred_mask: Tensor, pred_rho: Tensor) -> Tensor:
+    return torch.mul(1 - pred_mask, ref_img) + torch.mul(pred_mask, torch.mul(pred_img, pred_rho))
+
+
+def measure(fn: Callable, repeat: int, device: torch.device) -> float:
+    fn() # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='get_mask / get_final_pred microbenchmark')
+    parser.add_argument('--batch_sizes', type=str, default='1,8,32',
+                        help='comma separated batch sizes')
+    parser.add_argument('--size', type=int, default=512,
+                        help='image height and width')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='timed calls per setting')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device')
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    print(f'{"batch":>6}{"old mask ms":>14}{"new mask ms":>14}{"old pred ms":>14}{"new pred ms":>14}')
+    for n in [int(b) for b in opt.batch_sizes.split(',')]:
+        logits = torch.randn(n, 2, opt.size, opt.size, device=device)
+        ref = torch.rand(n, 3, opt.size, opt.size, device=device)
+        pred = torch.rand(n, 3, opt.size, opt.size, device=device)
+        rho = torch.rand(n, 1, opt.size, opt.size, device=device)
+
+        old_mask = get_mask_reshape(logits)
+        new_mask = utility.get_mask(logits)
+        assert torch.equal(old_mask.bool(), new_mask)
+        old_full = old_mask.expand(n, 3, opt.size, opt.size)
+        assert torch.allclose(get_final_pred_mul(ref, pred, old_full, rho), utility.get_final_pred(ref, pred, new_mask, rho))
+
+        times = [
+            measure(lambda: get_mask_reshape(logits), opt.repeat, device),
+            measure(lambda: utility.get_mask(logits), opt.repeat, device),
+            measure(lambda: get_final_pred_mul(ref, pred, get_mask_reshape(logits).expand(n, 3, opt.size, opt.size), rho), opt.repeat, device),
+            measure(lambda: utility.get_final_pred(ref, pred, utility.get_mask(logits), rho), opt.repeat, device),
+        ]
+        print(f'{n:>6}' + ''.join(f'{t:>14.3f}' for t in times))
@@ -0,0 +1,122 @@
+import io
+import json
+import time
+import socket
+import argparse
+import threading
+import http.client
+import numpy as np
+from PIL import Image
+from urllib.parse import urlparse
+from typing import List, Tuple
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float) -> None:
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def connect(opt: argparse.Namespace) -> http.client.HTTPConnection:
+    if opt.socket:
+        return UnixHTTPConnection(opt.socket, opt.timeout)
+    url = urlparse(opt.url)
+    return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=opt.timeout)
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body: bytes = None) -> Tuple[int, bytes]:
+    conn.request(method, path, body=body, headers={'Content-Type': 'application/octet-stream'})
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def make_image(size: int, seed: int) -> bytes:
+    image = np.random.RandomState(seed).randint(0, 256, (size, size, 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(image).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def client(opt: argparse.Namespace, body: bytes, n: int, latencies: List[float], errors: List[int]) -> None:
+    # one keep-alive connection per client
+    conn = connect(opt)
+    for _ in range(n):
+        start = time.perf_counter()
+        try:
+            status, data = request(conn, 'POST', '/predict', body)
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = connect(opt)
+            errors.append(-1)
+            continue
+        if status != 200:
+            errors.append(status)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a running serve.py instance')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000',
+                        help='server url')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='connect to this Unix socket instead of --url')
+    parser.add_argument('--image', type=str, default=None,
+                        help='image sent with every request (default: random noise)')
+    parser.add_argument('--size', type=int, default=256,
+                        help='size of the random image')
+    parser.add_argument('--concurrency', type=str, default='1,4,16',
+                        help='comma separated numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=64,
+                        help='requests per concurrency level')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='socket timeout in seconds')
+    opt = parser.parse_args()
+
+    if opt.image:
+        with open(opt.image, 'rb') as f:
+            body = f.read()
+    else:
+        body = make_image(opt.size, 0)
+
+    # check the response once and warm up the server
+    conn = connect(opt)
+    status, data = request(conn, 'POST', '/predict', body)
+    assert status == 200, data
+    result = np.load(io.BytesIO(data))
+    print('response: ' + ', '.join(f'{k} {result[k].dtype} {list(result[k].shape)}' for k in result.files))
+    conn.close()
+
+    print(f'{"clients":>8}{"req/s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"batch":>8}{"errors":>8}')
+    for c in [int(c) for c in opt.concurrency.split(',')]:
+        conn = connect(opt)
+        before = json.loads(request(conn, 'GET', '/health')[1])
+
+        latencies, errors = [], []
+        per_client = [opt.requests // c + (i < opt.requests % c) for i in range(c)]
+        threads = [threading.Thread(target=client, args=(opt, body, n, latencies, errors)) for n in per_client]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        after = json.loads(request(conn, 'GET', '/health')[1])
+        conn.close()
+        batches = after['batches'] - before['batches']
+        mean_batch = (after['requests'] - before['requests']) / max(batches, 1)
+
+        ms = [1000 * l for l in latencies]
+        print(f'{c:>8}{len(latencies) / elapsed:>10.2f}{percentile(ms, 50):>10.1f}{percentile(ms, 90):>10.1f}'
+              f'{percentile(ms, 99):>10.1f}{mean_batch:>8.2f}{len(errors):>8}')
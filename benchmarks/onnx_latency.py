@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import argparse
+import torch
+from typing import Dict, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from serve import Predictor
+
+
+def measure(predictor: Predictor, images: torch.Tensor, repeat: int) -> Tuple[float, Dict[str, torch.Tensor]]:
+    # ms per batch, median of repeat calls after one warm up call
+    output = predictor(images)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predictor(images)
+        times.append(time.perf_counter() - start)
+    return 1000 * sorted(times)[len(times) // 2], output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Predictor latency and throughput, PyTorch vs ONNX Runtime on CPU')
+    parser.add_argument('--pred_dir', type=str, default='coarse.pt',
+                        help='CoarseNet checkpoint')
+    parser.add_argument('--refine_dir', type=str, default=None,
+                        help='RefineNet checkpoint, refine the coarse prediction if given')
+    parser.add_argument('--onnx_coarse', type=str, default='coarse.onnx',
+                        help='CoarseNet graph written by onnx_export.py')
+    parser.add_argument('--onnx_refine', type=str, default='refine.onnx',
+                        help='RefineNet graph written by onnx_export.py --refine')
+    parser.add_argument('--batches', type=str, default='1,2,4,8,16',
+                        help='comma separated batch sizes')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed calls per batch size and backend')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op threads of both backends (0: their defaults)')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    device = torch.device('cpu')
+    predictors = {
+        'torch': Predictor(opt.pred_dir, opt.refine_dir, device),
+        'onnx': Predictor(opt.onnx_coarse, opt.onnx_refine if opt.refine_dir else None, device,
+                backend='onnx', threads=opt.threads),
+    }
+
+    print(f'\n{"batch":>6}{"torch ms":>11}{"onnx ms":>11}{"torch /s":>10}{"onnx /s":>10}{"speedup":>9}'
+            f'{"flow diff":>11}{"mask agree":>12}')
+    for n in [int(b) for b in opt.batches.split(',')]:
+        images = torch.rand(n, 3, 256, 256)
+        ms_torch, out_torch = measure(predictors['torch'], images, opt.repeat)
+        ms_onnx, out_onnx = measure(predictors['onnx'], images, opt.repeat)
+        flow_diff = (out_torch['flow'] - out_onnx['flow']).abs().max().item()
+        agree = out_torch['mask'].eq(out_onnx['mask']).float().mean().item()
+        print(f'{n:>6}{ms_torch:>11.1f}{ms_onnx:>11.1f}{1000 * n / ms_torch:>10.2f}{1000 * n / ms_onnx:>10.2f}'
+                f'{ms_torch / ms_onnx:>8.2f}x{flow_diff:>11.2e}{agree:>12.6f}')
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import argparse
+import torch
+from torch import Tensor
+from argparse import Namespace
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.RefineNet import RefineNet
+
+
+def make_inputs(n: int, size: int, area: float) -> List[Tensor]:
+    # coarse outputs with a square object covering the given fraction of the image
+    side = max(int(round(size * area ** 0.5)), 1)
+    y0 = x0 = (size - side) // 2
+    mask = torch.zeros(n, 2, size, size)
+    mask[:, 0] = 1
+    mask[:, 1, y0:y0+side, x0:x0+side] = 2
+    flow = torch.zeros(n, 2, size, size)
+    flow[:, :, y0:y0+side, x0:x0+side] = torch.randn(n, 2, side, side) * 10
+    return [torch.rand(n, 3, size, size), flow, mask, torch.rand(n, 1, size, size)]
+
+
+def measure(model: RefineNet, x: List[Tensor], repeat: int, device: torch.device) -> float:
+    with torch.no_grad():
+        model(list(x)) # warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(list(x))
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return repeat * x[0].size(0) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RefineNet throughput with and without ROI mode by mask area')
+    parser.add_argument('--areas', type=str, default='0.01,0.05,0.1,0.25,0.5,1.0',
+                        help='comma separated fractions of the image covered by the object')
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='mini-batch size')
+    parser.add_argument('--size', type=int, default=512,
+                        help='image size')
+    parser.add_argument('--pad', type=int, default=32,
+                        help='ROI padding')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed forward passes per setting')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    model = RefineNet(Namespace()).to(device).eval()
+
+    print(f'{"area":>6}{"full /s":>10}{"roi /s":>10}{"speedup":>9}{"mask agree":>12}{"flow diff":>11}')
+    for area in [float(a) for a in opt.areas.split(',')]:
+        x = [t.to(device) for t in make_inputs(opt.batch_size, opt.size, area)]
+
+        model.set_roi(-1)
+        full_rate = measure(model, x, opt.repeat, device)
+        with torch.no_grad():
+            full = model(list(x))
+        model.set_roi(opt.pad)
+        roi_rate = measure(model, x, opt.repeat, device)
+        with torch.no_grad():
+            roi = model(list(x))
+
+        # agreement with full-frame refinement inside the object
+        inside = x[2][:, 1:2] > x[2][:, 0:1]
+        agree = ((full[1][:, 1:2] > full[1][:, 0:1]) == (roi[1][:, 1:2] > roi[1][:, 0:1]))[inside].float().mean()
+        diff = (full[0] - roi[0]).norm(dim=1, keepdim=True)[inside].mean()
+        print(f'{area:>6.2f}{full_rate:>10.2f}{roi_rate:>10.2f}{roi_rate / full_rate:>8.2f}x{agree.item():>12.4f}{diff.item():>11.4f}')
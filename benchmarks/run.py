@@ -0,0 +1,351 @@
+import os
+import re
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import torch
+import torch.nn as nn
+from torch import Tensor
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+from option import get_config
+from dataloader import ETOMDataset, collate
+from models.CoarseNet import CoarseNet
+from models.RefineNet import RefineNet
+from synth import write_split
+
+# Case factories build their inputs once and return the timed function, so that only
+# the selected cases pay for their setup (models, datasets).
+
+
+def timeit(fn: Callable, warmup: int, repeat: int, min_time: float) -> Dict[str, float]:
+    # calls per measurement are calibrated so that one measurement takes >= min_time
+    for _ in range(warmup):
+        fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= min_time or number >= 1 << 16:
+            break
+        number *= 2
+
+    times = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            times.append(1000 * (time.perf_counter() - start) / number)
+    finally:
+        gc.enable()
+    q = statistics.quantiles(times, n=4) if len(times) > 1 else [times[0]] * 3
+    return {'ms': statistics.median(times), 'min_ms': min(times), 'iqr_ms': q[2] - q[0],
+            'repeat': repeat, 'number': number}
+
+
+class Context:
+    # shared, lazily created inputs of the cases
+    def __init__(self, opt: argparse.Namespace) -> None:
+        self.opt = opt
+        self.tmp = tempfile.TemporaryDirectory(prefix='etom_bench_')
+        self.datasets = {}
+
+    def dataset(self, compact: bool) -> ETOMDataset:
+        if compact not in self.datasets:
+            if not self.datasets:
+                write_split(self.tmp.name, 'train', 'train.txt', self.opt.samples, 512)
+            config = get_config(data_dir=self.tmp.name, train_list='train.txt', compact=compact)
+            self.datasets[compact] = ETOMDataset(config, 'train')
+        return self.datasets[compact]
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmp.name, name)
+
+
+def batch(n: int, size: int = 512) -> Dict[str, Tensor]:
+    torch.manual_seed(0)
+    return {
+        'ref': torch.rand(n, 3, size, size),
+        'tar': torch.rand(n, 3, size, size),
+        'masks': torch.randint(0, 2, (n, 1, size, size)).float(),
+        'rhos': torch.rand(n, 1, size, size),
+        'flows': torch.cat([torch.randn(n, 2, size, size) * 10, torch.ones(n, 1, size, size)], 1),
+    }
+
+
+def coarse_output(n: int, ms_num: int) -> List[List[Tensor]]:
+    torch.manual_seed(0)
+    sizes = [512 // 2 ** (ms_num - i - 1) for i in range(ms_num)]
+    return [[torch.randn(n, 2, s, s) * 5, torch.randn(n, 2, s, s), torch.rand(n, 1, s, s)] for s in sizes]
+
+
+def data_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    def getitem(compact: bool) -> Callable:
+        ds = ctx.dataset(compact)
+        it = iter(range(1 << 30))
+        return lambda: ds[next(it) % len(ds)]
+
+    def collate_case() -> Callable:
+        samples = [ctx.dataset(False)[i % ctx.opt.samples] for i in range(8)]
+        return lambda: collate(samples)
+
+    def load_flow() -> Callable:
+        ds = ctx.dataset(False)
+        path = os.path.join(ds.dir, os.path.splitext(ds.image_info[0])[0] + '_flow.flo')
+        return lambda: utility.load_flow(path)
+
+    def save_flow() -> Callable:
+        flow = batch(1)['flows'][0, :2]
+        return lambda: utility.save_flow(ctx.path('bench.flo'), flow)
+
+    return [
+        ('data/getitem', lambda: getitem(False)),
+        ('data/getitem_compact', lambda: getitem(True)),
+        ('data/collate_b8', collate_case),
+        ('io/load_flow', load_flow),
+        ('io/save_flow', save_flow),
+    ]
+
+
+def warp_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    n, ms_num = ctx.opt.batch, 4
+
+    def ms_data() -> Callable:
+        b = batch(n)
+        module = utility.CreateMultiScaleData(ms_num)
+        return lambda: module([b['ref'], b['tar'], b['rhos'].squeeze(1), b['masks'].squeeze(1), b['flows']])
+
+    def grid() -> Callable:
+        flow = batch(n)['flows'][:, :2]
+        return lambda: utility.grid_generator(flow)
+
+    def single() -> Callable:
+        b = batch(n)
+        return lambda: utility.create_single_warping([b['ref'], b['flows'][:, :2]])
+
+    def multi_scale() -> Callable:
+        b = batch(n)
+        refs = utility.CreateMultiScaleData(ms_num)([b['ref'], b['tar'], b['rhos'], b['masks'], b['flows']])[0]
+        flows = [o[0] for o in coarse_output(n, ms_num)]
+        module = utility.CreateMultiScaleWarping(ms_num)
+        return lambda: module([refs, flows])
+
+    return [
+        (f'ms/create_multiscale_data_b{n}', ms_data),
+        (f'warp/grid_generator_b{n}', grid),
+        (f'warp/single_b{n}', single),
+        (f'warp/multiscale_b{n}', multi_scale),
+    ]
+
+
+def loss_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    n, ms_num = ctx.opt.batch, 4
+    opt = get_config(ms_num=ms_num)
+
+    def epe() -> Callable:
+        b, out = batch(n), coarse_output(n, ms_num)[-1]
+        criterion = utility.EPELoss()
+        return lambda: criterion(out[0], b['flows'], b['masks'], b['rhos'])
+
+    def mask_ce() -> Callable:
+        b, out = batch(n), coarse_output(n, ms_num)[-1]
+        criterion = nn.CrossEntropyLoss()
+        return lambda: criterion(out[1], b['masks'].squeeze(1).long())
+
+    def rho_mse() -> Callable:
+        b, out = batch(n), coarse_output(n, ms_num)[-1]
+        criterion = nn.MSELoss()
+        return lambda: criterion(out[2], b['rhos'])
+
+    def rec_mse() -> Callable:
+        b = batch(n)
+        criterion = nn.MSELoss()
+        return lambda: criterion(b['ref'], b['tar'])
+
+    def multi_scale() -> Callable:
+        b, out = batch(n), coarse_output(n, ms_num)
+        ms = utility.CreateMultiScaleData(ms_num)([b['ref'], b['tar'], b['rhos'], b['masks'], b['flows']])
+        preds = utility.CreateMultiScaleWarping(ms_num)([ms[0], [o[0] for o in out]])
+        criterion = utility.MultiScaleLoss(opt)
+        return lambda: criterion(out, preds, ms[0], ms[1], ms[3], ms[2], ms[4])
+
+    def refine() -> Callable:
+        b, out = batch(n), coarse_output(n, ms_num)[-1]
+        criterion = utility.RefineLoss(opt)
+        return lambda: criterion(out, b['masks'].squeeze(1), b['rhos'].squeeze(1), b['flows'])
+
+    return [
+        (f'loss/epe_b{n}', epe),
+        (f'loss/mask_ce_b{n}', mask_ce),
+        (f'loss/rho_mse_b{n}', rho_mse),
+        (f'loss/rec_mse_b{n}', rec_mse),
+        (f'loss/multiscale_b{n}', multi_scale),
+        (f'loss/refine_b{n}', refine),
+    ]
+
+
+def model_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    models = {}
+
+    def get(name: str) -> nn.Module:
+        # one instance per network, reused by all batch sizes
+        if name not in models:
+            torch.manual_seed(0)
+            models[name] = CoarseNet(get_config()) if name == 'coarse' else RefineNet(get_config(refine=True))
+        return models[name]
+
+    def inputs(name: str, n: int):
+        if name == 'coarse':
+            torch.manual_seed(0)
+            return torch.rand(n, 3, 256, 256)
+        out = coarse_output(n, 4)[-1]
+        return [torch.rand(n, 3, 512, 512)] + out
+
+    def forward(name: str, n: int) -> Callable:
+        model, x = get(name).eval(), inputs(name, n)
+
+        def fn() -> None:
+            with torch.no_grad():
+                model(list(x) if isinstance(x, list) else x)
+        return fn
+
+    def forward_backward(name: str, n: int) -> Callable:
+        model, x = get(name), inputs(name, n)
+
+        def fn() -> None:
+            model.train()
+            out = model(list(x) if isinstance(x, list) else x)
+            out = out[-1] if name == 'coarse' else out
+            sum(o.float().square().mean() for o in out).backward()
+            model.zero_grad(set_to_none=True)
+        return fn
+
+    cases = []
+    for name, sizes in [('coarse', ctx.opt.coarse_batches), ('refine', ctx.opt.refine_batches)]:
+        for n in [int(s) for s in sizes.split(',') if s]:
+            cases.append((f'model/{name}_fwd_b{n}', lambda name=name, n=n: forward(name, n)))
+            cases.append((f'model/{name}_fwd_bwd_b{n}', lambda name=name, n=n: forward_backward(name, n)))
+    return cases
+
+
+def io_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    def compact_results() -> Callable:
+        # the 6 x 6 grid of Trainer.save_ms_results
+        b = batch(1)
+        images = [b['ref'][0], b['tar'][0], False, False, b['masks'][0, 0], b['rhos'][0, 0]]
+        images += [b['tar'][0], b['ref'][0], utility.flow_to_color(b['flows'][0]), b['masks'][0, 0], \
+                b['rhos'][0, 0], b['rhos'][0].repeat(3, 1, 1)] * 4
+        return lambda: utility.save_compact_results(ctx.path('bench.png'), images, 6)
+
+    return [('io/save_compact_results', compact_results)]
+
+
+def all_cases(ctx: Context) -> List[Tuple[str, Callable[[], Callable]]]:
+    return data_cases(ctx) + warp_cases(ctx) + loss_cases(ctx) + io_cases(ctx) + model_cases(ctx)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> Tuple[str, int]:
+    # per-case ratio of the median against the baseline; returns the table and #regressions
+    s = f'{"case":<32}{"base ms":>12}{"ms":>12}{"ratio":>8}\n'
+    regressions = 0
+    for name, r in results.items():
+        if name not in baseline:
+            s += f'{name:<32}{"-":>12}{r["ms"]:>12.3f}{"-":>8}  new\n'
+            continue
+        ratio = r['ms'] / baseline[name]['ms']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            flag = '  faster'
+        s += f'{name:<32}{baseline[name]["ms"]:>12.3f}{r["ms"]:>12.3f}{ratio:>7.2f}x{flag}\n'
+    return s.rstrip('\n'), regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU benchmark suite of the ETOM-Net hot paths')
+    parser.add_argument('--filter', type=str, default='',
+                        help='regex selecting the cases to run')
+    parser.add_argument('--list', action='store_true',
+                        help='list the cases and exit')
+    parser.add_argument('--out', type=str, default='benchmarks/results.json',
+                        help='json file the results are written to')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown of the median reported as a regression')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='intra-op threads, fixed for repeatable timings')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='untimed calls per case')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed measurements per case')
+    parser.add_argument('--min_time', type=float, default=0.05,
+                        help='seconds per measurement, fast cases are called repeatedly')
+    parser.add_argument('--batch', type=int, default=4,
+                        help='batch size of the warping and loss cases')
+    parser.add_argument('--coarse_batches', type=str, default='1,2',
+                        help='CoarseNet batch sizes')
+    parser.add_argument('--refine_batches', type=str, default='1,2,4',
+                        help='RefineNet batch sizes')
+    parser.add_argument('--samples', type=int, default=8,
+                        help='synthetic samples written for the data cases')
+    opt = parser.parse_args()
+
+    torch.set_num_threads(opt.threads)
+    ctx = Context(opt)
+    cases = [(name, factory) for name, factory in all_cases(ctx) if re.search(opt.filter, name)]
+    if opt.list:
+        print('\n'.join(name for name, _ in cases))
+        sys.exit(0)
+
+    results = {}
+    for name, factory in cases:
+        torch.manual_seed(0)
+        results[name] = timeit(factory(), opt.warmup, opt.repeat, opt.min_time)
+        r = results[name]
+        print(f'{name:<32}{r["ms"]:>12.3f} ms  (min {r["min_ms"]:.3f}, iqr {r["iqr_ms"]:.3f}, x{r["number"]})', flush=True)
+
+    meta = {
+        'time': time.time(),
+        'commit': git_commit(),
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'cpu': platform.processor() or platform.machine(),
+        'threads': opt.threads,
+        'args': vars(opt),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(opt.out)), exist_ok=True)
+    with open(opt.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f'\n\n --> Saved results to: {opt.out}')
+
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)
+        table, regressions = compare(results, baseline['results'], opt.tolerance)
+        print(f'\n\n --> Comparison with {opt.baseline} (commit {baseline["meta"].get("commit")}): \n{table}')
+        if regressions:
+            print(f'[Regression] {regressions} cases slower by more than {opt.tolerance:.0%}')
+            sys.exit(1)
@@ -0,0 +1,87 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+import statistics
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# each case runs in a fresh interpreter and prints the seconds spent in import and in first use
+CASES = {
+    'utility': '''
+import time
+start = time.perf_counter()
+import utility
+imported = time.perf_counter()
+utility.get_mask(utility.torch.zeros(1, 2, 8, 8))
+''',
+    'dataloader': '''
+import time
+start = time.perf_counter()
+import dataloader
+imported = time.perf_counter()
+dataloader.collate
+''',
+    'option': '''
+import time
+start = time.perf_counter()
+import option
+imported = time.perf_counter()
+option.get_config()
+''',
+    'first_inference': '''
+import time
+start = time.perf_counter()
+import torch
+import utility
+from argparse import Namespace
+from models.CoarseNet import CoarseNet
+imported = time.perf_counter()
+with torch.no_grad():
+    output = CoarseNet(Namespace(ms_num=4)).eval()(torch.rand(1, 3, 256, 256))[-1]
+    utility.get_mask(output[1])
+''',
+}
+
+SUFFIX = '''
+import json
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_use': done - imported}))
+'''
+
+
+def run_case(code: str, cwd: str) -> Dict[str, float]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code + SUFFIX], cwd=cwd, env=env,
+                        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    total = time.perf_counter() - start
+    result = json.loads(out.strip().splitlines()[-1])
+    result['process'] = total
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start time of the ETOM-Net modules')
+    parser.add_argument('--cases', type=str, default=','.join(CASES.keys()),
+                        help='comma separated cases: ' + ', '.join(CASES.keys()))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='fresh interpreters per case, the median is reported')
+    opt = parser.parse_args()
+
+    print(f'{"case":<18}{"import s":>10}{"first use s":>13}{"process s":>11}{"side effects":>14}')
+    for name in opt.cases.split(','):
+        runs: List[Dict[str, float]] = []
+        with tempfile.TemporaryDirectory() as cwd:
+            for _ in range(opt.repeat):
+                runs.append(run_case(CASES[name], cwd))
+            # importing must not create files, e.g. the training directories
+            side_effects = os.listdir(cwd)
+        median = {k: statistics.median(r[k] for r in runs) for k in runs[0].keys()}
+        print(f'{name:<18}{median["import"]:>10.3f}{median["first_use"]:>13.3f}{median["process"]:>11.3f}'
+              f'{", ".join(side_effects) or "none":>14}')
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import tempfile
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from typing import Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+from option import get_config
+from dataloader import ETOMDataset, collate, to_float_batch
+
+
+def write_samples(data_dir: str, n: int, size: int) -> None:
+    # random samples in the ETOMDataset layout
+    image_dir = os.path.join(data_dir, 'train/Images')
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.RandomState(0)
+    names = []
+    for i in range(n):
+        base = os.path.join(image_dir, f'{i:04d}')
+        Image.fromarray(rng.randint(0, 256, (size // 2, size // 2, 3), dtype=np.uint8)).save(base + '_1x.jpg')
+        Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(base + '_ref.jpg')
+        Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(base + '.jpg')
+        Image.fromarray(rng.randint(0, 2, (size, size), dtype=np.uint8) * 255).save(base + '_mask.png')
+        Image.fromarray(rng.randint(0, 256, (size, size), dtype=np.uint8)).save(base + '_rho.png')
+        utility.save_flow(base + '_flow.flo', torch.from_numpy(rng.randint(-50, 50, (2, size, size))))
+        names.append(f'{i:04d}.jpg')
+    with open(os.path.join(data_dir, 'train.txt'), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+
+
+def batch_bytes(sample: Dict[str, torch.Tensor]) -> int:
+    return sum(v.numel() * v.element_size() for v in sample.values())
+
+
+def measure(loader: DataLoader, device: torch.device, epochs: int) -> Dict[str, float]:
+    for _ in loader:
+        pass # fills the decoded cache
+
+    batches = 0
+    nbytes = 0
+    wait = 0
+    start = time.perf_counter()
+    for _ in range(epochs):
+        it = iter(loader)
+        while True:
+            t = time.perf_counter()
+            try:
+                sample = next(it)
+            except StopIteration:
+                break
+            nbytes += batch_bytes(sample)
+            sample = to_float_batch({k: v.to(device, non_blocking=True) for k, v in sample.items()})
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            wait += time.perf_counter() - t
+            batches += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'mb_per_batch': nbytes / batches / 2**20,
+        'batches_per_sec': batches / elapsed,
+        'ipc_mb_per_sec': nbytes / elapsed / 2**20,
+        'ms_per_batch': 1000 * wait / batches,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DataLoader transport: float32 vs compact uint8/int16 batches')
+    parser.add_argument('--samples', type=int, default=32,
+                        help='random samples written to a temporary dataset')
+    parser.add_argument('--size', type=int, default=512,
+                        help='image size')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='mini-batch size')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='DataLoader worker processes')
+    parser.add_argument('--epochs', type=int, default=3,
+                        help='timed epochs after the cache is filled')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device batches are converted on')
+    opt = parser.parse_args()
+
+    device = torch.device(opt.device)
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_samples(data_dir, opt.samples, opt.size)
+
+        print(f'{"transport":<10}{"MB/batch":>10}{"batch/s":>10}{"IPC MB/s":>10}{"ms/batch":>10}')
+        for compact in [False, True]:
+            # decoded samples are cached, so the loop measures conversion and transport, not decoding
+            config = get_config(data_dir=data_dir, train_list='train.txt', compact=compact, cache_mb=2**12)
+            dataset = ETOMDataset(config, 'train')
+            loader = DataLoader(dataset, batch_size=opt.batch_size, num_workers=opt.workers,
+                                collate_fn=collate, pin_memory=device.type == 'cuda')
+            r = measure(loader, device, opt.epochs)
+            name = 'compact' if compact else 'float32'
+            print(f'{name:<10}{r["mb_per_batch"]:>10.1f}{r["batches_per_sec"]:>10.2f}'
+                  f'{r["ipc_mb_per_sec"]:>10.1f}{r["ms_per_batch"]:>10.2f}')
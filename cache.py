@@ -0,0 +1,99 @@
+import torch
+import torch.multiprocessing as mp
+from torch import Tensor
+from typing import List, Tuple, Dict, Optional
+
+
+class SharedImageCache:
+    # Fixed-size slots of decoded samples in shared memory. The tensors are created
+    # before the DataLoader starts its workers, so every worker reads and fills the
+    # same slots; eviction picks the least recently used slot.
+    def __init__(self, n_items: int, budget_bytes: int, layout: List[Tuple[str, Tuple[int, ...], torch.dtype]]) -> None:
+        # widest dtypes first keeps every field aligned inside a slot
+        self.layout = sorted(layout, key=lambda l: -self.field_bytes((1,), l[2]))
+        self.slot_bytes = sum(self.field_bytes(shape, dtype) for _, shape, dtype in layout)
+        self.n_slots = max(0, min(n_items, budget_bytes // self.slot_bytes))
+
+        self.data = torch.empty(self.n_slots, self.slot_bytes, dtype=torch.uint8).share_memory_()
+        self.slot_of = torch.full((n_items,), -1, dtype=torch.int64).share_memory_()
+        self.owner = torch.full((self.n_slots,), -1, dtype=torch.int64).share_memory_()
+        self.last_used = torch.zeros(self.n_slots, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_() # clock, hits, misses
+        self.lock = mp.Lock()
+
+    @staticmethod
+    def field_bytes(shape: Tuple[int, ...], dtype: torch.dtype) -> int:
+        numel = 1
+        for s in shape:
+            numel *= s
+        return numel * torch.empty(0, dtype=dtype).element_size()
+
+    def pack(self, raw: Dict[str, Tensor]) -> Optional[Tensor]:
+        parts = []
+        for name, shape, dtype in self.layout:
+            t = raw[name]
+            if tuple(t.size()) != tuple(shape) or t.dtype != dtype:
+                return None
+            parts.append(t.contiguous().view(-1).view(torch.uint8))
+        return torch.cat(parts)
+
+    def unpack(self, record: Tensor) -> Dict[str, Tensor]:
+        raw = {}
+        offset = 0
+        for name, shape, dtype in self.layout:
+            n = self.field_bytes(shape, dtype)
+            raw[name] = record[offset:offset+n].view(dtype).view(shape)
+            offset += n
+        return raw
+
+    def get(self, idx: int) -> Optional[Dict[str, Tensor]]:
+        with self.lock:
+            slot = int(self.slot_of[idx])
+            if slot < 0:
+                self.counters[2] += 1
+                return None
+            self.counters[0] += 1
+            self.counters[1] += 1
+            self.last_used[slot] = self.counters[0]
+            # copy out while holding the lock so the slot cannot be evicted mid-read
+            record = self.data[slot].clone()
+        return self.unpack(record)
+
+    def put(self, idx: int, raw: Dict[str, Tensor]) -> None:
+        if self.n_slots == 0:
+            return
+        record = self.pack(raw)
+        if record is None:
+            return
+
+        with self.lock:
+            if self.slot_of[idx] >= 0:
+                return
+            # free slots were never used, so they always win the argmin
+            slot = int(torch.argmin(self.last_used))
+            old = int(self.owner[slot])
+            if old >= 0:
+                self.slot_of[old] = -1
+            self.data[slot].copy_(record)
+            self.owner[slot] = idx
+            self.slot_of[idx] = slot
+            self.counters[0] += 1
+            self.last_used[slot] = self.counters[0]
+
+    def stats(self) -> Dict[str, float]:
+        hits = int(self.counters[1])
+        misses = int(self.counters[2])
+        used = int((self.owner >= 0).sum())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            'slots': self.n_slots,
+            'used_slots': used,
+            'used_mb': used * self.slot_bytes / 2**20,
+        }
+
+    def stats_string(self) -> str:
+        s = self.stats()
+        return f'hit rate: {s["hit_rate"]:.3f} ({s["hits"]} hits, {s["misses"]} misses), ' + \
+            f'slots: {s["used_slots"]}/{s["slots"]}, {s["used_mb"]:.1f} MB'
@@ -2,37 +2,39 @@ import os
 import torch
 import torch.nn as nn
 import math
+import logging
 from argparse import Namespace
-from typing import Tuple
+from typing import Tuple, Optional
 from models import CoarseNet
+from history import MetricsStore
 import utility
 
 
-def update_history(opt: Namespace, epoch: int, loss: float, split: str) -> "model":
+def update_history(opt: Namespace, epoch: int, results: dict, split: str) -> dict:
+    if split not in ['train', 'val']:
+        logging.error('Unknown split: ' + split)
+        return None
 
-    train_hist = utility.load_data(os.path.join(opt.save, 'train_hist.pt'))
-    val_hist = utility.load_data(os.path.join(opt.save, 'val_hist.pt'))
+    record = {'epoch': epoch, 'split': split}
+    record.update(results)
+    record['losses'] = dict(results['losses'])
+    record['losses']['total'] = sum(results['losses'].values())
+    record = MetricsStore(opt.log_dir).append(record)
 
-    if split == 'train':
-        train_hist[epoch] = loss
-        torch.save(train_hist, os.path.join(opt.save, 'train_hist.pt'))
-        with open(os.path.join(opt.save, 'train_hist'), 'w') as f:
-            f.write(utility.hist_to_str(train_hist))
-        return train_hist
-    elif split == 'val':
-        val_hist[epoch] = loss
-        torch.save(val_hist, os.path.join(opt.save, 'val_hist.pt'))
-        with open(os.path.join(opt.save, 'val_hist'), 'w') as f:
-            f.write(utility.hist_to_str(val_hist))
-        return val_hist
-    else:
-        logging.error('Unknown split: ' + split)
+    # human readable copy, appended instead of rewritten every epoch
+    with open(os.path.join(opt.save, f'{split}_hist'), 'a') as f:
+        f.write(f'Epoch: {epoch}\n{utility.build_loss_string(results["losses"])}\n\n')
+    return record
 
 
 class CheckPoint:
     def latest(opt: Namespace) -> Tuple["model", "state"]:
         if opt.resume == None:
             return None, None
+        if not os.path.isfile(os.path.join(opt.resume, 'latest')):
+            # preempted before the first epoch checkpoint, load_snapshot may still find a snapshot
+            print(f'=> [Resume] No epoch checkpoint in: {opt.resume}')
+            return None, None
         f = open(os.path.join(opt.resume, 'latest'), 'r')
         suffix = f.read()
         
@@ -65,3 +67,33 @@ class CheckPoint:
         f = open(os.path.join(opt.save, 'latest'), 'w')
         f.write(suffix)
         f.close()
+
+    def save_snapshot(opt: Namespace, snapshot: dict) -> None:
+        # a single mid-epoch snapshot, replaced atomically so a preempted save leaves the previous one
+        if not os.path.exists(opt.save):
+            os.makedirs(opt.save)
+        path = os.path.join(opt.save, 'snapshot.pt')
+        torch.save(snapshot, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def load_snapshot(opt: Namespace, checkpoint: Optional[dict]) -> Optional[dict]:
+        # the snapshot in opt.resume if it is more recent than the epoch checkpoint
+        if opt.resume == None:
+            return None
+        path = os.path.join(opt.resume, 'snapshot.pt')
+        if not os.path.isfile(path):
+            return None
+        snapshot = torch.load(path)
+        if checkpoint is not None and snapshot['epoch'] < checkpoint['epoch']:
+            return None
+        print(f'=> [Resume] Loading snapshot: {path} (epoch {snapshot["epoch"]+1}, iteration {snapshot["iter"]})')
+        return snapshot
+
+    def resume(opt: Namespace) -> Tuple[Optional[dict], Optional[dict], Optional[dict]]:
+        # (checkpoint, optim state, snapshot), the snapshot replaces an older epoch checkpoint
+        checkpoint, optim_state = CheckPoint.latest(opt)
+        snapshot = CheckPoint.load_snapshot(opt, checkpoint)
+        if snapshot is not None:
+            return snapshot, snapshot['optim_state'], snapshot
+        assert opt.resume == None or checkpoint is not None, f'Nothing to resume in: {opt.resume}'
+        return checkpoint, optim_state, None
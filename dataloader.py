@@ -1,65 +1,257 @@
 import torch.multiprocessing as mp
 import torch
+import queue
+import threading
 from torch import Tensor
 import math
 import os
 import utility
-import pandas as pd
 from PIL import Image
-import torchvision.transforms.functional as TF
-from torchvision import transforms
 import random
 import torch.nn.functional as F
 from torch.distributions.uniform import Uniform
-import cv2
 import numpy as np
-from torch.utils.data import DataLoader
-from option import args
+from torch.utils.data import DataLoader, default_collate
+from cache import SharedImageCache
 from argparse import Namespace
 from typing import Type, Any, Callable, Union, List, Optional, Tuple, Dict
 
 
-def create(opt: Namespace) -> Tuple[DataLoader, DataLoader]:
-    dataset_0 = ETOMDataset(opt, 'train')
-    loader_0 = DataLoader(dataset_0, batch_size=opt.batch_size,
-                        shuffle=True, num_workers=16, collate_fn=collate)
-    dataset_1 = ETOMDataset(opt, 'val')
+def create(opt: Namespace) -> Tuple["Prefetcher", "Prefetcher"]:
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    pin = device.type == 'cuda'
+    Dataset = ETOMDataset
+    if opt.dataset == 'synth':
+        from synth import SynthDataset # synth imports this module
+        Dataset = SynthDataset
+    dataset_0 = Dataset(opt, 'train')
+    loader_0 = DataLoader(dataset_0, batch_size=opt.batch_size, sampler=ResumableSampler(len(dataset_0)),
+                        num_workers=16, collate_fn=collate, pin_memory=pin)
+    dataset_1 = Dataset(opt, 'val')
     loader_1 = DataLoader(dataset_1, batch_size=opt.batch_size,
-                        shuffle=True, num_workers=16, collate_fn=collate)
-    return loader_0, loader_1
+                        shuffle=True, num_workers=16, collate_fn=collate, pin_memory=pin)
+    return Prefetcher(loader_0, device), Prefetcher(loader_1, device)
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    # Random order that depends only on (seed, epoch), so an epoch can be continued
+    # from any offset after a restart. The offset applies to the next iteration only.
+    def __init__(self, n: int, seed: int = 0) -> None:
+        self.n = n
+        self.seed = seed
+        self.epoch = 0
+        self.offset = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.offset = 0
+
+    def __len__(self) -> int:
+        return self.n - self.offset
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.n, generator=g)[self.offset:].tolist()
+        self.offset = 0
+        return iter(indices)
+
+    def state_dict(self, offset: Optional[int] = None) -> dict:
+        # offset: samples of this epoch already consumed by the caller
+        return {'seed': self.seed, 'epoch': self.epoch, 'offset': self.offset if offset is None else offset}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.offset = state['offset']
+
+
+class Prefetcher:
+    # Hands out batches that are already on the training device. On GPU the next batch
+    # is copied from pinned memory on a side stream into one of two persistent device
+    # buffers while the current batch computes. On CPU a background thread keeps one
+    # batch ready ahead of the consumer.
+    def __init__(self, dataloader: DataLoader, device: torch.device) -> None:
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.sampler = dataloader.sampler
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.buffers = [{}, {}]
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self):
+        if self.stream is None:
+            return self.iter_cpu()
+        return self.iter_cuda()
+
+    def to_device(self, sample: Dict[str, Tensor], slot: int) -> Dict[str, Tensor]:
+        out = {}
+        buffers = self.buffers[slot]
+        for k, v in sample.items():
+            n = v.size(0)
+            buf = buffers.get(k)
+            if buf is None or buf.size(0) < n or buf.size()[1:] != v.size()[1:] or buf.dtype != v.dtype:
+                buf = torch.empty(v.size(), dtype=v.dtype, device=self.device)
+                buffers[k] = buf
+            out[k] = buf[:n]
+            out[k].copy_(v, non_blocking=True)
+        return out
+
+    def preload(self, it, slot: int) -> Optional[Dict[str, Tensor]]:
+        try:
+            sample = next(it)
+        except StopIteration:
+            return None
+        # the slot still holds the batch before last, which queued work may be reading
+        self.stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.stream):
+            return self.to_device(sample, slot)
+
+    def iter_cuda(self):
+        it = iter(self.dataloader)
+        slot = 0
+        batch = self.preload(it, slot)
+        while batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            current = batch
+            slot ^= 1
+            batch = self.preload(it, slot)
+            yield current
+
+    def iter_cpu(self):
+        q = queue.Queue(maxsize=2)
+        done = object()
+        stop = threading.Event()
+
+        def produce() -> None:
+            try:
+                for sample in self.dataloader:
+                    if stop.is_set():
+                        return
+                    q.put(sample)
+            except Exception as e:
+                q.put(e)
+                return
+            q.put(done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                sample = q.get()
+                if sample is done:
+                    break
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    thread.join(0.1)
 
 
 def collate(sample: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
-    sz = len(sample)
-    batch = masks = rhos = flows = image_size = None
-    for i, idx in enumerate(sample):
-        s = sample[i]
-
-        images = s['images']
-        if batch is None:
-            image_size = images.size()
-            input = torch.FloatTensor(sz, *s['input'].size())
-            batch = torch.FloatTensor(sz, *image_size)
-            masks = torch.FloatTensor(sz, image_size[1], image_size[2]) 
-            rhos = torch.FloatTensor(sz, image_size[1], image_size[2]) 
-            flows = torch.FloatTensor(sz, 3, image_size[1], image_size[2])
-        
-        input[i] = s['input'].clone()
-        batch[i] = images.clone()
-        masks[i] = s['mask'].clone()
-        rhos[i] = s['rho'].clone()
-        flows[i] = s['flow'].clone()
-        
+    # default_collate stacks into shared memory when called in a worker,
+    # so the batch is not copied again when sent to the main process
     batch_sample = {}
-    batch_sample['input'] = input
-    batch_sample['images'] = batch
-    batch_sample['masks'] = masks
-    batch_sample['rhos'] = rhos
-    batch_sample['flows'] = flows
-    
+    batch_sample['input'] = default_collate([s['input'] for s in sample])
+    batch_sample['images'] = default_collate([s['images'] for s in sample])
+    batch_sample['masks'] = default_collate([s['mask'] for s in sample]).squeeze(1)
+    batch_sample['rhos'] = default_collate([s['rho'] for s in sample]).squeeze(1)
+    batch_sample['flows'] = default_collate([s['flow'] for s in sample])
     return batch_sample
 
 
+def to_float_batch(sample: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    # Converts a batch of the compact transport to the float layout of __getitem__,
+    # one op per tensor on whatever device the batch is on. Float batches pass through.
+    if sample['images'].dtype != torch.uint8:
+        return sample
+    flows = sample['flows']
+    out = {}
+    out['input'] = sample['input'].float().div_(255)
+    out['images'] = sample['images'].float().div_(255)
+    out['masks'] = sample['masks'].gt(0).float()
+    out['rhos'] = sample['rhos'].float().div_(255)
+    out['flows'] = torch.ones(flows.size(0), 3, flows.size(2), flows.size(3), device=flows.device)
+    out['flows'][:, :2].copy_(flows)
+    return out
+
+
+class PathIndex:
+    # All paths of an image list in one bytes buffer plus an offset array, stored in a
+    # sidecar file next to the list and memory-mapped, so workers only pickle the
+    # file name and the slice bounds.
+    MAGIC = b'ETOMIDX1'
+
+    def __init__(self, list_file: str, max_num: int = -1) -> None:
+        self.list_file = list_file
+        self.index_file = list_file + '.idx'
+        self.open()
+        self.start = 0
+        self.stop = self.count if max_num <= 0 else min(max_num, self.count)
+
+    def open(self) -> None:
+        if not os.path.isfile(self.index_file) or \
+                os.path.getmtime(self.index_file) < os.path.getmtime(self.list_file):
+            try:
+                self.build()
+            except OSError:
+                # read-only dataset directory, keep the index in memory
+                self.offsets, self.blob = self.parse()
+                self.count = len(self.offsets) - 1
+                return
+
+        data = np.memmap(self.index_file, dtype=np.uint8, mode='r')
+        assert bytes(data[:8]) == self.MAGIC, 'Unable to read ' + self.index_file + ' because of wrong tag'
+        self.count = int(data[8:16].view(np.int64)[0])
+        header = 16 + 8 * (self.count + 1)
+        self.offsets = data[16:header].view(np.int64)
+        self.blob = data[header:]
+
+    def parse(self) -> Tuple[np.ndarray, np.ndarray]:
+        with open(self.list_file, 'rb') as f:
+            paths = [l.rstrip(b'\r\n') for l in f]
+        paths = [p for p in paths if p]
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in paths], out=offsets[1:])
+        return offsets, np.frombuffer(b''.join(paths), dtype=np.uint8)
+
+    def build(self) -> None:
+        offsets, blob = self.parse()
+        tmp = f'{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.MAGIC)
+            f.write(np.int64(len(offsets) - 1).tobytes())
+            f.write(offsets.tobytes())
+            f.write(blob.tobytes())
+        os.replace(tmp, self.index_file)
+
+    def __getstate__(self) -> dict:
+        return {'list_file': self.list_file, 'index_file': self.index_file, 
+                'start': self.start, 'stop': self.stop}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f'index {idx} out of range for {len(self)} paths')
+        i = self.start + idx
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode()
+
+
 class ETOMDataset(torch.utils.data.Dataset):
     def __init__(self, opt: Namespace, split: str) -> None:
         self.opt = opt
@@ -67,23 +259,27 @@ class ETOMDataset(torch.utils.data.Dataset):
         if split == 'train':
             self.image_list = os.path.join(opt.data_dir, opt.train_list)
             self.dir = os.path.join(opt.data_dir, 'train/Images')
-            if opt.max_train_num > 0:
-                self.image_info = pd.read_csv(self.image_list, sep='\n', header=None, nrows=opt.max_train_num)
-            else:
-                self.image_info = pd.read_csv(self.image_list, sep='\n', header=None)
+            self.image_info = PathIndex(self.image_list, opt.max_train_num)
         elif split == 'val':
             self.image_list = os.path.join(opt.data_dir, opt.val_list)
             self.dir = os.path.join(opt.data_dir, 'val/Images')
-            if opt.max_val_num > 0:
-                self.image_info = pd.read_csv(self.image_list, sep='\n', header=None, nrows=opt.max_val_num)
-            else:
-                self.image_info = pd.read_csv(self.image_list, sep='\n', header=None)
+            self.image_info = PathIndex(self.image_list, opt.max_val_num)
         
         print(f'\n\n --> Split: {self.split}')
         print(f'totaling {len(self.image_info)} images')
         print(f'dataset filenames: {self.image_list}')
         print(f'dataset image directory: {self.dir}')
 
+        self.cache = self.setup_cache()
+
+    def setup_cache(self) -> Optional[SharedImageCache]:
+        if self.opt.cache_mb <= 0 or len(self) == 0:
+            return None
+        layout = [(k, tuple(v.size()), v.dtype) for k, v in self.decode(0).items()]
+        cache = SharedImageCache(len(self), int(self.opt.cache_mb * 2**20), layout)
+        print(f'decoded cache: {cache.n_slots} samples in {self.opt.cache_mb} MB')
+        return cache
+
     def transform(self, image: Tensor) -> Tensor:
         image = image
         return image
@@ -91,33 +287,58 @@ class ETOMDataset(torch.utils.data.Dataset):
     def __len__(self) -> int:
         return len(self.image_info)
 
-    def __getitem__(self, idx: int) -> Dict[str, Tensor]:
-        path = self.image_info.iloc[idx, 0]
+    def decode(self, idx: int) -> Dict[str, Tensor]:
+        path = self.image_info[idx]
         path_base = os.path.splitext(path)[0]
-        path_input = path_base + '_1x.jpg'
-        path_ref = path_base + '_ref.jpg'
-        path_tar = path_base + '.jpg'
-        path_mask = path_base + '_mask.png'
-        path_rho = path_base + '_rho.png'
-        path_flow = path_base + '_flow.flo'
 
-        image_input = Image.open(os.path.join(self.dir, path_input))
-        image_input = TF.to_tensor(image_input) # size: [3, h, w]
+        def read_image(suffix: str, mode: Optional[str] = None) -> Tensor:
+            image = Image.open(os.path.join(self.dir, path_base + suffix))
+            if mode is not None:
+                image = image.convert(mode)
+            image = torch.from_numpy(np.array(image, dtype=np.uint8))
+            if image.dim() == 2:
+                return image.unsqueeze(0)
+            return image.permute(2, 0, 1).contiguous()
 
-        image_ref = Image.open(os.path.join(self.dir, path_ref))
-        image_ref = TF.to_tensor(image_ref) # size: [3, h, w]
+        raw = {}
+        raw['input'] = read_image('_1x.jpg') # size: [3, h, w]
+        raw['ref'] = read_image('_ref.jpg') # size: [3, h, w]
+        raw['tar'] = read_image('.jpg') # size: [3, h, w]
+        raw['mask'] = read_image('_mask.png', 'L') # size: [1, h, w]
+        raw['rho'] = read_image('_rho.png', 'L') # size: [1, h, w]
+        raw['flow'] = utility.load_flow_raw(os.path.join(self.dir, path_base + '_flow.flo')) # size: [2, h, w]
+        return raw
 
-        image_tar = Image.open(os.path.join(self.dir, path_tar)) 
-        image_tar = TF.to_tensor(image_tar) # size: [3, h, w]
+    def load_raw(self, idx: int) -> Dict[str, Tensor]:
+        if self.cache is None:
+            return self.decode(idx)
+        raw = self.cache.get(idx)
+        if raw is None:
+            raw = self.decode(idx)
+            self.cache.put(idx, raw)
+        return raw
+
+    def __getitem__(self, idx: int) -> Dict[str, Tensor]:
+        path_tar = self.image_info[idx]
+        raw = self.load_raw(idx)
 
-        mask = Image.open(os.path.join(self.dir, path_mask))
-        mask = TF.to_tensor(mask.convert('L')) # size: [1, h, w]
-        mask.apply_(lambda x: 1 if x else 0)
+        if self.opt.compact:
+            # uint8 images, mask and rho, int16 flow; converted by to_float_batch on the device
+            sample = {}
+            sample['input'] = raw['input']
+            sample['images'] = torch.cat([raw['ref'], raw['tar']], 0)
+            sample['mask'] = raw['mask']
+            sample['rho'] = raw['rho']
+            sample['flow'] = raw['flow']
+            return sample
 
-        rho = Image.open(os.path.join(self.dir, path_rho))
-        rho = TF.to_tensor(rho.convert('L')) # size: [1, h, w]
+        image_input = raw['input'].float().div(255) # size: [3, h, w]
+        image_ref = raw['ref'].float().div(255) # size: [3, h, w]
+        image_tar = raw['tar'].float().div(255) # size: [3, h, w]
+        mask = raw['mask'].gt(0).float() # size: [1, h, w]
+        rho = raw['rho'].float().div(255) # size: [1, h, w]
 
-        flow = utility.load_flow(os.path.join(self.dir, path_flow)) # size: [2, h, w]
+        flow = raw['flow'].float() # size: [2, h, w]
         add_on= torch.ones(1, flow.size(1), flow.size(2)) # size: [1, h, w]
         flow = torch.cat([flow, add_on], 0) # size: [3, h, w]
 
@@ -133,6 +354,7 @@ class ETOMDataset(torch.utils.data.Dataset):
         need_rotate = need_aug and self.opt.rot_ang and self.split == 'train'
 
         if need_aug:
+            import cv2
             dark = torch.lt(rho, 0.7).expand(3, rho.size(1), rho.size(2))
             image_tar[dark] = image_tar[dark] + torch.distributions.Uniform(0.01, 0.2).sample()
             
@@ -1,93 +1,161 @@
 #!/usr/bin/env python3
 
-from torchvision.utils import save_image
-import torch
-import glob
 import os
-import struct
-from PIL import Image
-import torchvision.transforms.functional as TF
+import sys
+import glob
+import argparse
+import numpy as np
+import torch
 import torch.nn.functional as F
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from torchvision.utils import save_image
+from typing import List, Tuple, Dict, Iterator
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+import results
+
+def load_image(filename: str, mode: str = 'RGB') -> torch.Tensor:
+	img = np.array(Image.open(filename).convert(mode), dtype=np.float32) / 255
+	img = torch.from_numpy(img)
+	if img.dim() == 2:
+		return img.unsqueeze(0)
+	return img.permute(2, 0, 1) # output: [c, h, w]
+
+def find_file(d: str, suffix: str) -> str:
+	return os.path.join(d, next(n for n in sorted(os.listdir(d)) if n.endswith(suffix)))
+
+# results.ResultsStore given by --store, result dirs are then sample ids in it
+store = None
+
+def load_matte(d: str) -> Dict[str, torch.Tensor]:
+	if store is not None:
+		matte = results.to_float(store.get(d, ['mask', 'rho', 'flow']))
+		matte['mask'] = matte['mask'].gt(0)
+		return matte
+	matte = {}
+	matte['mask'] = load_image(find_file(d, 'mask.png'), 'L').gt(0)
+	matte['rho'] = load_image(find_file(d, 'rho.png'), 'L')
+	matte['flow'] = utility.load_flow(find_file(d, 'flow.flo'))
+	return matte
+
+def load_background(filename: str, size: Tuple[int, int]) -> torch.Tensor:
+	bg = load_image(filename)
+	if tuple(bg.size()[1:]) != size:
+		# flows are in pixels of the matte, so the background is resampled to it
+		bg = F.interpolate(bg.unsqueeze(0), size, mode='bilinear', align_corners=True).squeeze(0)
+	return bg
+
+def composite(bg: torch.Tensor, grid: torch.Tensor, mask: torch.Tensor, rho: torch.Tensor) -> torch.Tensor:
+	# grid, mask and rho may have batch size 1 and are then shared by all backgrounds
+	n = bg.size(0)
+	grid = grid.expand(n, -1, -1, -1)
+	pred = F.grid_sample(bg, grid, align_corners=True)
+	return utility.get_final_pred(bg, pred, mask.expand(n, -1, -1, -1), rho.expand(n, -1, -1, -1))
+
+def batches(items: List, size: int) -> Iterator[List]:
+	for i in range(0, len(items), size):
+		yield items[i:i+size]
+
+class Writer:
+	# at most 2 * workers images wait for encoding, rendering is faster than writing pngs
+	def __init__(self, workers: int) -> None:
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.pending = deque()
+		self.limit = 2 * workers
+
+	def write(self, images: torch.Tensor, names: List[str]) -> None:
+		images = images.clamp(0, 1).cpu()
+		for img, name in zip(images, names):
+			while self.pending and (self.pending[0].done() or len(self.pending) >= self.limit):
+				self.pending.popleft().result() # raises the error of a failed write
+			self.pending.append(self.pool.submit(save_image, img, name))
+
+	def close(self) -> None:
+		self.pool.shutdown(wait=True)
+		for p in self.pending:
+			p.result()
+
+def render_matte(opt: argparse.Namespace, writer: Writer, loader: ThreadPoolExecutor, device: torch.device) -> int:
+	# one matte onto many backgrounds: decode the matte and build its grid once
+	matte = load_matte(opt.matte)
+	size = tuple(matte['flow'].size()[1:])
+	grid = utility.grid_generator(matte['flow'].unsqueeze(0).to(device))
+	mask = matte['mask'].unsqueeze(0).to(device)
+	rho = matte['rho'].unsqueeze(0).to(device)
+
+	bgs = sorted(glob.glob(opt.bgs)) if not os.path.isdir(opt.bgs) else \
+			sorted(os.path.join(opt.bgs, n) for n in os.listdir(opt.bgs))
+	count = 0
+	for names in batches(bgs, opt.batch):
+		bg = torch.stack(list(loader.map(lambda n: load_background(n, size), names))).to(device)
+		out = composite(bg, grid, mask, rho)
+		outs = [os.path.join(opt.out_dir, os.path.splitext(os.path.basename(n))[0] + '_rec.png') for n in names]
+		writer.write(out, outs)
+		count += len(names)
+		print(count)
+	return count
+
+def render_pairs(opt: argparse.Namespace, writer: Writer, loader: ThreadPoolExecutor, device: torch.device) -> int:
+	# manifest lines: <background> <result dir> [<output png>]
+	with open(opt.pairs) as f:
+		pairs = [l.split() for l in f if l.strip()]
+
+	def load_pair(i: int) -> Tuple[torch.Tensor, Dict[str, torch.Tensor], str]:
+		p = pairs[i]
+		matte = load_matte(p[1])
+		bg = load_background(p[0], tuple(matte['flow'].size()[1:]))
+		out = p[2] if len(p) > 2 else os.path.join(opt.out_dir, f'{i:06d}_rec.png')
+		return bg, matte, out
+
+	count = 0
+	for idx in batches(list(range(len(pairs))), opt.batch):
+		loaded = list(loader.map(load_pair, idx))
+		bg = torch.stack([l[0] for l in loaded]).to(device)
+		flow = torch.stack([l[1]['flow'] for l in loaded]).to(device)
+		mask = torch.stack([l[1]['mask'] for l in loaded]).to(device)
+		rho = torch.stack([l[1]['rho'] for l in loaded]).to(device)
+		out = composite(bg, utility.grid_generator(flow), mask, rho)
+		writer.write(out, [l[2] for l in loaded])
+		count += len(idx)
+		print(count)
+	return count
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Composite predicted refractive objects onto backgrounds')
+	parser.add_argument('--pairs', type=str, default=None,
+						help='manifest of "<background> <result dir> [<output png>]" lines')
+	parser.add_argument('--matte', type=str, default=None,
+						help='result dir with mask.png, rho.png and flow.flo to render onto --bgs')
+	parser.add_argument('--store', type=str, default=None,
+						help='results store file, result dirs in --pairs and --matte are then sample ids')
+	parser.add_argument('--bgs', type=str, default=None,
+						help='background directory or glob pattern for --matte')
+	parser.add_argument('--out_dir', type=str, default='composite',
+						help='output directory')
+	parser.add_argument('--batch', type=int, default=16,
+						help='images warped per grid_sample call')
+	parser.add_argument('--workers', type=int, default=4,
+						help='threads decoding and encoding images')
+	parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+						help='device used for warping')
+	opt = parser.parse_args()
+	assert (opt.pairs is None) != (opt.matte is None), 'Use exactly one of --pairs and --matte'
+	assert opt.matte is None or opt.bgs is not None, '--matte needs --bgs'
+
+	os.makedirs(opt.out_dir, exist_ok=True)
+	if opt.store is not None:
+		store = results.ResultsStore(opt.store)
+	device = torch.device(opt.device)
+	writer = Writer(opt.workers)
+
+	with torch.no_grad(), ThreadPoolExecutor(max_workers=opt.workers) as loader:
+		if opt.matte is not None:
+			count = render_matte(opt, writer, loader, device)
+		else:
+			count = render_pairs(opt, writer, loader, device)
+	writer.close()
 
-root_dir = ''
-
-def load_flow(filename):
-	f = open(filename, 'rb')
-	tag = struct.unpack('f', f.read(4))[0]
-	
-	w = struct.unpack('i', f.read(4))[0]
-	h = struct.unpack('i', f.read(4))[0]
-	channels = 2
-	
-	l = [] # in file: [h, w, c]
-	for i, val in enumerate(struct.iter_unpack('h', f.read())):
-		if not i % 2:
-			l.append([])
-		l[int(i/2)].append(val[0])
-		
-	flow = torch.ShortTensor(l).reshape(h, w, channels)
-	f.close()
-	
-	flow = flow.permute(2, 0, 1).float() # output: [c, h, w]
-	return flow
-
-def create_single_warping(input):
-	ref = input[0]
-	flo = input[1]
-	grid = grid_generator(flo)
-	
-	output = F.grid_sample(ref, grid, align_corners=True)
-	return output
-
-def grid_generator(flow):
-	B, C, H, W = flow.size()
-	# mesh grid 
-	xx = torch.arange(0, W).view(1,-1).repeat(H,1)
-	yy = torch.arange(0, H).view(-1,1).repeat(1,W)
-	xx = xx.view(1,1,H,W).repeat(B,1,1,1)
-	yy = yy.view(1,1,H,W).repeat(B,1,1,1)
-	grid = torch.cat((xx,yy),1).float()
-
-	flow = 2.0 * flow.div(H)
-	
-	flow_clo = flow.clone()
-	flow[:,0,:,:] = flow_clo[:,1,:,:]
-	flow[:,1,:,:] = flow_clo[:,0,:,:]
-	
-	# scale grid to [-1,1] 
-	grid[:,0,:,:] = 2.0*grid[:,0,:,:].clone() / max(W-1,1)-1.0
-	grid[:,1,:,:] = 2.0*grid[:,1,:,:].clone() / max(H-1,1)-1.0
-	
-	grid = grid + flow
-	
-	grid = grid.permute(0,2,3,1)
-	
-	return grid
-
-def get_final_pred(ref_img, pred_img, pred_mask, pred_rho):
-	final_pred_img = torch.mul(1 - pred_mask, ref_img) + torch.mul(pred_mask, torch.mul(pred_img, pred_rho))
-	return final_pred_img
-
-bg = glob.glob(os.path.join(root_dir, '*bg.png'))[0]
-bg = Image.open(bg)
-bg = TF.to_tensor(bg)
-
-mask = glob.glob(os.path.join(root_dir, '*mask.png'))[0]
-mask = Image.open(mask)
-mask = TF.to_tensor(mask.convert('L'))
-mask.apply_(lambda x: 1 if x else 0)
-
-rho = glob.glob(os.path.join(root_dir, '*rho.png'))[0]
-rho = Image.open(rho)
-rho = TF.to_tensor(rho.convert('L'))
-
-flow = glob.glob(os.path.join(root_dir, '*flow.png'))[0]
-flow = load_flow(flow)
-
-pred = create_single_warping([bg.unsqueeze(0), flow.unsqueeze(0)])
-
-final = get_final_pred(bg, pred, mask, rho)
-
-save_image(final, root_dir + 'rec.png')
-
-print('done')
+	print(f'done, {count} images')
@@ -1,111 +1,165 @@
 #!/usr/bin/env python3
 
-import re
 import os
-import torch
-import torch.nn.functional as F
+import sys
+import math
+import csv
 import struct
-import glob
+import argparse
+import numpy as np
+import torch
+from multiprocessing import Pool
 from PIL import Image
-import torchvision.transforms.functional as TF
-import shutil
-from torchvision.utils import save_image
+from typing import List, Dict, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import metrics
+import results
 
-root_dir = ''
+FIELDS = ['name', 'rec_err', 'rho_err', 'flow_err', 'mask_err', 'psnr', 'ssim', 'masked_psnr', 'masked_ssim']
+
+# file name suffixes written by Trainer.save_images
+SUFFIXES = {
+	'tar': 'tar.png',
+	'rec': 'rec.png',
+	'mask': 'mask.png',
+	'mask_gt': 'mask_gt.png',
+	'rho': 'rho.png',
+	'rho_gt': 'rho_gt.png',
+	'flow': 'flow.flo',
+	'flow_gt': 'flow_gt.flo',
+}
 
 def load_flow(filename: str) -> torch.Tensor:
 	f = open(filename, 'rb')
 	tag = struct.unpack('f', f.read(4))[0]
-	
+
 	w = struct.unpack('i', f.read(4))[0]
 	h = struct.unpack('i', f.read(4))[0]
 	channels = 2
-	
-	l = [] # in file: [h, w, c]
-	for i, val in enumerate(struct.iter_unpack('h', f.read())):
-		if not i % 2:
-			l.append([])
-		l[int(i/2)].append(val[0])
-		
-	flow = torch.ShortTensor(l).reshape(h, w, channels)
+
+	l = np.fromfile(f, dtype=np.int16, count=h*w*channels) # in file: [h, w, c]
 	f.close()
-	
+
+	flow = torch.from_numpy(l).reshape(h, w, channels)
 	flow = flow.permute(2, 0, 1).float() # output: [c, h, w]
 	return flow
 
-def iou(pred, tar):
-	intersection = torch.logical_and(tar, pred)
-	union = torch.logical_or(tar, pred)
-	iou_score = torch.true_divide(torch.sum(intersection), torch.sum(union))
-	return iou_score
-
-def epe(mask_gt, flow_gt, flow):
-	mask_gt = mask_gt.expand_as(flow_gt)
-	flow = flow * mask_gt
-	flow_gt = flow_gt * mask_gt
-	return torch.norm(flow_gt-flow, dim=1).mean() / 100
-	
+def load_image(filename: str, mode: str = None) -> torch.Tensor:
+	img = Image.open(filename)
+	if mode is not None:
+		img = img.convert(mode)
+	img = torch.from_numpy(np.array(img, dtype=np.float32) / 255)
+	if img.dim() == 2:
+		return img.unsqueeze(0)
+	return img.permute(2, 0, 1) # output: [c, h, w]
+
+def find_files(d: str) -> Dict[str, str]:
+	names = sorted(os.listdir(d))
+	files = {}
+	for k, suffix in SUFFIXES.items():
+		files[k] = os.path.join(d, next(n for n in names if n.endswith(suffix)))
+	return files
+
+# results.ResultsStore opened by each worker when evaluating a single-file store
+store = None
+
+def load_stored_sample(name: str) -> Dict[str, torch.Tensor]:
+	sample = results.to_float(store.get(name, list(SUFFIXES.keys())))
+	sample['flow_gt'] = sample['flow_gt'][:2]
+	return sample
+
+def load_sample(d: str) -> Dict[str, torch.Tensor]:
+	if store is not None:
+		return load_stored_sample(d)
+	files = find_files(d)
+	sample = {}
+	sample['tar'] = load_image(files['tar'])
+	sample['rec'] = load_image(files['rec'])
+	sample['mask'] = load_image(files['mask'], 'L')
+	sample['mask_gt'] = load_image(files['mask_gt'], 'L')
+	sample['rho'] = load_image(files['rho'], 'L')
+	sample['rho_gt'] = load_image(files['rho_gt'], 'L')
+	sample['flow'] = load_flow(files['flow'])
+	sample['flow_gt'] = load_flow(files['flow_gt'])
+	return sample
+
+def evaluate_chunk(dirs: List[str]) -> List[Tuple]:
+	samples = {}
+	for d in dirs:
+		try:
+			samples[d] = load_sample(d)
+		except (StopIteration, OSError, KeyError) as e:
+			print(f'skipping {d}: {e!r}')
+
+	# stack samples of the same resolution and evaluate them as one batch
+	groups = {}
+	for d, s in samples.items():
+		groups.setdefault(tuple(s['tar'].size()), []).append(d)
+
+	rows = []
+	for names in groups.values():
+		batch = {k: torch.stack([samples[d][k] for d in names]) for k in SUFFIXES.keys()}
+		m = metrics.evaluate_batch(batch['rec'], batch['tar'], batch['rho'], batch['rho_gt'], \
+				batch['flow'], batch['flow_gt'], batch['mask'], batch['mask_gt'])
+		m = torch.stack([m[k] for k in FIELDS[1:]], 1).tolist()
+		for d, row in zip(names, m):
+			rows.append((os.path.basename(d), *row))
+	return rows
+
+def init_worker(store_path: str = None):
+	global store
+	torch.set_num_threads(1)
+	if store_path is not None:
+		store = results.ResultsStore(store_path)
+
+def read_results(filename: str) -> List[Dict[str, str]]:
+	if not os.path.isfile(filename):
+		return []
+	with open(filename, newline='') as f:
+		return list(csv.DictReader(f))
+
 if __name__ == '__main__':
-	sub_dir = [os.path.join(root_dir, name) for name in os.listdir(root_dir) if os.path.isdir(os.path.join(root_dir, name))]
-	print(len(sub_dir))
-	
-	rec_err = 0
-	rho_err = 0
-	flow_err = 0
-	mask_err = 0
-	
-	count = 0
-	
-	for d in sub_dir:
-		count += 1
-		print(count)
-		
-		bg = glob.glob(os.path.join(root_dir, d, '*bg.png'))[0]
-		bg = Image.open(bg)
-		bg = TF.to_tensor(bg)
-		
-		tar = glob.glob(os.path.join(root_dir, d, '*tar.png'))[0]
-		tar = Image.open(tar)
-		tar = TF.to_tensor(tar)
-		
-		rec = glob.glob(os.path.join(root_dir, d, '*rec.png'))[0]
-		rec = Image.open(rec)
-		rec = TF.to_tensor(rec)
-		
-		mask = glob.glob(os.path.join(root_dir, d, '*mask.png'))[0]
-		mask = Image.open(mask)
-		mask = TF.to_tensor(mask.convert('L'))
-		
-		mask_gt = glob.glob(os.path.join(root_dir, d, '*mask_gt.png'))[0]
-		mask_gt = Image.open(mask_gt)
-		mask_gt = TF.to_tensor(mask_gt.convert('L'))
-	
-		rho = glob.glob(os.path.join(root_dir, d, '*rho.png'))[0]
-		rho = Image.open(rho)
-		rho = TF.to_tensor(rho.convert('L'))
-		
-		rho_gt = glob.glob(os.path.join(root_dir, d, '*rho_gt.png'))[0]
-		rho_gt = Image.open(rho_gt)
-		rho_gt = TF.to_tensor(rho_gt.convert('L'))
-		
-		flow = glob.glob(os.path.join(root_dir, d, '*flow.flo'))[0]
-		flow = load_flow(flow)
-		
-		flow_gt = glob.glob(os.path.join(root_dir, d, '*flow_gt.flo'))[0]
-		flow_gt = load_flow(flow_gt)
-		
-		rec_err += 100 * F.mse_loss(rec, tar)
-		rho_err += 100 * F.mse_loss(rho, rho_gt)
-		flow_err += epe(mask_gt, flow_gt * rho_gt, flow * rho_gt)
-		mask_err += iou(mask, mask_gt)
-
-	size = len(sub_dir)
-	rec_err /= size
-	rho_err /= size
-	flow_err /= size
-	mask_err /= size
-	
-	print(f'rec_err: {rec_err}')
-	print(f'rho_err: {rho_err}')
-	print(f'flow_err: {flow_err}')
-	print(f'mask_err: {mask_err}')
+	parser = argparse.ArgumentParser(description='Evaluate saved ETOM-Net results')
+	parser.add_argument('root_dir', type=str,
+						help='directory of per-sample result directories or a results store file')
+	parser.add_argument('--out', type=str, default=None,
+						help='per-sample csv (default: <root_dir>/eval.csv), appended to when resuming')
+	parser.add_argument('--workers', type=int, default=os.cpu_count(),
+						help='evaluation processes')
+	parser.add_argument('--batch', type=int, default=16,
+						help='samples evaluated together by one worker')
+	opt = parser.parse_args()
+
+	is_store = os.path.isfile(opt.root_dir)
+	out = opt.out or (os.path.splitext(opt.root_dir)[0] + '_eval.csv' if is_store else os.path.join(opt.root_dir, 'eval.csv'))
+	done = set(r['name'] for r in read_results(out))
+	if is_store:
+		# sample ids instead of directories, the index is read once here
+		with results.ResultsStore(opt.root_dir) as s:
+			sub_dir = [id for id in s.ids() if id not in done]
+	else:
+		sub_dir = sorted(e.path for e in os.scandir(opt.root_dir) if e.is_dir() and e.name not in done)
+	print(f'{len(done)} evaluated, {len(sub_dir)} remaining')
+
+	chunks = [sub_dir[i:i+opt.batch] for i in range(0, len(sub_dir), opt.batch)]
+	new_file = not os.path.isfile(out)
+	count = len(done)
+
+	with open(out, 'a', newline='') as f, Pool(opt.workers, initializer=init_worker, \
+			initargs=(opt.root_dir if is_store else None,)) as pool:
+		writer = csv.writer(f)
+		if new_file:
+			writer.writerow(FIELDS)
+		for rows in pool.imap_unordered(evaluate_chunk, chunks):
+			writer.writerows(rows)
+			f.flush()
+			count += len(rows)
+			print(count)
+
+	results = read_results(out)
+	for k in FIELDS[1:]:
+		# masked metrics are nan for samples without object pixels
+		values = [float(r[k]) for r in results if r.get(k)]
+		values = [v for v in values if not math.isnan(v)]
+		print(f'{k}: {sum(values) / max(len(values), 1)}')
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from torchvision.utils import save_image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utility
+import results
+
+# file names written by Trainer.save_images
+IMAGES = {
+	'rec': 'in_rec.png',
+	'mask': 'mask.png',
+	'rho': 'rho.png',
+	'bg': 'bg.png',
+	'mask_gt': 'mask_gt.png',
+	'rho_gt': 'rho_gt.png',
+	'input': 'input.png',
+	'tar': 'tar.png',
+}
+
+def export_sample(store: results.ResultsStore, id: str, out_dir: str) -> None:
+	d = os.path.join(out_dir, id)
+	os.makedirs(d, exist_ok=True)
+	raw = store.get(id)
+	sample = results.to_float(raw)
+	for k, name in IMAGES.items():
+		save_image(sample[k], os.path.join(d, name))
+	utility.save_flow(os.path.join(d, 'flow.flo'), raw['flow'])
+	utility.save_flow(os.path.join(d, 'flow_gt.flo'), raw['flow_gt'][:2])
+	save_image(utility.flow_to_color(sample['flow'] * sample['mask_gt']), os.path.join(d, 'fcolor.png'))
+	save_image(utility.flow_to_color(sample['flow_gt']), os.path.join(d, 'fcolor_gt.png'))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Export a results store to the results/<id>/ directory layout')
+	parser.add_argument('store', type=str,
+						help='results store file written with --results_store')
+	parser.add_argument('--out_dir', type=str, default='results',
+						help='output directory')
+	parser.add_argument('--ids', type=str, default=None,
+						help='comma separated sample ids (default: all)')
+	parser.add_argument('--workers', type=int, default=4,
+						help='threads decoding and encoding samples')
+	opt = parser.parse_args()
+
+	torch.set_num_threads(1)
+	with results.ResultsStore(opt.store) as store:
+		ids = opt.ids.split(',') if opt.ids else store.ids()
+		with ThreadPoolExecutor(max_workers=opt.workers) as pool:
+			for count, _ in enumerate(pool.map(lambda id: export_sample(store, id, opt.out_dir), ids), 1):
+				print(count)
+
+	print(f'done, {len(ids)} samples')
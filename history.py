@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import argparse
+from typing import List, Dict, Optional, Any
+
+
+class MetricsStore:
+    # Append-only JSONL log of per-epoch numeric results in <log_dir>/metrics.jsonl.
+    # Appending never reads the existing records back.
+    def __init__(self, log_dir: str) -> None:
+        self.file = os.path.join(log_dir, 'metrics.jsonl')
+
+    def append(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        record = dict(record)
+        record.setdefault('time', time.time())
+        with open(self.file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        return record
+
+    def read(self, split: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not os.path.isfile(self.file):
+            return []
+        records = []
+        with open(self.file) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                r = json.loads(line)
+                if split is None or r.get('split') == split:
+                    records.append(r)
+        return records
+
+
+def flatten(record: Dict[str, Any]) -> Dict[str, float]:
+    # {'losses': {'mask': 1}, 'lr': 2} -> {'losses/mask': 1, 'lr': 2}
+    flat = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            for k2, v2 in flatten(v).items():
+                flat[f'{k}/{k2}'] = v2
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[k] = v
+    return flat
+
+
+def lookup(record: Dict[str, Any], key: str) -> Optional[float]:
+    flat = flatten(record)
+    if key in flat:
+        return flat[key]
+    # allow the short name of a nested key, e.g. 'flow_err' for 'metrics/flow_err'
+    matches = [v for k, v in flat.items() if k.split('/')[-1] == key]
+    return matches[0] if len(matches) == 1 else None
+
+
+def compare_runs(log_dirs: List[str], key: str, split: str = 'val', maximize: bool = False) -> str:
+    runs = {d: {r['epoch']: lookup(r, key) for r in MetricsStore(d).read(split)} for d in log_dirs}
+    epochs = sorted(set(e for r in runs.values() for e in r.keys()))
+    names = [os.path.basename(os.path.dirname(os.path.normpath(d))) or d for d in log_dirs]
+
+    s = f'{split} {key}\n'
+    s += f'{"epoch":<8}' + ''.join(f'{n[-30:]:>32}' for n in names) + '\n'
+    for e in epochs:
+        s += f'{e:<8}'
+        for d in log_dirs:
+            v = runs[d].get(e)
+            s += f'{"-" if v is None else format(v, ".6g"):>32}'
+        s += '\n'
+
+    s += f'{"best":<8}'
+    best = max if maximize else min
+    for d in log_dirs:
+        values = [v for v in runs[d].values() if v is not None]
+        s += f'{"-" if not values else format(best(values), ".6g"):>32}'
+    return s
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare metrics of ETOM-Net runs')
+    parser.add_argument('log_dirs', type=str, nargs='+',
+                        help='log directories containing metrics.jsonl')
+    parser.add_argument('--key', type=str, default='losses/total',
+                        help='metric to compare, e.g. losses/total, flow_err, lr')
+    parser.add_argument('--split', type=str, default='val',
+                        help='train | val')
+    parser.add_argument('--maximize', action='store_true',
+                        help='higher is better (iou, psnr, ssim)')
+    opt = parser.parse_args()
+
+    print(compare_runs(opt.log_dirs, opt.key, opt.split, opt.maximize))
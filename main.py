@@ -7,29 +7,43 @@ from dataloader import create
 from checkpoint import CheckPoint, update_history
 from models.init import setup
 from train import Trainer
-from option import args
+from option import parse_args, prepare_dirs
+from memplan import auto_batch
 import utility
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    print("\n\n --> Let's use", torch.cuda.device_count(), "GPUs!")
+    prepare_dirs(args)
+
+    if args.auto_batch:
+        auto_batch(args)
+
     torch.manual_seed(0)
     np.random.seed(0)
 
     loaders = create(args)
-    check_p, optim_state = CheckPoint.latest(args)
+    check_p, optim_state, snapshot = CheckPoint.resume(args)
     model = setup(args, check_p)
     trainer = Trainer(model, args, optim_state)
 
     start_epoch = check_p['epoch'] if check_p else args.start_epoch
+    if snapshot is not None:
+        trainer.load_snapshot(snapshot, loaders[0].sampler)
 
     if args.val_only:
         results = trainer.test(0, loaders[1], 'val')
         exit(0)
 
     for epoch in range(start_epoch, args.n_epochs):
+        loaders[0].sampler.set_epoch(epoch)
         train_loss = trainer.train(epoch, loaders[0], 'train')
         update_history(args, epoch+1, train_loss, 'train')
 
+        if loaders[0].dataset.cache is not None:
+            print(f'\n\n --> [Cache] {loaders[0].dataset.cache.stats_string()}')
+
         if (epoch+1) % args.save_interval == 0:
             print('\n\n===== Epoch {} saving checkpoint ====='.format(epoch+1))
             CheckPoint.save(args, model, trainer.optim_state, epoch+1)
@@ -0,0 +1,210 @@
+import gc
+import math
+import torch
+import numpy as np
+from argparse import Namespace
+from typing import Dict, Optional, Tuple
+from models import CoarseNet, RefineNet
+from option import parse_args
+from train import Trainer
+
+
+def synthetic_batch(n: int, device: torch.device) -> Dict[str, torch.Tensor]:
+    # shapes of a dataloader batch: 256 input, 512 ground truth (fixed by both networks)
+    return {
+        'input': torch.rand(n, 3, 256, 256, device=device),
+        'images': torch.rand(n, 6, 512, 512, device=device),
+        'masks': torch.randint(0, 2, (n, 512, 512), device=device).float(),
+        'rhos': torch.rand(n, 512, 512, device=device),
+        'flows': torch.cat([torch.randn(n, 2, 512, 512, device=device) * 10, \
+                torch.ones(n, 1, 512, 512, device=device)], 1),
+    }
+
+
+def reset_peak(device: torch.device) -> None:
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    # resets VmHWM, the peak resident set size of the process (Linux)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_bytes(device: torch.device) -> int:
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return read_kb('/proc/self/status', 'VmHWM')
+
+
+def read_kb(file: str, key: str) -> int:
+    with open(file) as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def device_budget(device: torch.device, fraction: float = 0.9) -> int:
+    if device.type == 'cuda':
+        return int(torch.cuda.get_device_properties(device).total_memory * fraction)
+    # the peak is the resident set of the whole process, which already holds some memory
+    available = read_kb('/proc/meminfo', 'MemAvailable') or read_kb('/proc/meminfo', 'MemTotal')
+    return int((available + read_kb('/proc/self/status', 'VmRSS')) * fraction)
+
+
+def get_budget(opt: Namespace, device: torch.device) -> int:
+    return int(opt.mem_budget * 2**20) if opt.mem_budget > 0 else device_budget(device)
+
+
+def is_oom(e: Exception) -> bool:
+    msg = str(e).lower()
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in msg or "can't allocate memory" in msg
+
+
+class MemoryPlanner:
+    # Measures the peak memory of one full training step (forward, loss, backward and
+    # optimizer step, with the AMP and activation checkpointing settings of opt) on
+    # synthetic batches, fits peak = base + per_sample * n and verifies the largest
+    # batch the fit allows within the budget.
+    def __init__(self, opt: Namespace, device: torch.device) -> None:
+        self.opt = opt
+        self.device = device
+        if opt.refine:
+            model = RefineNet.RefineNet(opt)
+        else:
+            model = CoarseNet.CoarseNet(opt)
+            model.set_act_ckpt(opt.act_ckpt)
+        self.trainer = Trainer(model, opt, None)
+        self.trainer.model.train()
+        self.probes = {}
+
+    def step(self, n: int) -> None:
+        sample = synthetic_batch(n, self.device)
+        _, _, loss, _ = self.trainer.step(sample)
+        self.trainer.backward(loss, self.opt.ga - 1) # includes the optimizer step
+        del sample, loss
+
+    def probe(self, n: int) -> Optional[int]:
+        # peak bytes of a step with batch size n, None if it does not fit
+        if n in self.probes:
+            return self.probes[n]
+        reset_peak(self.device)
+        try:
+            self.step(n)
+            peak = peak_bytes(self.device)
+        except RuntimeError as e:
+            if not is_oom(e):
+                raise
+            peak = None
+        self.trainer.optimizer.zero_grad()
+        self.probes[n] = peak
+        print(f'[Memory Plan] batch {n}: ' + ('out of memory' if peak is None else f'{peak / 2**20:.0f} MB'))
+        return peak
+
+    def plan(self, budget: int, limit: int = 1024) -> Tuple[int, float, float]:
+        # returns (max batch, base MB, MB per sample)
+        self.probe(1) # allocates the optimizer state, which is part of the base
+        self.probes.clear()
+        p1, p2 = self.probe(1), self.probe(2)
+        if p1 is None or p1 > budget:
+            return 0, math.nan, math.nan
+        if p2 is None:
+            return 1, math.nan, math.nan
+        per_sample = max(p2 - p1, 1)
+        base = p1 - per_sample
+        if self.device.type != 'cuda':
+            return self.grow(budget, limit)
+        n = int(min(max((budget - base) // per_sample, 1), limit))
+        # the fit is verified and corrected downwards, peaks are not exactly linear
+        while n > 1:
+            peak = self.probe(n)
+            if peak is not None and peak <= budget:
+                break
+            if peak is None:
+                n = min(int(n * 0.9), n - 1)
+            else:
+                n = min(int(n * (budget - base) / (peak - base)), n - 1)
+            n = max(n, 1)
+        return n, base / 2**20, per_sample / 2**20
+
+    def grow(self, budget: int, limit: int) -> Tuple[int, float, float]:
+        # On CPU the peak (VmHWM) includes memory the allocator kept from earlier probes,
+        # so p2 - p1 underestimates the cost of a sample and a probe far beyond the
+        # measured sizes may be killed by the kernel instead of raising. The batch is
+        # doubled from 2 while the slope of the last two probes predicts it to fit.
+        n, per_sample = 2, max(self.probes[2] - self.probes[1], 1)
+        if self.probes[2] > budget:
+            return 1, (self.probes[1] - per_sample) / 2**20, per_sample / 2**20
+        while n < limit:
+            m = min(2 * n, limit)
+            if self.probes[n] + per_sample * (m - n) > budget:
+                break
+            peak = self.probe(m)
+            if peak is None or peak > budget:
+                break
+            per_sample = max((peak - self.probes[n]) / (m - n), 1)
+            n = m
+        return n, (self.probes[n] - per_sample * n) / 2**20, per_sample / 2**20
+
+
+def suggest_ga(max_batch: int, target: int, devices: int) -> Tuple[int, int]:
+    # fewest accumulation steps reaching the target, then the smallest batch per step
+    ga = math.ceil(target / (max_batch * devices))
+    return math.ceil(target / (ga * devices)), ga
+
+
+def batch_flag(batch: int, opt: Namespace) -> int:
+    # --batch_size value that option.finalize turns into this per-device batch
+    return batch * (2 if opt.refine else 1)
+
+
+def report(opt: Namespace, devices: int, budget: int, result: Tuple[int, float, float]) -> str:
+    n, base, per_sample = result
+    s = f'network: {"RefineNet" if opt.refine else "CoarseNet"}, amp: {opt.amp}, act_ckpt: {opt.act_ckpt}, ' \
+            f'batch_aug: {opt.batch_aug}\n'
+    s += f'budget per device: {budget / 2**20:.0f} MB, base: {base:.0f} MB, per sample: {per_sample:.0f} MB\n'
+    s += f'max batch per device: {n}, total: {n * max(devices, 1)}\n'
+    if n > 0 and opt.target_batch > 0:
+        batch, ga = suggest_ga(n, opt.target_batch, max(devices, 1))
+        s += f'target batch {opt.target_batch}: --batch_size {batch_flag(batch, opt)} --ga {ga} ' \
+                f'(effective {batch * max(devices, 1) * ga})\n'
+    elif n > 0:
+        s += f'suggested: --batch_size {batch_flag(n, opt)}\n'
+    return s.rstrip('\n')
+
+
+def auto_batch(opt: Namespace) -> Namespace:
+    # replaces opt.batch_size (and opt.ga for --target_batch) by the planned values
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    devices = torch.cuda.device_count()
+    budget = get_budget(opt, device)
+    planner = MemoryPlanner(opt, device)
+    n = planner.plan(budget, opt.plan_limit)[0]
+    del planner
+    reset_peak(device)
+    assert n > 0, f'A batch of one does not fit in {budget / 2**20:.0f} MB'
+
+    if opt.target_batch > 0:
+        n, opt.ga = suggest_ga(n, opt.target_batch, max(devices, 1))
+    opt.batch_size = n * max(devices, 1)
+    print(f'\n\n --> [Memory Plan] batch_size: {opt.batch_size}, ga: {opt.ga}')
+    return opt
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    devices = torch.cuda.device_count()
+    budget = get_budget(args, device)
+
+    planner = MemoryPlanner(args, device)
+    result = planner.plan(budget, args.plan_limit)
+    print(f'\n\n --> [Memory Plan] Summary: \n{report(args, devices, budget, result)}')
@@ -0,0 +1,121 @@
+import math
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from typing import Dict, Optional
+
+# All metrics take batched [n, c, h, w] tensors and return one value per sample,
+# computed on the device of the inputs.
+
+
+def mse(pred: Tensor, tar: Tensor) -> Tensor:
+    return (pred - tar).pow(2).mean((1, 2, 3))
+
+
+def masked_mean(x: Tensor, mask: Tensor) -> Tensor:
+    # samples with an empty mask yield nan and are skipped by MetricMeter
+    mask = mask.expand_as(x).float()
+    return (x * mask).sum((1, 2, 3)) / mask.sum((1, 2, 3))
+
+
+def psnr(pred: Tensor, tar: Tensor, mask: Optional[Tensor] = None, max_val: float = 1.0) -> Tensor:
+    err = (pred - tar).pow(2)
+    err = err.mean((1, 2, 3)) if mask is None else masked_mean(err, mask)
+    # identical images are capped at 100 dB
+    return 10 * torch.log10(max_val ** 2 / err.clamp(min=max_val ** 2 * 1e-10))
+
+
+def gaussian_window(size: int, sigma: float, channels: int, device: torch.device) -> Tensor:
+    x = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+    g = torch.exp(-x.pow(2) / (2 * sigma ** 2))
+    g = g / g.sum()
+    return (g.view(-1, 1) * g.view(1, -1)).expand(channels, 1, size, size).contiguous()
+
+
+def ssim(pred: Tensor, tar: Tensor, mask: Optional[Tensor] = None, max_val: float = 1.0,
+        size: int = 11, sigma: float = 1.5) -> Tensor:
+    c = pred.size(1)
+    window = gaussian_window(size, sigma, c, pred.device).to(pred.dtype)
+    c1 = (0.01 * max_val) ** 2
+    c2 = (0.03 * max_val) ** 2
+
+    mu_x = F.conv2d(pred, window, groups=c)
+    mu_y = F.conv2d(tar, window, groups=c)
+    sigma_x = F.conv2d(pred * pred, window, groups=c) - mu_x.pow(2)
+    sigma_y = F.conv2d(tar * tar, window, groups=c) - mu_y.pow(2)
+    sigma_xy = F.conv2d(pred * tar, window, groups=c) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / \
+            ((mu_x.pow(2) + mu_y.pow(2) + c1) * (sigma_x + sigma_y + c2))
+
+    if mask is None:
+        return ssim_map.mean((1, 2, 3))
+    # the map only covers the valid window positions
+    pad = (size - 1) // 2
+    return masked_mean(ssim_map, mask[:, :, pad:pad+ssim_map.size(2), pad:pad+ssim_map.size(3)])
+
+
+def iou(pred: Tensor, tar: Tensor) -> Tensor:
+    intersection = torch.logical_and(tar, pred)
+    union = torch.logical_or(tar, pred)
+    return torch.true_divide(intersection.sum((1, 2, 3)), union.sum((1, 2, 3)))
+
+
+def epe(mask_gt: Tensor, flow_gt: Tensor, flow: Tensor) -> Tensor:
+    mask_gt = mask_gt.expand_as(flow_gt)
+    flow = flow * mask_gt
+    flow_gt = flow_gt * mask_gt
+    return torch.norm(flow_gt-flow, dim=1).mean((1, 2)) / 100
+
+
+def evaluate_batch(
+    rec: Tensor,
+    tar: Tensor,
+    rho: Tensor,
+    rho_gt: Tensor,
+    flow: Tensor,
+    flow_gt: Tensor,
+    mask: Tensor,
+    mask_gt: Tensor
+    ) -> Dict[str, Tensor]:
+    # rec/tar: [n, 3, h, w], rho/rho_gt/mask/mask_gt: [n, 1, h, w], flow/flow_gt: [n, 2(+1), h, w]
+    flow_gt = flow_gt.narrow(1, 0, 2)
+    return {
+        'rec_err': 100 * mse(rec, tar),
+        'rho_err': 100 * mse(rho, rho_gt),
+        'flow_err': epe(mask_gt, flow_gt * rho_gt, flow * rho_gt),
+        'mask_err': iou(mask, mask_gt),
+        'psnr': psnr(rec, tar),
+        'ssim': ssim(rec, tar),
+        'masked_psnr': psnr(rec, tar, mask_gt),
+        'masked_ssim': ssim(rec, tar, mask_gt),
+    }
+
+
+class MetricMeter:
+    # Keeps running sums on the device; only average() copies them to the host.
+    def __init__(self) -> None:
+        self.sums = {}
+        self.counts = {}
+
+    def update(self, values: Dict[str, Tensor]) -> None:
+        for k, v in values.items():
+            v = v.detach().reshape(-1).float()
+            valid = ~torch.isnan(v)
+            if k not in self.sums:
+                self.sums[k] = torch.zeros((), device=v.device)
+                self.counts[k] = torch.zeros((), device=v.device)
+            self.sums[k] += torch.where(valid, v, torch.zeros_like(v)).sum()
+            self.counts[k] += valid.sum()
+
+    def average(self) -> Dict[str, float]:
+        if not self.sums:
+            return {}
+        keys = list(self.sums.keys())
+        sums = torch.stack([self.sums[k] for k in keys]).tolist()
+        counts = torch.stack([self.counts[k] for k in keys]).tolist()
+        return {k: s / c if c else math.nan for k, s, c in zip(keys, sums, counts)}
+
+    def reset(self) -> None:
+        self.sums = {}
+        self.counts = {}
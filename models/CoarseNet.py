@@ -1,12 +1,24 @@
 import torch.nn as nn
 import torch
 from torch import Tensor
-from typing import Type, Any, Callable, Union, List, Optional
+from typing import Type, Any, Callable, Union, List, Optional, Tuple
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from torch.utils.checkpoint import checkpoint
 import math
 from argparse import Namespace
 
 
+def run_in_state(branch: Callable[[], Tensor], grad: bool, casts: List[Tuple[str, torch.dtype]]) -> Tensor:
+    with ExitStack() as stack:
+        stack.enter_context(torch.set_grad_enabled(grad))
+        for device_type, dtype in casts:
+            stack.enter_context(torch.autocast(device_type, dtype))
+        return branch()
+
+
 class CreateOutput(nn.Module):
     def __init__(self, in_channels: int, w: int, scale: int) -> None:
         super(CreateOutput, self).__init__()
@@ -20,7 +32,7 @@ class CreateOutput(nn.Module):
         self.conv2 = nn.Conv2d(in_channels, 1, k, step, pad)
 
     def forward(self, x: List[Tensor]) -> List[Tensor]:
-        if type(x) != Tensor:
+        if isinstance(x, (list, tuple)):
             x = torch.cat(x, dim=1) 
         
         flow = self.conv1_0(x)
@@ -77,7 +89,7 @@ class Decoder(nn.Module):
         self.decoder = nn.Sequential(od)
 
     def forward(self, x: Union[Tensor, List[Tensor]]) -> Tensor:
-        if type(x) != Tensor:
+        if isinstance(x, (list, tuple)):
             x = torch.cat(x, dim=1) 
 
         return self.decoder(x)
@@ -236,10 +248,85 @@ class CoarseNet(nn.Module):
         self.normalize_output3 = NormalizeOutput(w, 3)
         self.normalize_output2 = NormalizeOutput(w, 2)
 
+    def __getstate__(self) -> dict:
+        # thread pools and cuda streams are runtime state, recreated lazily after loading
+        state = self.__dict__.copy()
+        state['branch_pool'] = None
+        state['branch_streams'] = None
+        return state
+
+    def set_branch_parallel(self, mode: str, devices: Optional[List[torch.device]] = None) -> None:
+        assert mode in ['none', 'streams', 'threads', 'devices'], f'Unknown branch parallel mode: {mode}'
+        self.branch_mode = mode
+        self.branch_devices = devices if mode == 'devices' else None
+        self.branch_pool = None
+        self.branch_streams = None
+
+    def set_act_ckpt(self, enabled: bool) -> None:
+        # Recompute the RIRB towers in backward instead of keeping their activations.
+        # They have no batch norm, so the recomputation matches the first forward exactly.
+        self.act_ckpt = enabled
+
+    def run_tower(self, i: int, x: Tensor) -> Tensor:
+        if not getattr(self, 'act_ckpt', False) or not torch.is_grad_enabled():
+            return self.RIRB0[i](x)
+        for block in self.RIRB0[i]:
+            x = checkpoint(block, x, use_reentrant=False)
+        return x
+
+    def place_branches(self) -> None:
+        # RIRB towers and their first decoders only depend on the bottleneck, so they
+        # live on their own device; decoder5..1 mix all branches and stay on the main one
+        for i, device in enumerate(self.branch_devices):
+            if next(self.RIRB0[i].parameters()).device != device:
+                self.RIRB0[i].to(device)
+                self.decoder6[i].to(device)
+
+    def run_branches(self, branches: List[Callable[[], Tensor]]) -> List[Tensor]:
+        mode = getattr(self, 'branch_mode', 'none')
+
+        if mode == 'threads':
+            if self.branch_pool is None:
+                self.branch_pool = ThreadPoolExecutor(max_workers=len(branches))
+            # grad mode and autocast are thread local, the workers run in the state of the caller
+            grad = torch.is_grad_enabled()
+            casts = [(d, torch.get_autocast_dtype(d)) for d in ['cuda', 'cpu'] if torch.is_autocast_enabled(d)]
+            futures = [self.branch_pool.submit(run_in_state, b, grad, casts) for b in branches]
+            return [f.result() for f in futures]
+
+        if mode == 'streams' and torch.cuda.is_available():
+            if self.branch_streams is None:
+                self.branch_streams = [torch.cuda.Stream() for _ in branches]
+            current = torch.cuda.current_stream()
+            results = []
+            for b, stream in zip(branches, self.branch_streams):
+                stream.wait_stream(current)
+                with torch.cuda.stream(stream):
+                    out = b()
+                out.record_stream(current)
+                results.append(out)
+            for stream in self.branch_streams:
+                current.wait_stream(stream)
+            return results
+
+        return [b() for b in branches]
+
+    def bottleneck_branch(self, i: int, conv6: Tensor) -> Tensor:
+        devices = getattr(self, 'branch_devices', None)
+        if devices is None:
+            return self.decoder6[i](conv6 + self.run_tower(i, conv6))
+
+        x = conv6.to(devices[i], non_blocking=True)
+        out = self.decoder6[i](x + self.run_tower(i, x))
+        return out.to(conv6.device, non_blocking=True)
+
     def forward(self, x: Tensor) -> List[List[Tensor]]:
         opt = self.opt
         n_out = 3
 
+        if getattr(self, 'branch_devices', None) is not None:
+            self.place_branches()
+
         # upsampling
         x = nn.functional.interpolate(x, (512,512), mode='bicubic', align_corners=True)
 
@@ -253,30 +340,20 @@ class CoarseNet(nn.Module):
         conv6 = self.encoder6(conv5)
 
         # decoder
-        deconv6 = []
-        deconv5 = []
-        deconv4 = []
-        deconv3 = []
-        deconv2 = []
-        deconv1 = []
         results = []
 
-        for i in range(n_out):
-            deconv6.append(self.decoder6[i](conv6 + self.RIRB0[i](conv6)))
+        deconv6 = self.run_branches([partial(self.bottleneck_branch, i, conv6) for i in range(n_out)])
         deconv6.append(conv5)
 
-        for i in range(n_out):
-            deconv5.append(self.decoder5[i](deconv6))
+        deconv5 = self.run_branches([partial(self.decoder5[i], deconv6) for i in range(n_out)])
         deconv5.append(conv4)  # deconv5
 
-        for i in range(n_out):
-            deconv4.append(self.decoder4[i](deconv5))
+        deconv4 = self.run_branches([partial(self.decoder4[i], deconv5) for i in range(n_out)])
         deconv4.append(conv3)  # deconv4
 
         ms_num = opt.ms_num
 
-        for i in range(n_out):
-            deconv3.append(self.decoder3[i](deconv4))
+        deconv3 = self.run_branches([partial(self.decoder3[i], deconv4) for i in range(n_out)])
         deconv3.append(conv2)  # deconv3
         
         if ms_num >= 4:
@@ -286,8 +363,7 @@ class CoarseNet(nn.Module):
             deconv3.append(s4_out_up)
             results.append(s4_out)
 
-        for i in range(n_out):
-            deconv2.append(self.decoder2[i](deconv3))
+        deconv2 = self.run_branches([partial(self.decoder2[i], deconv3) for i in range(n_out)])
         deconv2.append(conv1)  # deconv2
 
         if ms_num >= 3:
@@ -297,8 +373,7 @@ class CoarseNet(nn.Module):
             deconv2.append(s3_out_up)
             results.append(s3_out)
 
-        for i in range(n_out):
-            deconv1.append(self.decoder1[i](deconv2))
+        deconv1 = self.run_branches([partial(self.decoder1[i], deconv2) for i in range(n_out)])
         deconv1.append(conv0)  # deconv1
 
         if ms_num >= 2:
@@ -1,7 +1,7 @@
 import torch.nn as nn
 import torch
 from torch import Tensor
-from typing import Type, Any, Callable, Union, List, Optional
+from typing import Type, Any, Callable, Union, List, Optional, Tuple
 from collections import OrderedDict
 import math
 from argparse import Namespace
@@ -103,8 +103,80 @@ class RefineNet(nn.Module):
 
         self.conv1 = nn.Conv2d(self.n+2, 2, 3, 1, 1) # flow
         self.conv2 = nn.Conv2d(self.n+2, 2, 3, 1, 1) # mask
-
-    def forward(self, x: List[Tensor]) -> Tensor:
+        self.roi = None
+
+    def set_roi(self, pad: int = 32, buckets: Optional[List[int]] = None) -> None:
+        # Refine only a box around the coarse mask, padded by pad pixels on each side.
+        # Box sides are rounded up to a bucket size (multiples of 8) so that samples
+        # with similar objects are refined together. Pass pad < 0 to disable.
+        if pad < 0:
+            self.roi = None
+            return
+        buckets = sorted(buckets or [64, 128, 192, 256, 320, 384, 448, 512])
+        assert all(b % 8 == 0 for b in buckets), 'ROI bucket sizes must be multiples of 8'
+        self.roi = {'pad': pad, 'buckets': buckets}
+
+    def bucket(self, size: int, limit: int) -> int:
+        for b in self.roi['buckets']:
+            if b >= size:
+                return min(b, limit)
+        return limit
+
+    def roi_boxes(self, mask: Tensor) -> List[Optional[Tuple[int, int, int, int]]]:
+        # [y0, x0, h, w] of the padded box around the coarse mask, None without object pixels
+        n, _, h, w = mask.size()
+        fg = mask[:, 1] > mask[:, 0]
+        rows, cols = fg.any(2), fg.any(1)
+        ys = torch.arange(h, device=mask.device)
+        xs = torch.arange(w, device=mask.device)
+        bounds = torch.stack([
+            rows.any(1).long(),
+            torch.where(rows, ys, h).min(1).values,
+            torch.where(rows, ys, -1).max(1).values,
+            torch.where(cols, xs, w).min(1).values,
+            torch.where(cols, xs, -1).max(1).values,
+        ], 1).tolist() # single device to host copy
+
+        boxes = []
+        pad = self.roi['pad']
+        for found, top, bottom, left, right in bounds:
+            if not found:
+                boxes.append(None)
+                continue
+            bh = self.bucket(bottom - top + 1 + 2 * pad, h)
+            bw = self.bucket(right - left + 1 + 2 * pad, w)
+            y0 = min(max((top + bottom + 1) // 2 - bh // 2, 0), h - bh)
+            x0 = min(max((left + right + 1) // 2 - bw // 2, 0), w - bw)
+            boxes.append((y0, x0, bh, bw))
+        return boxes
+
+    def forward_roi(self, x: List[Tensor]) -> List[Tensor]:
+        # outside the boxes the coarse flow and mask are kept
+        boxes = self.roi_boxes(x[2])
+        flow = x[1].clone()
+        mask = x[2].clone()
+
+        groups = {}
+        for i, box in enumerate(boxes):
+            if box is not None:
+                groups.setdefault(box[2:], []).append(i)
+
+        for (bh, bw), idx in groups.items():
+            crops = [torch.stack([t[i, :, boxes[i][0]:boxes[i][0]+bh, boxes[i][1]:boxes[i][1]+bw] for i in idx]) for t in x]
+            output = self.forward_full(crops)
+            for j, i in enumerate(idx):
+                y0, x0 = boxes[i][:2]
+                flow[i, :, y0:y0+bh, x0:x0+bw] = output[0][j]
+                mask[i, :, y0:y0+bh, x0:x0+bw] = output[1][j]
+
+        return [flow, mask, x[3].clone()]
+
+    def forward(self, x: List[Tensor]) -> List[Tensor]:
+        if getattr(self, 'roi', None) is not None:
+            return self.forward_roi(x)
+        return self.forward_full(x)
+
+    def forward_full(self, x: List[Tensor]) -> List[Tensor]:
         # x = [img:3, flow:2, mask:2, rho:1]
         rho = x[3].clone()
         normalized_x = self.normalize(x)
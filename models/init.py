@@ -4,6 +4,34 @@ from models import CoarseNet, RefineNet
 from torch import nn
 
 def setup(opt, checkpoint):
+    model = create_model(opt, checkpoint)
+
+    roi_pad = getattr(opt, 'roi_pad', -1)
+    if isinstance(getattr(model, 'module', model), RefineNet.RefineNet):
+        # also with roi_pad < 0, a model loaded from a checkpoint keeps the ROI mode it was saved with
+        if roi_pad >= 0:
+            print(f'\n\n --> [ROI] Refining boxes around the coarse mask, padding: {roi_pad}')
+        getattr(model, 'module', model).set_roi(roi_pad, [int(b) for b in opt.roi_buckets.split(',')])
+
+    if getattr(opt, 'act_ckpt', False) and isinstance(getattr(model, 'module', model), CoarseNet.CoarseNet):
+        print('\n\n --> [Activation Checkpointing] Recomputing the RIRB towers in backward')
+        getattr(model, 'module', model).set_act_ckpt(True)
+
+    mode = getattr(opt, 'branch_parallel', 'none')
+    if mode != 'none':
+        model = getattr(model, 'module', model)
+        if isinstance(model, CoarseNet.CoarseNet):
+            n = torch.cuda.device_count()
+            devices = [torch.device(f'cuda:{i % n}') for i in range(3)] if n > 0 else None
+            if mode == 'devices' and devices is None:
+                print('[Branch Parallel] Mode devices needs a GPU, running the branches one after another')
+                mode = 'none'
+            print(f'\n\n --> [Branch Parallel] Running CoarseNet branches with mode: {mode}')
+            model.set_branch_parallel(mode, devices)
+    return model
+
+
+def create_model(opt, checkpoint):
     if checkpoint:
         model = checkpoint['model'].cuda(0)
         return model
@@ -29,6 +57,6 @@ def setup(opt, checkpoint):
             model = torch.load(opt.pred_dir)['model'].cuda(0)
             return model
 
-    if torch.cuda.device_count() > 1:
+    if torch.cuda.device_count() > 1 and getattr(opt, 'branch_parallel', 'none') == 'none':
           model = nn.DataParallel(model).cuda(0)
     return model
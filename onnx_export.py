@@ -0,0 +1,160 @@
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+from torch import Tensor
+from typing import Dict, List, Tuple, Union
+from option import parse_args
+import utility
+
+OUTPUTS = ['flow', 'mask', 'rho']
+
+
+class CoarseExport(nn.Module):
+    # flattens the per-scale [flow, mask, rho] lists into one output tuple, coarsest scale first
+    def __init__(self, model: nn.Module) -> None:
+        super(CoarseExport, self).__init__()
+        self.model = model
+
+    def forward(self, input: Tensor) -> Tuple[Tensor, ...]:
+        return tuple(t for scale in self.model(input) for t in scale)
+
+
+class RefineExport(nn.Module):
+    # takes the list input of RefineNet as separate tensors
+    def __init__(self, model: nn.Module) -> None:
+        super(RefineExport, self).__init__()
+        self.model = model
+
+    def forward(self, image: Tensor, flow: Tensor, mask: Tensor, rho: Tensor) -> Tuple[Tensor, ...]:
+        return tuple(self.model([image, flow, mask, rho]))
+
+
+def load_model(path: str) -> nn.Module:
+    print(f'\n\n --> Loading model from: {path}')
+    model = torch.load(path, map_location='cpu')['model']
+    model = getattr(model, 'module', model) # unwrap nn.DataParallel
+    # branch parallelism and ROI mode are runtime control flow, the graph is the plain model
+    if hasattr(model, 'set_branch_parallel'):
+        model.set_branch_parallel('none')
+    if hasattr(model, 'set_roi'):
+        model.set_roi(-1)
+    return model.float().eval()
+
+
+def example_inputs(refine: bool, n: int) -> List[Tensor]:
+    if refine:
+        return [torch.rand(n, 3, 512, 512), torch.randn(n, 2, 512, 512) * 10, torch.randn(n, 2, 512, 512), \
+                torch.rand(n, 1, 512, 512)]
+    return [torch.rand(n, 3, 256, 256)]
+
+
+def io_names(model: nn.Module, refine: bool) -> Tuple[List[str], List[str]]:
+    if refine:
+        return ['image', 'flow_in', 'mask_in', 'rho_in'], list(OUTPUTS)
+    # scale s output is 2^(s-1) times smaller than the 512 output, the finest one has no suffix
+    scales = list(range(model.opt.ms_num, 1, -1))
+    return ['input'], [f'{k}_s{s}' for s in scales for k in OUTPUTS] + list(OUTPUTS)
+
+
+def export(model: nn.Module, path: str, opset: int) -> None:
+    refine = not hasattr(model, 'create_output1')
+    input_names, output_names = io_names(model, refine)
+    # export restores the train/eval mode of the wrapper, which would put the model back in train mode
+    wrapper = (RefineExport(model) if refine else CoarseExport(model)).eval()
+    dynamic_axes = {name: {0: 'batch'} for name in input_names}
+
+    print(f'\n\n --> [ONNX] Exporting {type(model).__name__} to: {path}')
+    with torch.no_grad():
+        torch.onnx.export(wrapper, tuple(example_inputs(refine, 1)), path, input_names=input_names,
+                output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+
+
+class OnnxModel:
+    # ONNX Runtime session called like the exported nn.Module on CPU tensors:
+    # CoarseNet graphs return List[List[Tensor]], RefineNet graphs take and return List[Tensor]
+    def __init__(self, path: str, threads: int = 0) -> None:
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError('The onnx backend requires onnxruntime (pip install onnxruntime)')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.input_shapes = [i.shape for i in self.session.get_inputs()] # only the batch axis is dynamic
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+    def __call__(self, x: Union[Tensor, List[Tensor]]) -> Union[List[Tensor], List[List[Tensor]]]:
+        inputs = x if isinstance(x, (list, tuple)) else [x]
+        for name, shape, t in zip(self.input_names, self.input_shapes, inputs):
+            assert list(t.size()[1:]) == shape[1:], \
+                    f'{name} of size {tuple(t.size()[1:])}, the graph was exported for {tuple(shape[1:])}'
+        feed = {name: t.detach().float().cpu().contiguous().numpy() for name, t in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(o) for o in self.session.run(self.output_names, feed)]
+        scales = [outputs[i:i+3] for i in range(0, len(outputs), 3)]
+        return scales[0] if isinstance(x, (list, tuple)) else scales
+
+
+def check_parity(model: nn.Module, path: str, batches: List[int], threads: int) -> Dict[str, float]:
+    # largest absolute difference per output and mask agreement against eager PyTorch
+    refine = not hasattr(model, 'create_output1')
+    session = OnnxModel(path, threads)
+    diffs = {}
+    for n in batches:
+        x = example_inputs(refine, n)
+        with torch.no_grad():
+            expected = model([t.clone() for t in x]) if refine else model(x[0])
+            start = time.perf_counter()
+            actual = session(x) if refine else session(x[0])
+            elapsed = time.perf_counter() - start
+        if not refine:
+            expected = [t for scale in expected for t in scale]
+            actual = [t for scale in actual for t in scale]
+        for name, e, a in zip(session.output_names, expected, actual):
+            assert e.size() == a.size(), f'{name}: {tuple(a.size())} != {tuple(e.size())}'
+            diffs[name] = max(diffs.get(name, 0.0), (e - a).abs().max().item())
+        agree = utility.get_mask(expected[-2]).eq(utility.get_mask(actual[-2])).float().mean().item()
+        diffs['mask_agree'] = min(diffs.get('mask_agree', 1.0), agree)
+        print(f'[ONNX] batch {n}: {1000 * elapsed:.1f} ms, mask agreement {agree:.6f}')
+    return diffs
+
+
+def report(diffs: Dict[str, float], tol: float, min_agree: float) -> Tuple[str, bool]:
+    s = f'{"output":<14}{"max abs diff":>14}\n'
+    ok = True
+    for k, v in diffs.items():
+        if k == 'mask_agree':
+            continue
+        s += f'{k:<14}{v:>14.2e}{"" if v <= tol else "  > tol":>8}\n'
+        ok = ok and v <= tol
+    agree = diffs['mask_agree']
+    s += f'mask agreement: {agree:.6f}' + ('' if agree >= min_agree else f'  < {min_agree}')
+    return s, ok and agree >= min_agree
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    args = parse_args()
+    batches = [int(n) for n in args.onnx_batches.split(',')]
+    jobs = [(args.pred_dir, args.onnx_coarse)]
+    if args.refine:
+        jobs.append((args.refine_dir, args.onnx_refine))
+
+    failed = False
+    for checkpoint, path in jobs:
+        model = load_model(checkpoint)
+        export(model, path, args.onnx_opset)
+        diffs = check_parity(model, path, batches, args.onnx_threads)
+        s, ok = report(diffs, args.onnx_tol, args.onnx_mask_agree)
+        print(f'\n\n --> [ONNX] Parity of {path} with {checkpoint}: \n{s}')
+        failed = failed or not ok
+        del model
+
+    assert not failed, f'ONNX outputs differ from PyTorch by more than {args.onnx_tol} ' \
+            f'or agree on less than {args.onnx_mask_agree} of the mask'
+    print(f'\n\n --> [ONNX] Done')
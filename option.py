@@ -1,7 +1,7 @@
 import os
 import argparse
 import numpy as np
-from typing import Tuple
+from typing import Tuple, List, Optional, Any
 import torch
 import datetime
 
@@ -28,7 +28,7 @@ parser = argparse.ArgumentParser(description='ETOM-Net')
 
 # dataset options
 parser.add_argument('--dataset', type=str, default='TOMDataset',
-                    help='dataset name')
+                    help='dataset name, synth streams generated samples (see synth.py)')
 parser.add_argument('--data_dir', type=str, default='../TOM-Net_Synth_Train_178k',
                     help='training dataset path')
 parser.add_argument('--train_list', type=str, default='train_60k.txt',
@@ -37,10 +37,30 @@ parser.add_argument('--val_list', type=str, default='val_400.txt',
                     help='val list')
 parser.add_argument('--data_aug', type=bool, default=True,
                     help='data augmentation')
+parser.add_argument('--batch_aug', action='store_true',
+                    help='augment whole batches on the training device')
+parser.add_argument('--aug_seed', type=int, default=0,
+                    help='seed of the batch augmentation rng')
 parser.add_argument('--noise', type=float, default=0.05,
                     help='noise level')
 parser.add_argument('--rot_ang', type=float, default=0.3,
                     help='angle for rotating data')
+parser.add_argument('--cache_mb', type=float, default=0,
+                    help='>0 for shared decoded sample cache size (MB) per split')
+parser.add_argument('--compact', action='store_true',
+                    help='send uint8 images and int16 flows from the workers, convert them on the device')
+parser.add_argument('--synth_num', type=str, default='1000,100',
+                    help='train,val sample counts of synth.py and --dataset synth')
+parser.add_argument('--synth_size', type=int, default=512,
+                    help='size of the synthetic reference and target images')
+parser.add_argument('--synth_seed', type=int, default=0,
+                    help='seed of the synthetic samples')
+parser.add_argument('--synth_workers', type=int, default=4,
+                    help='processes writing synthetic samples')
+parser.add_argument('--synth_dir', type=str, default='',
+                    help='output directory of synth.py (default: a new data/synth_<date>_<time>)')
+parser.add_argument('--force', action='store_true',
+                    help='let synth.py overwrite the image lists of an existing --synth_dir')
 parser.add_argument('--max_train_num', type=int, default=-1,
                     help='>0 for max number')
 parser.add_argument('--max_val_num', type=int, default=-1,
@@ -53,6 +73,10 @@ parser.add_argument('--n_epochs', type=int, default=30,
                     help='number of total epochs to run')
 parser.add_argument('--ga', type=int, default=1,
                     help='gradient accumulations')
+parser.add_argument('--amp', action='store_true',
+                    help='mixed precision forward and loss with a gradient scaler')
+parser.add_argument('--detect_anomaly', action='store_true',
+                    help='enable autograd anomaly detection (slow)')
 parser.add_argument('--batch_size', type=int, default=8,
                     help='mini-batch size')
 parser.add_argument('--lr', type=float, default=0.0005,
@@ -73,16 +97,26 @@ parser.add_argument('--beta_2', type=float, default=0.999,
 # network options
 parser.add_argument('--ms_num', type=int, default=4,
                     help='multiscale level')
+parser.add_argument('--branch_parallel', type=str, default='none',
+                    help='run the three CoarseNet branches in parallel (none | streams | threads | devices)')
+parser.add_argument('--act_ckpt', action='store_true',
+                    help='activation checkpointing of the CoarseNet RIRB towers, less memory for more compute')
 parser.add_argument('--refine', action='store_true',
                     help='train refine net')
 parser.add_argument('--pred_dir', type=str, default='coarse.pt',
                     help='predictor path')
 parser.add_argument('--refine_dir', type=str, default='refine.pt',
                     help='predictor path')
+parser.add_argument('--roi_pad', type=int, default=-1,
+                    help='>=0 to refine only a box around the coarse mask padded by this many pixels')
+parser.add_argument('--roi_buckets', type=str, default='64,128,192,256,320,384,448,512',
+                    help='comma separated ROI box sizes, multiples of 8')
 parser.add_argument('--val_only', action='store_true',
                     help='run on validation set only')
 parser.add_argument('--save_images', action='store_true',
                     help='save test results')
+parser.add_argument('--results_store', type=str, default='',
+                    help='save test results into this single indexed file instead of results/<id>/ directories')
 
 # checkpoint options
 parser.add_argument('--resume', type=str, default=None,
@@ -93,6 +127,8 @@ parser.add_argument('--save_interval', type=int, default=1,
                     help='epochs to save checkpoint(overwrite)')
 parser.add_argument('--save_new', type=int, default=1,
                     help='epochs to save new checkpoint')
+parser.add_argument('--snapshot_iters', type=int, default=0,
+                    help='>0 for iterations between mid-epoch snapshots that --resume continues from')
 
 # loss options
 parser.add_argument('--flow_w', type=float, default=0.1,
@@ -108,6 +144,48 @@ parser.add_argument('--r_flow_w', type=float, default=1,
 parser.add_argument('--r_mask_w', type=float, default=10,
                     help='mask weight')
 
+# quantization options
+parser.add_argument('--calib_num', type=int, default=64,
+                    help='number of val samples used for int8 calibration')
+parser.add_argument('--quant_backend', type=str, default='fbgemm',
+                    help='quantized engine (fbgemm | x86 | qnnpack)')
+parser.add_argument('--quant_dir', type=str, default='coarse_int8.pt',
+                    help='quantized predictor path')
+
+# onnx options
+parser.add_argument('--onnx_coarse', type=str, default='coarse.onnx',
+                    help='ONNX graph exported from --pred_dir')
+parser.add_argument('--onnx_refine', type=str, default='refine.onnx',
+                    help='ONNX graph exported from --refine_dir with --refine')
+parser.add_argument('--onnx_opset', type=int, default=17,
+                    help='ONNX opset version')
+parser.add_argument('--onnx_batches', type=str, default='1,2',
+                    help='comma separated batch sizes of the parity check')
+parser.add_argument('--onnx_tol', type=float, default=1e-3,
+                    help='largest absolute difference to PyTorch the parity check accepts')
+parser.add_argument('--onnx_mask_agree', type=float, default=0.9999,
+                    help='smallest fraction of mask pixels agreeing with PyTorch the parity check accepts')
+parser.add_argument('--onnx_threads', type=int, default=0,
+                    help='ONNX Runtime intra-op threads (0: its default)')
+
+# memory planner options
+parser.add_argument('--auto_batch', action='store_true',
+                    help='set batch_size (and ga for --target_batch) with the memory planner before training')
+parser.add_argument('--mem_budget', type=float, default=0,
+                    help='>0 for the memory budget (MB) per device, 90%% of the device memory otherwise')
+parser.add_argument('--target_batch', type=int, default=0,
+                    help='>0 for the effective batch size the planner suggests --ga for')
+parser.add_argument('--plan_limit', type=int, default=256,
+                    help='largest batch size the planner considers')
+
+# sweep options
+parser.add_argument('--sweep_dir', type=str, default=None,
+                    help='directory of the checkpoints scored by sweep.py (defaults to --resume)')
+parser.add_argument('--sweep_pattern', type=str, default='checkpoint*.pt',
+                    help='glob pattern of the swept checkpoints')
+parser.add_argument('--sweep_metric', type=str, default='flow_err',
+                    help='metric the checkpoints are ranked by')
+
 # display options
 parser.add_argument('--train_display', type=int, default=20,
                     help='iteration to display train loss')
@@ -120,17 +198,35 @@ parser.add_argument('--val_display', type=int, default=1,
 parser.add_argument('--val_save', type=int, default=1,
                     help='iteration to save val results')
 
-args = parser.parse_args()
+# profiling options
+parser.add_argument('--profile', action='store_true',
+                    help='time training stages and log them to profile.jsonl')
+parser.add_argument('--profile_trace', type=str, default='',
+                    help='start:stop profiled iterations to capture a torch.profiler trace')
+
+def finalize(args: argparse.Namespace) -> argparse.Namespace:
+    # fields derived from the parsed options
+    args.batch_size *= max(torch.cuda.device_count(), 1)
+    if args.refine:
+        args.batch_size = int(args.batch_size / 2)
+    args.log_dir, args.save = get_save_dir_name(args)
+    return args
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    # argv defaults to sys.argv[1:]
+    return finalize(parser.parse_args(argv))
 
-args.batch_size *= torch.cuda.device_count()
-if args.refine:
-    args.batch_size = int(args.batch_size / 2)
-print("\n\n --> Let's use", torch.cuda.device_count(), "GPUs!")
 
-args.log_dir, args.save = get_save_dir_name(args)
+def get_config(**kwargs: Any) -> argparse.Namespace:
+    # default options with overrides, independent of the command line
+    args = parser.parse_args([])
+    for k, v in kwargs.items():
+        assert hasattr(args, k), f'Unknown option: {k}'
+        setattr(args, k, v)
+    return finalize(args)
 
-if not os.path.isdir(args.log_dir):
-    os.makedirs(args.log_dir)
 
-if not os.path.isdir(args.save):
-    os.makedirs(args.save)
+def prepare_dirs(args: argparse.Namespace) -> None:
+    os.makedirs(args.log_dir, exist_ok=True)
+    os.makedirs(args.save, exist_ok=True)
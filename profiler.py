@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import resource
+import torch
+from argparse import Namespace
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Any, Optional, Tuple
+
+
+class StageProfiler:
+    # Per-stage wall clock timers for the training loop. Stages are synchronized with
+    # the GPU so that asynchronous kernels are charged to the stage launching them.
+    # Every flush() appends one JSON record to <log_dir>/profile.jsonl.
+    def __init__(self, opt: Namespace) -> None:
+        self.enabled = opt.profile
+        self.sync = torch.cuda.is_available()
+        self.file = os.path.join(opt.log_dir, 'profile.jsonl')
+        self.trace_dir = os.path.join(opt.log_dir, 'traces')
+        self.trace_range = self.parse_range(opt.profile_trace)
+        self.trace = None
+        self.step_count = 0
+        self.reset()
+
+    @staticmethod
+    def parse_range(s: str) -> Optional[Tuple[int, int]]:
+        if not s:
+            return None
+        start, stop = s.split(':')
+        return int(start), int(stop)
+
+    def reset(self) -> None:
+        self.times = OrderedDict()
+        self.iters = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+
+    def synchronize(self) -> None:
+        if self.sync:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+    def iterate(self, dataloader: Iterable) -> Iterator[Any]:
+        # charges the time spent waiting for the next batch to the 'data' stage
+        it = iter(dataloader)
+        while True:
+            with self.stage('data'):
+                try:
+                    sample = next(it)
+                except StopIteration:
+                    return
+            yield sample
+
+    def step(self, batch_size: int) -> None:
+        if not self.enabled:
+            return
+        self.iters += 1
+        self.samples += batch_size
+        self.step_count += 1
+
+        if self.trace_range is None:
+            return
+        if self.step_count == self.trace_range[0]:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+        elif self.step_count == self.trace_range[1] and self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            name = f'trace_iter{self.trace_range[0]}-{self.trace_range[1]}.json'
+            self.trace.export_chrome_trace(os.path.join(self.trace_dir, name))
+            self.trace = None
+
+    def memory(self) -> dict:
+        mem = {'cpu_max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        if torch.cuda.is_available():
+            mem['gpu_max_allocated_mb'] = torch.cuda.max_memory_allocated() / 2**20
+            mem['gpu_max_reserved_mb'] = torch.cuda.max_memory_reserved() / 2**20
+        return mem
+
+    def flush(self, split: str, epoch: int, iter: int) -> Optional[dict]:
+        if not self.enabled or self.iters == 0:
+            return None
+        elapsed = time.perf_counter() - self.start
+        record = OrderedDict()
+        record['split'] = split
+        record['epoch'] = epoch
+        record['iter'] = iter
+        record['time'] = time.time()
+        record['stages_ms'] = {k: 1000 * v / self.iters for k, v in self.times.items()}
+        record['iter_ms'] = 1000 * elapsed / self.iters
+        record['samples_per_sec'] = self.samples / elapsed
+        record.update(self.memory())
+
+        with open(self.file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.reset()
+        return record
@@ -0,0 +1,125 @@
+import copy
+import time
+import torch
+import torch.nn.functional as F
+import numpy as np
+from argparse import Namespace
+from typing import Dict, Tuple
+from torch.utils.data import DataLoader, Subset
+from torch.ao.quantization import get_default_qconfig, QConfigMapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from dataloader import ETOMDataset, collate, to_float_batch
+from models import CoarseNet
+from option import parse_args
+import utility
+import metrics
+
+
+def load_float_model(opt: Namespace) -> CoarseNet.CoarseNet:
+    print(f'\n\n --> Loading model from: {opt.pred_dir}')
+    model = torch.load(opt.pred_dir, map_location='cpu')['model']
+    model = getattr(model, 'module', model) # unwrap nn.DataParallel
+    return model.float().eval()
+
+
+def create_calib_loaders(opt: Namespace) -> Tuple[DataLoader, DataLoader]:
+    dataset = ETOMDataset(opt, 'val')
+    calib_num = min(opt.calib_num, len(dataset))
+    calib_idx = list(range(calib_num))
+    # evaluate on the samples not seen during calibration whenever there are any
+    eval_idx = list(range(calib_num, len(dataset))) or calib_idx
+
+    calib_loader = DataLoader(Subset(dataset, calib_idx), batch_size=opt.batch_size,
+                        shuffle=False, num_workers=4, collate_fn=collate)
+    eval_loader = DataLoader(Subset(dataset, eval_idx), batch_size=opt.batch_size,
+                        shuffle=False, num_workers=4, collate_fn=collate)
+    return calib_loader, eval_loader
+
+
+def get_qconfig_mapping(model: CoarseNet.CoarseNet, backend: str) -> QConfigMapping:
+    qconfig_mapping = QConfigMapping().set_global(get_default_qconfig(backend))
+    # the bicubic input resize has no int8 kernel
+    qconfig_mapping.set_object_type(F.interpolate, None)
+    # flow regression (tanh * ratio) and the softmax of the output heads stay in float
+    for name, _ in model.named_children():
+        if name.startswith('create_output') or name.startswith('normalize_output'):
+            qconfig_mapping.set_module_name(name, None)
+    return qconfig_mapping
+
+
+def prepare(model: CoarseNet.CoarseNet, opt: Namespace) -> torch.nn.Module:
+    torch.backends.quantized.engine = opt.quant_backend
+    qconfig_mapping = get_qconfig_mapping(model, opt.quant_backend)
+    example = torch.rand(1, 3, 256, 256)
+    return prepare_fx(copy.deepcopy(model), qconfig_mapping, (example,))
+
+
+def quantize(model: CoarseNet.CoarseNet, calib_loader: DataLoader, opt: Namespace) -> torch.nn.Module:
+    print(f'\n\n --> [Quantization] Calibrating on {len(calib_loader.dataset)} samples')
+    prepared = prepare(model, opt)
+    with torch.no_grad():
+        for sample in calib_loader:
+            prepared(to_float_batch(sample)['input'])
+
+    return convert_fx(prepared)
+
+
+def load_quantized_model(opt: Namespace) -> torch.nn.Module:
+    # fx graph modules do not pickle reliably, so rebuild the graph and load the int8 weights
+    print(f'\n\n --> Loading quantized model from: {opt.quant_dir}')
+    q_model = convert_fx(prepare(load_float_model(opt), opt))
+    q_model.load_state_dict(torch.load(opt.quant_dir, map_location='cpu')['state_dict'])
+    return q_model.eval()
+
+
+def evaluate(model: torch.nn.Module, loader: DataLoader) -> Dict[str, float]:
+    meter = metrics.MetricMeter()
+    size = 0
+    forward_time = 0
+
+    with torch.no_grad():
+        for sample in loader:
+            sample = to_float_batch(sample)
+            ref_images = sample['images'][:, :3, :, :]
+            tar_images = sample['images'][:, 3:, :, :]
+
+            start = time.perf_counter()
+            output = model(sample['input'])[-1]
+            forward_time += time.perf_counter() - start
+
+            pred_images = utility.create_single_warping([ref_images, output[0]])
+            mask = utility.get_mask(output[1])
+            final_pred = utility.get_final_pred(ref_images, pred_images, mask, output[2])
+            meter.update(metrics.evaluate_batch(final_pred, tar_images, output[2], sample['rhos'].unsqueeze(1), \
+                    output[0], sample['flows'], mask, sample['masks'].unsqueeze(1)))
+            size += ref_images.size(0)
+
+    results = meter.average()
+    results['ms_per_sample'] = 1000 * forward_time / size
+    return results
+
+
+def report(fp32: Dict[str, float], int8: Dict[str, float]) -> str:
+    s = f'{"metric":<14}{"fp32":>14}{"int8":>14}{"delta":>14}\n'
+    for k in fp32.keys():
+        s += f'{k:<14}{fp32[k]:>14.6f}{int8[k]:>14.6f}{int8[k] - fp32[k]:>+14.6f}\n'
+    s += f'[Speedup: {fp32["ms_per_sample"] / int8["ms_per_sample"]:.2f}x]'
+    return s
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    args = parse_args()
+    calib_loader, eval_loader = create_calib_loaders(args)
+    model = load_float_model(args)
+    q_model = quantize(model, calib_loader, args)
+
+    print(f'\n\n --> [Quantization] Evaluating on {len(eval_loader.dataset)} samples')
+    fp32 = evaluate(model, eval_loader)
+    int8 = evaluate(q_model, eval_loader)
+    print(f'\n\n --> Accuracy / latency summary: \n{report(fp32, int8)}')
+
+    torch.save({'opt': args, 'state_dict': q_model.state_dict()}, args.quant_dir)
+    print(f'\n\n --> Saved quantized model to: {args.quant_dir}')
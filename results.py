@@ -0,0 +1,157 @@
+import os
+import json
+import zlib
+import struct
+import threading
+import numpy as np
+import torch
+from torch import Tensor
+from typing import Dict, List, Optional, Iterator
+
+
+class ResultsStore:
+    # Append-only single-file container of per-sample results with random access by id.
+    #
+    # file:   MAGIC, record*, [index]
+    # record: b'R', <QI> payload and meta length, meta json, payload
+    # index:  b'I', json {id: record offset}, <Q> index offset, INDEX_MAGIC
+    #
+    # meta holds the dtype, shape and (offset, length) of every zlib compressed field in
+    # the payload, so single fields are read without the rest of the record. The index
+    # is written on close; a file without one (e.g. after a crash) is indexed by scanning
+    # the record headers. Appending an existing id replaces it in the index.
+    MAGIC = b'ETOMRES1'
+    INDEX_MAGIC = b'ETOMRIX1'
+    RECORD = struct.Struct('<QI')
+    FOOTER = struct.Struct('<Q')
+
+    def __init__(self, path: str, mode: str = 'r', level: int = 1) -> None:
+        assert mode in ['r', 'a'], f'Unknown mode: {mode}'
+        self.path = path
+        self.mode = mode
+        self.level = level
+        self.lock = threading.Lock()
+        self.meta = {} # id -> meta of the record, read lazily
+
+        if mode == 'a' and not os.path.isfile(path):
+            with open(path, 'wb') as f:
+                f.write(self.MAGIC)
+        self.f = open(path, 'r+b' if mode == 'a' else 'rb')
+        self.fd = self.f.fileno()
+        assert os.pread(self.fd, len(self.MAGIC), 0) == self.MAGIC, f'Not a results store: {path}'
+
+        self.index, self.end = self.read_index()
+        if mode == 'a':
+            # drop the index, it is rewritten on close
+            self.f.truncate(self.end)
+            self.f.seek(self.end)
+
+    def read_index(self) -> tuple:
+        size = os.fstat(self.fd).st_size
+        tail = len(self.INDEX_MAGIC) + self.FOOTER.size
+        if size >= len(self.MAGIC) + tail and os.pread(self.fd, len(self.INDEX_MAGIC), size - len(self.INDEX_MAGIC)) == self.INDEX_MAGIC:
+            start = self.FOOTER.unpack(os.pread(self.fd, self.FOOTER.size, size - tail))[0]
+            index = json.loads(os.pread(self.fd, size - tail - start - 1, start + 1))
+            return index, start
+        return self.scan(size)
+
+    def scan(self, size: int) -> tuple:
+        index = {}
+        offset = len(self.MAGIC)
+        while offset + 1 + self.RECORD.size <= size and os.pread(self.fd, 1, offset) == b'R':
+            payload_len, meta_len = self.RECORD.unpack(os.pread(self.fd, self.RECORD.size, offset + 1))
+            end = offset + 1 + self.RECORD.size + meta_len + payload_len
+            if end > size:
+                break # truncated record
+            meta = json.loads(os.pread(self.fd, meta_len, offset + 1 + self.RECORD.size))
+            index[meta['id']] = offset
+            offset = end
+        return index, offset
+
+    def append(self, id: str, fields: Dict[str, Tensor]) -> None:
+        assert self.mode == 'a', 'Store is opened read-only'
+        id = str(id)
+        blobs = []
+        meta = {'id': id, 'fields': {}}
+        offset = 0
+        for k, v in fields.items():
+            array = v.detach().cpu().contiguous().numpy()
+            blob = zlib.compress(array.tobytes(), self.level)
+            meta['fields'][k] = [array.dtype.str, list(array.shape), offset, len(blob)]
+            blobs.append(blob)
+            offset += len(blob)
+        meta_bytes = json.dumps(meta).encode()
+
+        with self.lock:
+            self.f.write(b'R' + self.RECORD.pack(offset, len(meta_bytes)) + meta_bytes)
+            for blob in blobs:
+                self.f.write(blob)
+            self.index[id] = self.end
+            self.meta[id] = dict(meta, payload=self.end + 1 + self.RECORD.size + len(meta_bytes))
+            self.end += 1 + self.RECORD.size + len(meta_bytes) + offset
+
+    def read_meta(self, id: str) -> dict:
+        meta = self.meta.get(id)
+        if meta is None:
+            offset = self.index[id]
+            _, meta_len = self.RECORD.unpack(os.pread(self.fd, self.RECORD.size, offset + 1))
+            meta = json.loads(os.pread(self.fd, meta_len, offset + 1 + self.RECORD.size))
+            meta['payload'] = offset + 1 + self.RECORD.size + meta_len
+            self.meta[id] = meta
+        return meta
+
+    def get(self, id: str, keys: Optional[List[str]] = None) -> Dict[str, Tensor]:
+        # raw stored tensors, see to_float; pread keeps concurrent readers independent
+        id = str(id)
+        if self.mode == 'a':
+            self.f.flush()
+        meta = self.read_meta(id)
+        out = {}
+        for k in keys or meta['fields'].keys():
+            dtype, shape, offset, length = meta['fields'][k]
+            data = zlib.decompress(os.pread(self.fd, length, meta['payload'] + offset))
+            out[k] = torch.from_numpy(np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape).copy())
+        return out
+
+    def __getitem__(self, id: str) -> Dict[str, Tensor]:
+        return self.get(id)
+
+    def __contains__(self, id: str) -> bool:
+        return str(id) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def ids(self) -> List[str]:
+        # in the order of the records in the file
+        return sorted(self.index.keys(), key=lambda k: self.index[k])
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.ids())
+
+    def close(self) -> None:
+        if self.f.closed:
+            return
+        if self.mode == 'a':
+            with self.lock:
+                self.f.seek(self.end)
+                self.f.write(b'I' + json.dumps(self.index).encode())
+                self.f.write(self.FOOTER.pack(self.end) + self.INDEX_MAGIC)
+                self.f.truncate()
+        self.f.close()
+
+    def __enter__(self) -> "ResultsStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def quantize(img: Tensor) -> Tensor:
+    # the rounding of torchvision's save_image, so stored and png results are identical
+    return img.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+def to_float(sample: Dict[str, Tensor]) -> Dict[str, Tensor]:
+    # uint8 images in [0, 1], int16 flows in pixels
+    return {k: v.float().div_(255) if v.dtype == torch.uint8 else v.float() for k, v in sample.items()}
@@ -0,0 +1,268 @@
+import io
+import os
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from PIL import Image
+from typing import Callable, List, Dict, Optional, Tuple, Union
+import utility
+
+
+class Predictor:
+    # CoarseNet and optionally RefineNet, loaded once from the checkpoints written by main.py,
+    # or with backend 'onnx' from the graphs written by onnx_export.py and run by ONNX Runtime
+    def __init__(self, coarse_dir: str, refine_dir: Optional[str], device: torch.device, roi_pad: int = -1,
+            backend: str = 'torch', threads: int = 0) -> None:
+        assert backend in ['torch', 'onnx'], f'Unknown backend: {backend}'
+        assert backend == 'torch' or device.type == 'cpu', 'The onnx backend runs on CPU'
+        self.device = device
+        self.backend = backend
+        self.threads = threads
+        print(f'\n\n --> Loading model from: {coarse_dir}')
+        self.coarse = self.load(coarse_dir)
+        self.refine = None
+        if refine_dir:
+            print(f'\n\n --> Loading model from: {refine_dir}')
+            self.refine = self.load(refine_dir)
+            if backend == 'torch':
+                self.refine.set_roi(roi_pad)
+            elif roi_pad >= 0:
+                print('[Predictor] ROI mode is data dependent and not part of the ONNX graph, refining full images')
+
+    def load(self, path: str) -> Union[nn.Module, Callable]:
+        if self.backend == 'onnx':
+            from onnx_export import OnnxModel
+            return OnnxModel(path, self.threads)
+        model = torch.load(path, map_location=self.device)['model']
+        if isinstance(model, nn.DataParallel):
+            model = model.module
+        return model.to(self.device).eval()
+
+    def __call__(self, images: Tensor) -> Dict[str, Tensor]:
+        # images: [n, 3, h, w] in [0, 1]
+        with torch.no_grad():
+            images = images.to(self.device, non_blocking=True)
+            output = self.coarse(images)[-1]
+            if self.refine is not None:
+                size = output[0].size()[2:]
+                output = self.refine([F.interpolate(images, size, mode='bicubic', align_corners=True)] + output)
+            return {
+                'flow': output[0].float().cpu(),
+                'mask': utility.get_mask(output[1]).squeeze(1).to(torch.uint8).cpu(),
+                'rho': output[2].float().squeeze(1).cpu(),
+            }
+
+
+class MicroBatcher:
+    # Collects concurrent requests into one forward pass. A batch is run as soon as it
+    # holds max_batch images or its oldest request has waited max_latency seconds.
+    def __init__(self, predictor: Predictor, max_batch: int, max_latency: float) -> None:
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.stats = {'requests': 0, 'batches': 0, 'errors': 0, 'busy_sec': 0.0}
+        self.stats_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: Tensor) -> Future:
+        future = Future()
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def collect(self) -> Optional[List[Tuple[Tensor, Future, float]]]:
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = item[2] + self.max_latency
+        while len(batch) < self.max_batch:
+            # past the deadline only requests that are already queued join the batch
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None) # stop after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def run(self) -> None:
+        while True:
+            batch = self.collect()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                output = self.predictor(torch.stack([b[0] for b in batch]))
+                for i, b in enumerate(batch):
+                    b[1].set_result({k: v[i] for k, v in output.items()})
+            except Exception as e:
+                for b in batch:
+                    b[1].set_exception(e)
+                with self.stats_lock:
+                    self.stats['errors'] += 1
+            with self.stats_lock:
+                self.stats['requests'] += len(batch)
+                self.stats['batches'] += 1
+                self.stats['busy_sec'] += time.perf_counter() - start
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['mean_batch'] = stats['requests'] / max(stats['batches'], 1)
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+
+def decode_image(data: bytes, size: int) -> Tensor:
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    if image.size != (size, size):
+        image = image.resize((size, size), Image.BICUBIC)
+    image = torch.from_numpy(np.array(image, dtype=np.uint8))
+    return image.permute(2, 0, 1).float().div(255) # size: [3, h, w]
+
+
+def encode_result(result: Dict[str, Tensor]) -> bytes:
+    # flow: float32 [2, h, w] (dy, dx in pixels), mask: uint8 [h, w], rho: float32 [h, w]
+    buf = io.BytesIO()
+    np.savez(buf, **{k: v.numpy() for k, v in result.items()})
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST /predict with an encoded image as body -> npz with flow, mask and rho
+    # GET /health -> json batching statistics
+    protocol_version = 'HTTP/1.1'
+
+    def send(self, code: int, body: bytes, content_type: str) -> None:
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code: int, obj: dict) -> None:
+        self.send(code, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self) -> None:
+        if self.path != '/health':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        self.send_json(200, self.server.batcher.get_stats())
+
+    def do_POST(self) -> None:
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            image = decode_image(data, self.server.input_size)
+        except Exception as e:
+            self.send_json(400, {'error': f'cannot decode image: {e!r}'})
+            return
+        try:
+            result = self.server.batcher.submit(image).result()
+        except Exception as e:
+            self.send_json(500, {'error': repr(e)})
+            return
+        self.send(200, encode_result(result), 'application/octet-stream')
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self) -> str:
+        # AF_UNIX peers have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def stop(signum: int, frame) -> None:
+    raise KeyboardInterrupt
+
+
+def create_server(opt: argparse.Namespace, batcher: MicroBatcher):
+    if opt.socket:
+        if os.path.exists(opt.socket):
+            os.remove(opt.socket)
+        server = UnixHTTPServer(opt.socket, Handler)
+    else:
+        server = ThreadingHTTPServer((opt.host, opt.port), Handler)
+    server.batcher = batcher
+    server.input_size = opt.input_size
+    server.verbose = opt.verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ETOM-Net inference server')
+    parser.add_argument('--pred_dir', type=str, default='coarse.pt',
+                        help='CoarseNet checkpoint')
+    parser.add_argument('--refine_dir', type=str, default=None,
+                        help='RefineNet checkpoint, refine the coarse prediction if given')
+    parser.add_argument('--roi_pad', type=int, default=-1,
+                        help='>=0 to refine only a box around the coarse mask padded by this many pixels')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='HTTP host')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='HTTP port')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--input_size', type=int, default=256,
+                        help='images are resized to this size')
+    parser.add_argument('--max_batch', type=int, default=8,
+                        help='largest micro-batch')
+    parser.add_argument('--max_latency', type=float, default=10,
+                        help='ms a request may wait for its batch to fill')
+    parser.add_argument('--backend', type=str, default='torch',
+                        help='torch | onnx (ONNX Runtime on CPU, --pred_dir and --refine_dir are .onnx files)')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op threads on CPU (0: torch / ONNX Runtime default)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+    predictor = Predictor(opt.pred_dir, opt.refine_dir, torch.device(opt.device), opt.roi_pad, opt.backend, opt.threads)
+    if opt.backend == 'onnx':
+        size = predictor.coarse.input_shapes[0][-1]
+        assert opt.input_size == size, f'{opt.pred_dir} was exported for {size}x{size} inputs, not --input_size {opt.input_size}'
+    batcher = MicroBatcher(predictor, opt.max_batch, opt.max_latency / 1000)
+    server = create_server(opt, batcher)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f'\n\n --> Serving on {opt.socket or f"http://{opt.host}:{opt.port}"}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if opt.socket and os.path.exists(opt.socket):
+            os.remove(opt.socket)
@@ -0,0 +1,168 @@
+import os
+import copy
+import re
+import glob
+import json
+import time
+import queue
+import threading
+import torch
+import torch.nn as nn
+import numpy as np
+from argparse import Namespace
+from typing import Dict, List, Optional, Tuple
+from torch.utils.data import DataLoader
+from dataloader import ETOMDataset, collate, to_float_batch
+from models import RefineNet
+from option import parse_args
+import utility
+import metrics
+
+# metrics where a larger value is better, all others are errors
+HIGHER_BETTER = {'mask_err', 'psnr', 'ssim', 'masked_psnr', 'masked_ssim'}
+
+
+def find_checkpoints(sweep_dir: str, pattern: str) -> List[str]:
+    # checkpoint<epoch>.pt in epoch order, unnumbered names last
+    def key(path: str) -> Tuple[int, str]:
+        num = re.findall(r'\d+', os.path.basename(path))
+        return (int(num[-1]) if num else 1 << 30, path)
+    return sorted(glob.glob(os.path.join(sweep_dir, pattern)), key=key)
+
+
+def load_checkpoints(paths: List[str], depth: int = 1):
+    # Unpickles the next checkpoints on a background thread while the current one is
+    # evaluated. Yields (path, checkpoint or exception).
+    q = queue.Queue(maxsize=depth)
+
+    def run() -> None:
+        for path in paths:
+            try:
+                q.put((path, torch.load(path, map_location='cpu')))
+            except Exception as e:
+                q.put((path, e))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    for _ in paths:
+        yield q.get()
+    thread.join()
+
+
+def cache_val_set(opt: Namespace, device: torch.device) -> List[Dict[str, torch.Tensor]]:
+    # Decodes the val set once. Batches stay on the device in the compact transport
+    # (uint8 images, int16 flows) and are expanded per batch with to_float_batch.
+    # a copy, so that the caller keeps its own transport
+    cache_opt = copy.copy(opt)
+    cache_opt.compact = True
+    dataset = ETOMDataset(cache_opt, 'val')
+    loader = DataLoader(dataset, batch_size=opt.batch_size, shuffle=False,
+                        num_workers=4, collate_fn=collate, pin_memory=device.type == 'cuda')
+    start = time.time()
+    batches = [{k: v.to(device, non_blocking=True) for k, v in sample.items()} for sample in loader]
+    size = sum(b['images'].numel() * b['images'].element_size() + b['flows'].numel() * b['flows'].element_size() \
+            for b in batches)
+    print(f'\n\n --> [Sweep] Cached {len(dataset)} val samples ({size / 2**20:.1f} MB) in {time.time() - start:.1f}s')
+    return batches
+
+
+def coarse_inputs(opt: Namespace, batches: List[dict], device: torch.device) -> List[List[torch.Tensor]]:
+    # RefineNet checkpoints all share the CoarseNet prediction, so it is computed once
+    print(f'\n\n --> Loading model from: {opt.pred_dir}')
+    model = unwrap(torch.load(opt.pred_dir, map_location=device)['model']).to(device).eval()
+    inputs = []
+    with torch.no_grad():
+        for sample in batches:
+            image = to_float_batch(sample)['input']
+            x = model(image)[opt.ms_num-1]
+            x.insert(0, nn.functional.interpolate(image, (512, 512), mode='bicubic', align_corners=True))
+            inputs.append(x)
+    return inputs
+
+
+def unwrap(model: nn.Module) -> nn.Module:
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def evaluate(model: nn.Module, batches: List[dict], refine_inputs: Optional[List[list]]) -> Dict[str, float]:
+    meter = metrics.MetricMeter()
+    size = 0
+    start = time.time()
+
+    with torch.no_grad():
+        for i, sample in enumerate(batches):
+            sample = to_float_batch(sample)
+            ref_images = sample['images'][:, :3, :, :]
+            tar_images = sample['images'][:, 3:, :, :]
+            if refine_inputs is not None:
+                output = model(list(refine_inputs[i]))
+            else:
+                output = model(sample['input'])[-1]
+
+            flow, rho = output[0].float(), output[2].float()
+            pred_images = utility.create_single_warping([ref_images, flow])
+            mask = utility.get_mask(output[1])
+            final_pred = utility.get_final_pred(ref_images, pred_images, mask, rho)
+            meter.update(metrics.evaluate_batch(final_pred, tar_images, rho, sample['rhos'].unsqueeze(1), \
+                    flow, sample['flows'], mask, sample['masks'].unsqueeze(1)))
+            size += ref_images.size(0)
+
+    results = meter.average()
+    results['samples_per_sec'] = size / (time.time() - start)
+    return results
+
+
+def rank(rows: List[dict], metric: str) -> List[dict]:
+    return sorted(rows, key=lambda r: r['metrics'][metric], reverse=metric in HIGHER_BETTER)
+
+
+def build_table(rows: List[dict], metric: str) -> str:
+    keys = [k for k in rows[0]['metrics'].keys() if k != 'samples_per_sec']
+    s = f'{"rank":<6}{"checkpoint":<24}{"epoch":>7}' + ''.join(f'{k:>13}' for k in keys) + '\n'
+    for i, r in enumerate(rows):
+        s += f'{i+1:<6}{os.path.basename(r["checkpoint"]):<24}{r["epoch"]:>7}' + \
+                ''.join(f'{r["metrics"][k]:>13.6f}' for k in keys) + '\n'
+    s += f'[Ranked by: {metric} ({"higher" if metric in HIGHER_BETTER else "lower"} is better)]'
+    return s
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    args = parse_args()
+    sweep_dir = args.sweep_dir or args.resume
+    assert sweep_dir and os.path.isdir(sweep_dir), f'Checkpoint directory not found: {sweep_dir}'
+    paths = find_checkpoints(sweep_dir, args.sweep_pattern)
+    assert paths, f'No {args.sweep_pattern} in {sweep_dir}'
+    print(f'\n\n --> [Sweep] Found {len(paths)} checkpoints in {sweep_dir}')
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batches = cache_val_set(args, device)
+    refine_inputs = coarse_inputs(args, batches, device) if args.refine else None
+
+    rows = []
+    for path, checkpoint in load_checkpoints(paths):
+        if isinstance(checkpoint, Exception):
+            print(f'[Sweep] Skipping {path}: {checkpoint!r}')
+            continue
+        model = unwrap(checkpoint['model'])
+        if isinstance(model, RefineNet.RefineNet) != args.refine:
+            print(f'[Sweep] Skipping {path}: {type(model).__name__} does not match --refine')
+            continue
+        results = evaluate(model.to(device).eval(), batches, refine_inputs)
+        rows.append({'checkpoint': path, 'epoch': checkpoint.get('epoch', -1), 'metrics': results})
+        print(f'[Sweep] {os.path.basename(path)} (epoch {rows[-1]["epoch"]}): {args.sweep_metric}: ' \
+                f'{results[args.sweep_metric]:.6f}, {results["samples_per_sec"]:.2f} samples/s')
+        del model, checkpoint
+
+    assert rows, 'No checkpoint could be evaluated'
+    rows = rank(rows, args.sweep_metric)
+    table = build_table(rows, args.sweep_metric)
+    print(f'\n\n --> [Sweep] Ranked checkpoints: \n{table}')
+
+    with open(os.path.join(sweep_dir, 'sweep.txt'), 'w') as f:
+        f.write(table + '\n')
+    with open(os.path.join(sweep_dir, 'sweep.json'), 'w') as f:
+        json.dump(rows, f, indent=1)
+    print(f'\n\n --> [Sweep] Saved table to: {os.path.join(sweep_dir, "sweep.txt")}')
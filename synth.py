@@ -0,0 +1,170 @@
+import os
+import math
+import datetime
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torch import Tensor
+from argparse import Namespace
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+from dataloader import ETOMDataset
+from option import parse_args
+import utility
+
+# seed offsets, so that train and val never share a sample
+SPLIT_SEED = {'train': 0, 'val': 1 << 20}
+
+
+def background(g: torch.Generator, size: int, k: int = 6) -> Tensor:
+    # smooth colour texture: random oriented sinusoids per channel plus a colour ramp
+    ys, xs = torch.meshgrid(torch.linspace(-1, 1, size), torch.linspace(-1, 1, size), indexing='ij')
+    img = torch.zeros(3, size, size)
+    for c in range(3):
+        theta = torch.rand(k, generator=g) * math.pi
+        freq = torch.rand(k, generator=g) * 20 + 2
+        phase = torch.rand(k, generator=g) * 2 * math.pi
+        proj = xs.unsqueeze(0) * theta.cos().view(-1, 1, 1) + ys.unsqueeze(0) * theta.sin().view(-1, 1, 1)
+        img[c] = torch.sin(proj * freq.view(-1, 1, 1) + phase.view(-1, 1, 1)).mean(0)
+    ramp = torch.rand(3, 2, generator=g) - 0.5
+    img += ramp[:, 0].view(3, 1, 1) * xs + ramp[:, 1].view(3, 1, 1) * ys
+    return (img * 0.5 + 0.5).clamp(0, 1)
+
+
+def object_shape(g: torch.Generator, size: int) -> Tensor:
+    # height field of a rotated super-ellipse lens, 1 at its centre, 0 at and outside its border
+    ys, xs = torch.meshgrid(torch.linspace(-1, 1, size), torch.linspace(-1, 1, size), indexing='ij')
+    cy, cx = (torch.rand(2, generator=g) - 0.5).tolist()
+    a, b = (torch.rand(2, generator=g) * 0.45 + 0.15).tolist()
+    angle = torch.rand(1, generator=g).item() * math.pi
+    p = torch.rand(1, generator=g).item() * 3 + 1.5
+    u = ((xs - cx) * math.cos(angle) + (ys - cy) * math.sin(angle)) / a
+    v = (-(xs - cx) * math.sin(angle) + (ys - cy) * math.cos(angle)) / b
+    r = (u.abs().pow(p) + v.abs().pow(p)).pow(1 / p)
+    return (1 - r.pow(2)).clamp(min=0)
+
+
+def make_sample(idx: int, size: int, seed: int) -> Dict[str, Tensor]:
+    # One self-consistent sample in the raw layout of ETOMDataset.decode: the target is
+    # the reference warped by the stored (integer) flow through create_single_warping,
+    # attenuated by rho inside the mask, as in utility.get_final_pred.
+    g = torch.Generator()
+    g.manual_seed(seed + idx)
+    ref = background(g, size)
+    height = object_shape(g, size)
+    mask = height.gt(0)
+
+    # refraction displaces along the lens slope, up to strength pixels
+    strength = torch.rand(1, generator=g).item() * 35 + 5
+    dy, dx = torch.gradient(height)
+    slope = torch.stack([dy, dx])
+    slope = slope / slope.norm(dim=0).max().clamp(min=1e-8)
+    flow = (slope * strength * mask).round() # size: [2, h, w], channel 0: dy, 1: dx
+
+    absorption = torch.rand(1, generator=g).item() * 0.4
+    rho = torch.where(mask, 1 - absorption * height.sqrt(), torch.ones_like(height))
+
+    warped = utility.create_single_warping([ref.unsqueeze(0), flow.unsqueeze(0)])[0]
+    tar = utility.get_final_pred(ref, warped, mask.unsqueeze(0), rho.unsqueeze(0))
+    input = F.interpolate(tar.unsqueeze(0), (size // 2, size // 2), mode='bicubic',
+            align_corners=True, antialias=True)[0].clamp(0, 1)
+
+    def to_uint8(x: Tensor) -> Tensor:
+        return x.mul(255).round().clamp(0, 255).to(torch.uint8)
+
+    raw = {}
+    raw['input'] = to_uint8(input) # size: [3, h/2, w/2]
+    raw['ref'] = to_uint8(ref) # size: [3, h, w]
+    raw['tar'] = to_uint8(tar) # size: [3, h, w]
+    raw['mask'] = mask.unsqueeze(0).to(torch.uint8) * 255 # size: [1, h, w]
+    raw['rho'] = to_uint8(rho.unsqueeze(0)) # size: [1, h, w]
+    raw['flow'] = flow.short() # size: [2, h, w]
+    return raw
+
+
+def sample_name(idx: int) -> str:
+    return f'{idx:06d}.jpg'
+
+
+def write_sample(args: Tuple[str, int, int, int]) -> str:
+    image_dir, idx, size, seed = args
+    raw = make_sample(idx, size, seed)
+    base = os.path.join(image_dir, os.path.splitext(sample_name(idx))[0])
+
+    def save(t: Tensor, suffix: str) -> None:
+        array = t.permute(1, 2, 0).numpy()
+        Image.fromarray(array[:, :, 0] if array.shape[2] == 1 else array).save(base + suffix, quality=95)
+
+    save(raw['input'], '_1x.jpg')
+    save(raw['ref'], '_ref.jpg')
+    save(raw['tar'], '.jpg')
+    save(raw['mask'], '_mask.png')
+    save(raw['rho'], '_rho.png')
+    utility.save_flow(base + '_flow.flo', raw['flow'])
+    return sample_name(idx)
+
+
+def init_worker() -> None:
+    torch.set_num_threads(1)
+
+
+def write_split(data_dir: str, split: str, list_name: str, n: int, size: int, seed: int = 0, workers: int = 1) -> None:
+    # <data_dir>/<split>/Images/* and the image list <data_dir>/<list_name>
+    image_dir = os.path.join(data_dir, split, 'Images')
+    os.makedirs(image_dir, exist_ok=True)
+    jobs = [(image_dir, i, size, seed + SPLIT_SEED[split]) for i in range(n)]
+    names = []
+    with Pool(workers, initializer=init_worker) as pool:
+        for name in pool.imap(write_sample, jobs, chunksize=8):
+            names.append(name)
+            if len(names) % 100 == 0:
+                print(f'[Synth] {split}: {len(names)}/{n}')
+    with open(os.path.join(data_dir, list_name), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+
+
+class SynthDataset(ETOMDataset):
+    # Streams the samples write_split stores (without the jpeg compression), generated
+    # on the fly in the loader workers and passed through the __getitem__ of the files.
+    def __init__(self, opt: Namespace, split: str) -> None:
+        self.opt = opt
+        self.split = split
+        self.size = opt.synth_size
+        self.seed = opt.synth_seed + SPLIT_SEED[split]
+        n = parse_counts(opt.synth_num)[0 if split == 'train' else 1]
+        max_num = opt.max_train_num if split == 'train' else opt.max_val_num
+        self.image_info = [sample_name(i) for i in range(n if max_num <= 0 else min(n, max_num))]
+
+        print(f'\n\n --> Split: {self.split}')
+        print(f'totaling {len(self.image_info)} synthetic images of size {self.size}')
+        self.cache = self.setup_cache()
+
+    def decode(self, idx: int) -> Dict[str, Tensor]:
+        return make_sample(idx, self.size, self.seed)
+
+
+def parse_counts(s: str) -> List[int]:
+    # 'train,val' sample counts
+    return [int(n) for n in s.split(',')]
+
+
+def output_dir(opt: Namespace) -> str:
+    # never the training --data_dir, its image lists would be overwritten
+    if opt.synth_dir:
+        return opt.synth_dir
+    return os.path.join('data', datetime.datetime.now().strftime('synth_%Y-%m-%d_%H:%M:%S'))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    data_dir = output_dir(args)
+    train_num, val_num = parse_counts(args.synth_num)
+    jobs = [(s, l, n) for s, l, n in [('train', args.train_list, train_num), ('val', args.val_list, val_num)] if n > 0]
+    for _, list_name, _ in jobs:
+        list_file = os.path.join(data_dir, list_name)
+        assert args.force or not os.path.exists(list_file), f'{list_file} exists, pass --force to overwrite it'
+
+    for split, list_name, n in jobs:
+        print(f'\n\n --> [Synth] Writing {n} {split} samples of size {args.synth_size} to {data_dir}')
+        write_split(data_dir, split, list_name, n, args.synth_size, args.synth_seed, args.synth_workers)
+    print(f'\n\n --> [Synth] Done, train with --data_dir {data_dir}')
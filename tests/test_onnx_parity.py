@@ -0,0 +1,52 @@
+import os
+import sys
+import pytest
+import torch
+import torch.nn as nn
+from argparse import Namespace
+
+pytest.importorskip('onnxruntime')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.CoarseNet import CoarseNet
+from models.RefineNet import RefineNet
+import onnx_export
+
+
+def small_coarse_net() -> CoarseNet:
+    # the RIRB towers are cut to their last convolution, which keeps the multi-scale
+    # outputs, the bilinear upsampling and the bicubic input resize at a fraction of the size
+    model = CoarseNet(Namespace(ms_num=4))
+    model.RIRB0 = nn.ModuleList([nn.Sequential(tower[-1]) for tower in model.RIRB0])
+    return model.eval()
+
+
+def check(model: nn.Module, path: str) -> None:
+    diffs = onnx_export.check_parity(model, path, [1, 2], 1)
+    s, ok = onnx_export.report(diffs, 1e-3, 0.9999)
+    assert ok, s
+
+
+def test_coarse_net(tmp_path):
+    torch.manual_seed(0)
+    model = small_coarse_net()
+    path = str(tmp_path / 'coarse.onnx')
+    onnx_export.export(model, path, 17)
+    assert not model.training
+    check(model, path)
+
+
+def test_refine_net(tmp_path):
+    torch.manual_seed(0)
+    model = RefineNet(Namespace()).eval()
+    path = str(tmp_path / 'refine.onnx')
+    onnx_export.export(model, path, 17)
+    check(model, path)
+
+
+def test_input_size(tmp_path):
+    torch.manual_seed(0)
+    path = str(tmp_path / 'coarse.onnx')
+    onnx_export.export(small_coarse_net(), path, 17)
+    with pytest.raises(AssertionError, match='exported for'):
+        onnx_export.OnnxModel(path)(torch.rand(1, 3, 128, 128))
@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+import torch.nn as nn
+from argparse import Namespace
+
+# checkpoints pickle whole models, which torch >= 2.6 only loads with weights_only=False
+os.environ.setdefault('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from checkpoint import CheckPoint
+
+
+def write_snapshot(d: str, epoch: int, iter: int) -> None:
+    snapshot = {'epoch': epoch, 'iter': iter, 'model': nn.Linear(2, 2), 'optim_state': {'epoch': epoch}}
+    CheckPoint.save_snapshot(Namespace(save=d), snapshot)
+
+
+def test_snapshot_only(tmp_path):
+    # preempted during the first epoch: no 'latest' and no epoch checkpoint yet
+    write_snapshot(str(tmp_path), 0, 3)
+    checkpoint, optim_state, snapshot = CheckPoint.resume(Namespace(resume=str(tmp_path)))
+    assert snapshot is not None and checkpoint is snapshot
+    assert (checkpoint['epoch'], snapshot['iter']) == (0, 3)
+    assert optim_state == {'epoch': 0}
+
+
+def test_snapshot_after_checkpoint(tmp_path):
+    opt = Namespace(save=str(tmp_path), resume=str(tmp_path), save_new=1)
+    CheckPoint.save(opt, nn.Linear(2, 2), {'epoch': 2}, 2)
+    write_snapshot(str(tmp_path), 2, 5)
+    checkpoint, _, snapshot = CheckPoint.resume(opt)
+    assert (checkpoint['epoch'], snapshot['iter']) == (2, 5)
+
+    # a snapshot older than the epoch checkpoint is ignored
+    CheckPoint.save(opt, nn.Linear(2, 2), {'epoch': 3}, 3)
+    checkpoint, optim_state, snapshot = CheckPoint.resume(opt)
+    assert snapshot is None and checkpoint['epoch'] == 3 and optim_state == {'epoch': 3}
+
+
+def test_nothing_to_resume(tmp_path):
+    with pytest.raises(AssertionError, match='Nothing to resume'):
+        CheckPoint.resume(Namespace(resume=str(tmp_path)))
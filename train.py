@@ -1,14 +1,22 @@
 import torch
+import random
+import numpy as np
 import utility
+import metrics
 import logging
 import os
+import time
 import torch.nn as nn
 from torch import Tensor
-from typing import Type, Any, Callable, Union, List, Optional
+from typing import Type, Any, Callable, Union, List, Optional, Tuple
 from torch.utils.data import DataLoader
 from models import CoarseNet, RefineNet
 from argparse import Namespace
 from checkpoint import CheckPoint
+from augment import BatchAugmentation
+from profiler import StageProfiler
+from dataloader import to_float_batch
+from results import ResultsStore, quantize
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import StepLR
 from torchvision.utils import save_image
@@ -19,14 +27,19 @@ class Trainer:
     opt: Namespace, optim_state: Optional[dict]) -> None:
         print('\n\n --> Initializing Trainer')
         self.opt = opt
-        self.model = model.cuda()
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model = model.to(self.device)
         self.warping_module = self.setup_warping_module() 
         self.multi_scale_data = self.setup_ms_data_module()
         self.optim_state = self.setup_solver(optim_state) 
         self.setup_criterions()
+        self.augmentation = self.setup_augmentation()
+        self.profiler = StageProfiler(opt)
         self.optimizer = torch.optim.Adam(self.model.parameters(), **(self.optim_state), \
                                 weight_decay=0.01)
         self.scheduler = StepLR(self.optimizer, step_size=5, gamma=0.5)
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=opt.amp)
+        torch.autograd.set_detect_anomaly(opt.detect_anomaly)
         
         print('\n\n --> Total number of parameters in ETOM-Net: ' + str(sum(p.numel() for p in self.model.parameters())))
 
@@ -36,6 +49,8 @@ class Trainer:
         self.rhos = None
         self.masks = None
         self.flows = None
+        self.resume_state = None
+        self.results_store = None
     
     def setup_ms_data_module(self) -> utility.CreateMultiScaleData:
         print('[Multi Scale] Setting up multi scale data module')
@@ -47,20 +62,23 @@ class Trainer:
         warping_module = utility.CreateMultiScaleWarping(self.opt.ms_num)
         return warping_module
 
+    def setup_augmentation(self) -> Optional[BatchAugmentation]:
+        if not self.opt.batch_aug:
+            return None
+        print('[Augmentation] Setting up batch augmentation')
+        return BatchAugmentation(self.opt).to(self.device)
+
     def setup_criterions(self) -> None:
         print('\n\n --> Setting up criterion')
 
         print('[Flow Loss] Setting up EPELoss for flow')
-        self.flow_criterion = utility.EPELoss
-
-        print('[Rec Loss] Setting up MSELoss for reconstructed image')
-        self.rec_criterion = nn.MSELoss
-        
         print('[Mask Loss] Setting up CrossENtropyLoss for mask')
-        self.mask_criterion = nn.CrossEntropyLoss
-
-        print('[Rho Loss] Setting up MSELoss for rho')
-        self.rho_criterion = nn.MSELoss
+        if self.opt.refine:
+            self.criterion = utility.RefineLoss(self.opt).to(self.device)
+        else:
+            print('[Rec Loss] Setting up MSELoss for reconstructed image')
+            print('[Rho Loss] Setting up MSELoss for rho')
+            self.criterion = utility.MultiScaleLoss(self.opt).to(self.device)
 
     def setup_solver(self, in_optim_state: dict) -> dict:
         optim_state = None
@@ -75,132 +93,211 @@ class Trainer:
 
         return optim_state
 
-    def train(self, epoch: int, dataloader: DataLoader, split: str) -> float:
-        gradient_accumulations = self.opt.ga
-
-        num_batches = len(dataloader)
+    def train(self, epoch: int, dataloader: DataLoader, split: str) -> dict:
         print('\n====================')
         print(self.optim_state)
-        print(f'Training epoch # {epoch+1}, totaling mini batches {num_batches}')
+        print(f'Training epoch # {epoch+1}, totaling mini batches {len(dataloader)}')
         print('====================\n')
 
         self.model.train()
-        
-        loss_iter = {} # loss every n iterations
-        loss_epoch = {} # loss of the entire epoch
-        eps = 1e-7
-
-        # Zero gradients
-        self.optimizer.zero_grad()
-
-        if self.opt.refine:
-            loss_iter['mask'] = 0
-            loss_iter['flow'] = 0
+        results = self.run_epoch(epoch, dataloader, split, True)
+        results['lr'] = self.optimizer.param_groups[0]['lr']
 
-            for iter, sample in enumerate(dataloader):
-                input = self.setup_inputs(sample)
-                
-                torch.cuda.empty_cache()
-                torch.autograd.set_detect_anomaly(True)
-
-                output = self.model.forward(input)     
-
-                pred_images = self.single_flow_warping(output) # warp input image with flow
-
-                flow_loss = self.opt.r_flow_w * self.flow_criterion()(output[0], self.flows, \
-                        self.masks.unsqueeze(1), self.rhos.unsqueeze(1)) 
-                mask_loss = self.opt.r_mask_w * self.mask_criterion()(output[1] + eps, self.masks.squeeze(1).long()) 
+        self.scheduler.step()
+        self.optim_state['lr'] = self.optimizer.param_groups[0]['lr']
+        return results
 
-                loss = flow_loss + mask_loss
-                
-                loss_iter['mask'] += mask_loss.item() 
-                loss_iter['flow'] += flow_loss.item()
+    def test(self, epoch: int, dataloader: DataLoader, split: str) -> dict:
+        print(f'\n\n===== Testing after {epoch+1} epochs =====')
 
-                # Perform a backward pass
-                (loss / gradient_accumulations).backward()
+        self.model.eval()
+        try:
+            return self.run_epoch(epoch, dataloader, split, False)
+        finally:
+            # writes the footer index, also when the epoch is interrupted
+            if self.results_store is not None:
+                self.results_store.close()
+                self.results_store = None
+
+    def run_epoch(self, epoch: int, dataloader: DataLoader, split: str, training: bool) -> dict:
+        # The same loop serves both model kinds and phases. Training differs only in
+        # the backward hook, testing in the metric and image saving hooks.
+        num_batches = len(dataloader)
+        start_time = time.time()
+        save_interval = self.opt.train_save if training else self.opt.val_save
+        display_interval = self.opt.train_display if training else self.opt.val_display
 
-                # Update the weights
-                if (iter + 1) % gradient_accumulations == 0:
-                    self.optimizer.step()
-                    self.optimizer.zero_grad()
+        # summed loss components every n iterations, copied to the host only when displayed
+        loss_iter = torch.zeros(len(self.criterion.names), device=self.device)
+        loss_epoch = {} # loss of the entire epoch
+        meter = metrics.MetricMeter()
+        count = 1
+        first_iter = 0 # batches of this epoch done before a resumed snapshot
+        sampler = getattr(dataloader, 'sampler', None)
+        seen = sampler.offset if training and hasattr(sampler, 'offset') else 0
+
+        if training:
+            self.optimizer.zero_grad()
+            if self.resume_state is not None:
+                first_iter = self.resume_state['iter']
+                if self.resume_state['grads'] is not None:
+                    for p, g in zip(self.model.parameters(), self.resume_state['grads']):
+                        p.grad = None if g is None else g.to(p.device)
+                loss_iter += self.resume_state['loss_iter'].to(self.device)
+                loss_epoch = self.resume_state['loss_epoch']
+                self.resume_state = None
+        num_batches += first_iter
+        start_seen = seen
+
+        for iter, sample in enumerate(self.profiler.iterate(dataloader), first_iter):
+            with torch.set_grad_enabled(training):
+                output, pred_images, loss, components = self.step(sample)
+            loss_iter += components
+
+            if training:
+                self.backward(loss, iter)
+            else:
+                with torch.no_grad():
+                    self.update_metrics(meter, output, pred_images)
+                    if self.opt.save_images:
+                        final_output, final_pred_images, *_ = self.final_scale(output, pred_images)
+                        count = self.save_images(final_pred_images, final_output, count)
+
+            if (iter+1) % save_interval == 0:
+                with self.profiler.stage('save'), torch.no_grad():
+                    self.save_visuals(epoch+1, iter+1, output, pred_images, split)
+
+            self.profiler.step(self.input_image.size(0))
+            seen += self.input_image.size(0)
+
+            if (iter+1) % display_interval == 0:
+                loss_epoch[iter] = self.display(epoch+1, iter+1, num_batches, \
+                        self.criterion.to_dict(loss_iter), split)
+                loss_iter.zero_()
+
+            if training and self.opt.snapshot_iters > 0 and (iter+1) % self.opt.snapshot_iters == 0 \
+                    and iter+1 < num_batches:
+                with self.profiler.stage('save'):
+                    CheckPoint.save_snapshot(self.opt, self.snapshot_state(epoch, iter+1, \
+                            sampler.state_dict(seen), loss_iter, loss_epoch))
+
+        results = {'losses': utility.dict_of_dict_average(loss_epoch)}
+        eval_str = ''
+        if not training:
+            results['metrics'] = meter.average()
+            eval_str = ''.join(f'{k}: {v}\n' for k, v in results['metrics'].items())
+        results['samples_per_sec'] = (seen - start_seen) / (time.time() - start_time)
+
+        print(f'\n\n --> Epoch: [{epoch+1}] Loss summary: \n{eval_str}{utility.build_loss_string(results["losses"])}')
+        return results
+
+    def snapshot_state(self, epoch: int, iter: int, sampler_state: dict, loss_iter: Tensor, loss_epoch: dict) -> dict:
+        # everything needed to continue the epoch at batch iter, see load_snapshot
+        params = [p for p in self.model.parameters()]
+        snapshot = {}
+        snapshot['opt'] = self.opt
+        snapshot['epoch'] = epoch
+        snapshot['iter'] = iter
+        snapshot['model'] = self.model
+        snapshot['optim_state'] = self.optim_state
+        snapshot['optimizer'] = self.optimizer.state_dict()
+        snapshot['scheduler'] = self.scheduler.state_dict()
+        snapshot['scaler'] = self.scaler.state_dict()
+        # gradients accumulated since the last optimizer step
+        snapshot['grads'] = None if iter % self.opt.ga == 0 else \
+                [p.grad.detach().cpu() if p.grad is not None else None for p in params]
+        snapshot['sampler'] = sampler_state
+        snapshot['loss_iter'] = loss_iter.cpu()
+        snapshot['loss_epoch'] = loss_epoch
+        snapshot['rng'] = {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'random': random.getstate(),
+            'augment': self.augmentation.generator.get_state() \
+                    if self.augmentation is not None and self.augmentation.generator is not None else None,
+        }
+        return snapshot
+
+    def load_snapshot(self, snapshot: dict, sampler: torch.utils.data.Sampler) -> None:
+        print(f'=> [Resume] Continuing epoch {snapshot["epoch"]+1} at iteration {snapshot["iter"]}')
+        self.optimizer.load_state_dict(snapshot['optimizer'])
+        self.scheduler.load_state_dict(snapshot['scheduler'])
+        self.scaler.load_state_dict(snapshot['scaler'])
+        sampler.load_state_dict(snapshot['sampler'])
+
+        rng = snapshot['rng']
+        torch.set_rng_state(rng['torch'])
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng['cuda'])
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['random'])
+        if rng['augment'] is not None and self.augmentation is not None:
+            self.augmentation.uniform(1, 0, 1, self.device) # creates the generator on the device
+            self.augmentation.generator.set_state(rng['augment'])
+
+        self.resume_state = {'iter': snapshot['iter'], 'grads': snapshot['grads'], \
+                'loss_iter': snapshot['loss_iter'], 'loss_epoch': snapshot['loss_epoch']}
+
+    def step(self, sample: dict) -> Tuple[list, Union[Tensor, List[Tensor]], Tensor, Tensor]:
+        input = self.setup_inputs(sample)
+        torch.cuda.empty_cache()
+
+        with torch.autocast(self.device.type, enabled=self.opt.amp):
+            with self.profiler.stage('forward'):
+                output = self.model.forward(input)
+
+            with self.profiler.stage('warping'):
+                pred_images = self.warp(output) # warp input image with flow
+
+            with self.profiler.stage('loss'):
+                loss, components = self.compute_loss(output, pred_images)
+
+        return output, pred_images, loss, components
+
+    def backward(self, loss: Tensor, iter: int) -> None:
+        with self.profiler.stage('backward'):
+            self.scaler.scale(loss / self.opt.ga).backward()
+
+        # Update the weights every ga iterations
+        if (iter + 1) % self.opt.ga == 0:
+            with self.profiler.stage('optimizer'):
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
+
+    def warp(self, output: list) -> Union[Tensor, List[Tensor]]:
+        if self.opt.refine:
+            return self.single_flow_warping(output)
+        return self.flow_warping(output)
 
-                if (iter+1) % self.opt.train_display == 0:
-                    loss_epoch[iter] = self.display(epoch+1, iter+1, num_batches, loss_iter, split)
-                    loss_iter['mask'] = 0
-                    loss_iter['flow'] = 0
+    def compute_loss(self, output: list, pred_images: Union[Tensor, List[Tensor]]) -> Tuple[Tensor, Tensor]:
+        if self.opt.refine:
+            return self.criterion(output, self.masks, self.rhos, self.flows)
+        return self.criterion(output, pred_images, self.multi_ref_images, self.multi_tar_images, \
+                self.multi_masks, self.multi_rhos, self.multi_flows)
 
-                if (iter+1) % self.opt.train_save == 0:
-                    self.save_results(epoch+1, iter+1, output, pred_images, split, 0)
+    def final_scale(self, output: list, pred_images: Union[Tensor, List[Tensor]]) -> Tuple:
+        # predictions and ground truth at full resolution:
+        # output, pred_images, ref_images, tar_images, rhos, flows, masks
+        if self.opt.refine:
+            return output, pred_images, self.ref_images, self.tar_images, \
+                    self.rhos.unsqueeze(1), self.flows, self.masks.unsqueeze(1)
+        return output[-1], pred_images[-1], self.multi_ref_images[-1], self.multi_tar_images[-1], \
+                self.multi_rhos[-1], self.multi_flows[-1], self.multi_masks[-1]
+
+    def update_metrics(self, meter: metrics.MetricMeter, output: list, pred_images: Union[Tensor, List[Tensor]]) -> None:
+        output, pred_images, ref_images, tar_images, rhos, flows, masks = self.final_scale(output, pred_images)
+        flow, rho, pred_images = output[0].float(), output[2].float(), pred_images.float()
+        mask = utility.get_mask(output[1])
+        final_pred = utility.get_final_pred(ref_images, pred_images, mask, rho)
+        meter.update(metrics.evaluate_batch(final_pred, tar_images, rho, rhos, flow, flows, mask, masks))
+
+    def save_visuals(self, epoch: int, iter: int, output: list, pred_images: Union[Tensor, List[Tensor]], split: str) -> None:
+        if self.opt.refine:
+            self.save_results(epoch, iter, output, pred_images, split, 0)
         else:
-            for i in range(self.opt.ms_num):
-                loss_iter[f'Scale {i} mask'] = 0
-                loss_iter[f'Scale {i} rho'] = 0
-                loss_iter[f'Scale {i} flow'] = 0
-                loss_iter[f'Scale {i} rec'] = 0
-
-
-            for iter, sample in enumerate(dataloader):
-                input = self.setup_inputs(sample)
-                
-                torch.cuda.empty_cache()
-                torch.autograd.set_detect_anomaly(True)
-
-                output = self.model.forward(input)     
-
-                pred_images = self.flow_warping(output) # warp input image with flow
-
-                loss = None
-
-                for i in range(self.opt.ms_num):
-                    
-                    mask_loss = self.opt.mask_w * self.mask_criterion()(output[i][1] + eps, \
-                            self.multi_masks[i].squeeze(1).long()) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                    rho_loss = self.opt.rho_w * self.rho_criterion()(output[i][2], \
-                            self.multi_rhos[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                    flow_loss = self.opt.flow_w * self.flow_criterion()(output[i][0], \
-                            self.multi_flows[i], self.multi_masks[i], self.multi_rhos[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                    mask = utility.get_mask(output[i][1]).expand(output[i][1].size(0), \
-                            3, output[i][1].size(2), output[i][1].size(3))
-                    final_pred = utility.get_final_pred(self.multi_ref_images[i], \
-                            pred_images[i], mask, output[i][2])
-                    rec_loss = self.opt.img_w * self.rec_criterion()(final_pred, \
-                            self.multi_tar_images[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                    
-                    if i == 0:
-                        loss = mask_loss + rho_loss + flow_loss + rec_loss
-                    else:
-                        loss += mask_loss + rho_loss + flow_loss + rec_loss
-                    
-                    loss_iter[f'Scale {i} mask'] += mask_loss.item() 
-                    loss_iter[f'Scale {i} rho'] += rho_loss.item()
-                    loss_iter[f'Scale {i} flow'] += flow_loss.item()
-                    loss_iter[f'Scale {i} rec'] += rec_loss.item()
-
-                # Perform a backward pass
-                (loss / gradient_accumulations).backward()
-                
-                # Update the weights
-                if (iter + 1) % gradient_accumulations == 0:
-                    self.optimizer.step()
-                    self.optimizer.zero_grad()
-
-                if (iter+1) % self.opt.train_display == 0:
-                    loss_epoch[iter] = self.display(epoch+1, iter+1, num_batches, loss_iter, split)
-                    for i in range(self.opt.ms_num):
-                        loss_iter[f'Scale {i} mask'] = 0
-                        loss_iter[f'Scale {i} rho'] = 0
-                        loss_iter[f'Scale {i} flow'] = 0
-                        loss_iter[f'Scale {i} rec'] = 0
-
-                if (iter+1) % self.opt.train_save == 0:
-                    self.save_ms_results(epoch+1, iter+1, output, pred_images, split, 0)
-        
-        average_loss = utility.build_loss_string(utility.dict_of_dict_average(loss_epoch))
-        print(f'\n\n --> Epoch: [{epoch+1}] Loss summary: \n{average_loss}')
-        self.scheduler.step()
-        self.optim_state['lr'] = self.optimizer.param_groups[0]['lr']
-        
-        return average_loss
+            self.save_ms_results(epoch, iter, output, pred_images, split, 0)
 
     def get_saving_name(self, log_dir: str, split: str, epoch: int, iter: int, id: int) -> str:
         f_path = f'{log_dir}/{split}/Images/'
@@ -208,10 +305,12 @@ class Trainer:
         return os.path.join(f_path, f_names + '.png')
 
     def save_images(self, pred_images: Tensor, output: List[Tensor], count: int) -> int:
+        if self.opt.results_store:
+            return self.store_images(pred_images, output, count)
         for i in range(pred_images.size()[0]):
             print(count)
             os.makedirs(f'results/{count}')
-            mask = torch.squeeze(utility.get_mask(output[1][i].unsqueeze(0))).expand(3, output[1].size(2), output[1].size(3))
+            mask = utility.get_mask(output[1][i:i+1])[0]
             rho = output[2][i].repeat(3, 1, 1)
             final_img = utility.get_final_pred(self.ref_images[i], pred_images[i], mask, rho)
             save_image(final_img, f'results/{count}/in_rec.png')
@@ -230,6 +329,33 @@ class Trainer:
             count += 1
         return count
 
+    def store_images(self, pred_images: Tensor, output: List[Tensor], count: int) -> int:
+        # the fields of save_images as one record per sample, quantized like the png files;
+        # the flow color images are derived and left to the exporter
+        if self.results_store is None:
+            print(f'\n\n --> [Results] Appending test results to: {self.opt.results_store}')
+            self.results_store = ResultsStore(self.opt.results_store, 'a')
+        mask = utility.get_mask(output[1])
+        final_img = utility.get_final_pred(self.ref_images, pred_images, mask, output[2])
+        fields = {
+            'rec': quantize(final_img),
+            'mask': quantize(mask.float()),
+            'rho': quantize(output[2]),
+            'flow': output[0].short(),
+            'bg': quantize(self.ref_images),
+            'mask_gt': quantize(self.masks.unsqueeze(1)),
+            'rho_gt': quantize(self.rhos.unsqueeze(1)),
+            'input': quantize(self.input_image),
+            'tar': quantize(self.tar_images),
+            'flow_gt': self.flows.short(),
+        }
+        fields = {k: v.cpu() for k, v in fields.items()}
+        for i in range(pred_images.size(0)):
+            print(count)
+            self.results_store.append(str(count), {k: v[i] for k, v in fields.items()})
+            count += 1
+        return count
+
     def get_predicts(self, id: int, output: List[Tensor], pred_img: Tensor, m_scale: int) -> List[Tensor]:
         pred = [] 
         if m_scale != None:
@@ -240,7 +366,7 @@ class Trainer:
 
         color_flow = utility.flow_to_color(output[0][id])
         pred.append(color_flow)
-        mask = torch.squeeze(utility.get_mask(output[1][id].unsqueeze(0))).expand(3, output[1].size(2), output[1].size(3))
+        mask = utility.get_mask(output[1][id:id+1])[0, 0]
         pred.append(mask)
         rho = output[2][id].repeat(3, 1, 1)
         pred.append(rho)
@@ -329,206 +455,55 @@ class Trainer:
         pred_images= utility.create_single_warping([self.ref_images, output[0]])
         return pred_images
 
-    def test(self, epoch: int, dataloader: DataLoader, split: str) -> float:
-        num_batches = len(dataloader)
-
-        loss_iter = {}
-        loss_epoch = {}
-
-        print(f'\n\n===== Testing after {epoch+1} epochs =====')
-        
-        self.model.eval()
-        
-        rec_err = 0
-        rho_err = 0
-        flow_err = 0
-        mask_err = 0
-        size = 400
-
-        def iou(pred, tar):
-            intersection = torch.logical_and(tar, pred)
-            union = torch.logical_or(tar, pred)
-            iou_score = torch.true_divide(torch.sum(intersection), torch.sum(union))
-            return iou_score
-
-        def epe(mask_gt, flow_gt, flow):
-            mask_gt = mask_gt.expand_as(flow_gt)
-            flow = flow * mask_gt
-            flow_gt = flow_gt * mask_gt
-            return torch.norm(flow_gt-flow, dim=1).mean() / 100
-
-        if self.opt.refine:
-            loss_iter['mask'] = 0
-            loss_iter['flow'] = 0
-
-            count = 1
-
-            for iter, sample in enumerate(dataloader):
-
-                with torch.no_grad():
-                    input = self.setup_inputs(sample)
-                    
-                    torch.cuda.empty_cache()
-                    torch.autograd.set_detect_anomaly(True)
-
-                    output = self.model.forward(input)     
-
-                    pred_images = self.single_flow_warping(output) # warp input image with flow
-                    
-                    if self.opt.save_images:
-                        count = self.save_images(pred_images, output, count)
-
-                    for i in range(output[0].size(0)):
-                        mask = torch.squeeze(utility.get_mask(output[1][i].unsqueeze(0))).expand(3, \
-                                output[1][i].size(1), output[1][i].size(2))
-                        final_pred = utility.get_final_pred(self.ref_images[i], \
-                                pred_images[i], mask, output[2][i]) 
-                        rec_err += 100 * F.mse_loss(final_pred, self.tar_images[i])
-                        rho_err += 100 * F.mse_loss(output[2][i], self.rhos[i])
-                        flow_err += epe(self.masks[i], self.flows[i][0:2, :, :] * \
-                                self.rhos[i], output[0][i] * self.rhos[i])
-                        mask_err += iou(mask, self.masks[i])
-
-                    flow_loss = self.opt.r_flow_w * self.flow_criterion()(output[0], self.flows, \
-                            self.masks.unsqueeze(1), self.rhos.unsqueeze(1)) 
-                    mask_loss = self.opt.r_mask_w * self.mask_criterion()(output[1], self.masks.squeeze(1).long()) 
-                    
-                    loss_iter['mask'] += mask_loss.item() 
-                    loss_iter['flow'] += flow_loss.item()
-
-                    if (iter+1) % self.opt.val_display == 0:
-                        loss_epoch[iter] = self.display(epoch+1, iter+1, num_batches, loss_iter, split)
-                        loss_iter['mask'] = 0
-                        loss_iter['flow'] = 0
-
-                    if (iter+1) % self.opt.val_save == 0:
-                        self.save_results(epoch+1, iter+1, output, pred_images, split, 0)
-        else:
-            for i in range(self.opt.ms_num):
-                loss_iter[f'Scale {i} mask'] = 0
-                loss_iter[f'Scale {i} rho'] = 0
-                loss_iter[f'Scale {i} flow'] = 0
-                loss_iter[f'Scale {i} rec'] = 0
-
-            count = 1
-
-            for iter, sample in enumerate(dataloader):
-
-                with torch.no_grad():
-
-                    torch.cuda.empty_cache()
-
-                    input = self.setup_inputs(sample)
-                    torch.cuda.empty_cache()
-                    torch.autograd.set_detect_anomaly(True)
-
-                    output = self.model.forward(input)
-                    pred_images = self.flow_warping(output) # warp input image with flow
-
-                    if self.opt.save_images:
-                        count = self.save_images(pred_images[-1], output[-1], count)
-
-                    loss = None
-
-                    for i in range(output[-1][0].size(0)):
-                        mask = torch.squeeze(utility.get_mask(output[-1][1][i].unsqueeze(0))).expand(3, \
-                                output[-1][1][i].size(1), output[-1][1][i].size(2))
-                        final_pred = utility.get_final_pred(self.multi_ref_images[-1][i], \
-                                pred_images[-1][i], mask, output[-1][2][i])
-                        rec_err += 100 * F.mse_loss(final_pred, self.multi_tar_images[-1][i])
-                        rho_err += 100 * F.mse_loss(output[-1][2][i], self.multi_rhos[-1][i])
-                        flow_err += epe(self.multi_masks[-1][i], self.multi_flows[-1][i][0:2, :, :] * \
-                                self.multi_rhos[-1][i], output[-1][0][i] * self.multi_rhos[-1][i])
-                        mask_err += iou(mask, self.multi_masks[-1][i])
-
-                    for i in range(self.opt.ms_num):
-
-                        mask_loss = self.opt.mask_w * self.mask_criterion()(output[i][1], \
-                                self.multi_masks[i].squeeze(1).long()) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                        rho_loss = self.opt.rho_w * self.rho_criterion()(output[i][2], \
-                                self.multi_rhos[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                        flow_loss = self.opt.flow_w * self.flow_criterion()(output[i][0], \
-                                self.multi_flows[i], self.multi_masks[i], self.multi_rhos[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-                        mask = utility.get_mask(output[i][1]).expand(output[i][1].size(0), \
-                                3, output[i][1].size(2), output[i][1].size(3))
-                        final_pred = utility.get_final_pred(self.multi_ref_images[i], \
-                                pred_images[i], mask, output[i][2])
-                        rec_loss = self.opt.img_w * self.rec_criterion()(final_pred, \
-                                self.multi_tar_images[i]) * (1 / 2 ** (self.opt.ms_num - i - 1))
-
-                        loss_iter[f'Scale {i} mask'] += mask_loss.item() 
-                        loss_iter[f'Scale {i} rho'] += rho_loss.item()
-                        loss_iter[f'Scale {i} flow'] += flow_loss.item()
-                        loss_iter[f'Scale {i} rec'] += rec_loss.item()
-
-                    if (iter+1) % self.opt.val_display == 0:
-                        loss_epoch[iter] = self.display(epoch+1, iter+1, num_batches, loss_iter, split)
-                        for i in range(self.opt.ms_num):
-                            loss_iter[f'Scale {i} mask'] = 0
-                            loss_iter[f'Scale {i} rho'] = 0
-                            loss_iter[f'Scale {i} flow'] = 0
-                            loss_iter[f'Scale {i} rec'] = 0
-
-                    if (iter+1) % self.opt.val_save == 0:
-                        self.save_ms_results(epoch+1, iter+1, output, pred_images, split, 0)
-
-        rec_err /= size
-        rho_err /= size
-        flow_err /= size
-        mask_err /= size
-        eval_str = f'rec_err: {rec_err}\nrho_err: {rho_err}\nflow_err: {flow_err}\nmask_err: {mask_err}\n'
-        
-        average_loss = utility.build_loss_string(utility.dict_of_dict_average(loss_epoch))
-        average_loss = eval_str + average_loss
-        print(f'\n\n --> Epoch: [{epoch+1}] Loss summary: \n{average_loss}')
-        return average_loss
-
     def display(self, epoch: int, iter: int, num_batches: int, loss: dict, split: str) -> float:
         interval = (split == 'train') and self.opt.train_display or self.opt.val_display
         average_loss = utility.dict_divide(loss, interval)
 
         print(f'\n\n --> Epoch ({split}): [{epoch}][{iter}/{num_batches}]')
         print(utility.build_loss_string(average_loss))
+
+        record = self.profiler.flush(split, epoch, iter)
+        if record is not None:
+            stages = ', '.join(f'{k}: {v:.1f}' for k, v in record['stages_ms'].items())
+            print(f'[Profile] {record["samples_per_sec"]:.2f} samples/s, ms/iter: {stages}')
         return average_loss
 
     def setup_inputs(self, sample: dict) -> Tensor:
-        self.copy_inputs(sample)
+        with self.profiler.stage('copy'):
+            self.copy_inputs(sample)
+        if self.augmentation is not None and self.model.training:
+            with self.profiler.stage('augment'):
+                self.augment_inputs()
         if not self.opt.refine:
-            self.generate_ms_inputs(sample)
+            with self.profiler.stage('ms_data'):
+                self.generate_ms_inputs(sample)
             network_input = self.input_image
         else:
-            checkpoint = torch.load(self.opt.pred_dir)
-            model = checkpoint['model']
-            network_input = model.forward(self.input_image)[self.opt.ms_num-1]
-            network_input.insert(0, nn.functional.interpolate(
-                self.input_image, (512,512), mode='bicubic', align_corners=True))
+            with self.profiler.stage('coarse'):
+                checkpoint = torch.load(self.opt.pred_dir)
+                model = checkpoint['model']
+                network_input = model.forward(self.input_image)[self.opt.ms_num-1]
+                network_input.insert(0, nn.functional.interpolate(
+                    self.input_image, (512,512), mode='bicubic', align_corners=True))
         
         return network_input
 
     def copy_inputs(self, sample: dict) -> None:
-        del self.ref_images
-        del self.tar_images
-        del self.masks
-        del self.rhos
-        del self.flows
-        del self.input_image
-
-        self.input_image = torch.cuda.FloatTensor()
-        self.ref_images = torch.cuda.FloatTensor()
-        self.tar_images = torch.cuda.FloatTensor()
-        self.masks = torch.cuda.FloatTensor()
-        self.rhos = torch.cuda.FloatTensor()
-        self.flows = torch.cuda.FloatTensor()
-
-        n, c, h, w = list(sample['images'].size())
-        sh, sw = list(sample['input'].size()[2:])
-
-        self.input_image.resize_(n, 3, sh, sw).copy_(sample['input'])
-        self.ref_images.resize_(n, 3, h, w).copy_(sample['images'][:,:3,:,:])
-        self.tar_images.resize_(n, 3, h, w).copy_(sample['images'][:,3:,:,:])
-        self.masks.resize_(n, h, w).copy_(sample['masks'])
-        self.rhos.resize_(n, h, w).copy_(sample['rhos'])
-        self.flows.resize_(n, 3, h, w).copy_(sample['flows'])
+        # batches from dataloader.Prefetcher are already on the device and .to() is a no-op
+        sample = to_float_batch({k: v.to(self.device, non_blocking=True) for k, v in sample.items()})
+        images = sample['images']
+        self.input_image = sample['input']
+        self.ref_images = images[:, :3, :, :]
+        self.tar_images = images[:, 3:, :, :]
+        self.masks = sample['masks']
+        self.rhos = sample['rhos']
+        self.flows = sample['flows']
+
+    def augment_inputs(self) -> None:
+        with torch.no_grad():
+            self.input_image, self.ref_images, self.tar_images, self.masks, self.rhos, self.flows = \
+                    self.augmentation(self.input_image, self.ref_images, self.tar_images, \
+                    self.masks, self.rhos, self.flows)
 
     def generate_ms_inputs(self, sample: dict) -> None:
         multiscale_in = [self.ref_images, self.tar_images, self.rhos, self.masks, self.flows]
@@ -1,18 +1,16 @@
-from models.CoarseNet import CreateOutput
 import os
 import torch
 from torch import Tensor
 import math
 import logging
-from torchvision import transforms
-from torchvision.utils import save_image
 import struct
+import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import math
 from pathlib import Path
-from skimage.color import hsv2rgb
-from typing import Type, Any, Callable, Union, List, Optional, Dict
+from argparse import Namespace
+from typing import Type, Any, Callable, Union, List, Optional, Dict, Tuple
 
 TAG = 202021.25
 
@@ -29,6 +27,7 @@ def load_data(f_name: str) -> "model":
 
 
 def resize_tensor(input_tensor: Tensor, h: int, w: int) -> Tensor:
+    from torchvision import transforms # torchvision is slow to import, only needed for saving
     final_output = None
 
     for img in input_tensor:
@@ -78,6 +77,7 @@ def save_compact_results(save_name: str, results: List[Tensor], width_num: int)
     path = Path(save_name)
     if not os.path.exists(path.parent):
         os.makedirs(path.parent)
+    from torchvision.utils import save_image
     save_image(big_img, save_name)
 
 
@@ -89,7 +89,7 @@ def flow_to_color(flow: Tensor) -> Tensor:
     if flow.size(0) == 3:
         f_val = flow[2, :, :].ge(0.1).float()
     else:
-        f_val = torch.ones(flow.size(1), flow.size(2)).cuda()
+        f_val = torch.ones(flow.size(1), flow.size(2), device=flow.device)
     
     f_du = flow[1, :, :].clone()
     f_dv = flow[0, :, :].clone()
@@ -103,15 +103,17 @@ def flow_to_color(flow: Tensor) -> Tensor:
 
 def flow_mapping(f_mag: Tensor, f_dir: Tensor, f_val: Tensor) -> Tensor:
     img_size = f_mag.size()
-    img = torch.zeros(3, img_size[0], img_size[1]).cuda()
+    device = f_mag.device
+    img = torch.zeros(3, img_size[0], img_size[1], device=device)
 
     img[0, :, :] = (f_dir + math.pi) / (2 * math.pi)
     img[1, :, :] = torch.div(f_mag, (f_mag.size(1) * 0.5)).clamp(0, 1)
     img[2, :, :] = 1
 
-    img[1:2, :, :] = torch.minimum(torch.maximum(img[1:2, :, :], torch.zeros(img_size).cuda()), torch.ones(img_size).cuda())
+    from skimage.color import hsv2rgb # imported on first use, skimage is slow to load
+    img[1:2, :, :] = torch.minimum(torch.maximum(img[1:2, :, :], torch.zeros(img_size, device=device)), torch.ones(img_size, device=device))
     
-    img = torch.from_numpy(hsv2rgb(img.cpu().permute(1,2,0).detach())).cuda().permute(2,0,1)
+    img = torch.from_numpy(hsv2rgb(img.cpu().permute(1,2,0).detach())).to(device).permute(2,0,1)
 
     img[0, :, :] = img[0, :, :] * f_val
     img[1, :, :] = img[1, :, :] * f_val
@@ -121,6 +123,10 @@ def flow_mapping(f_mag: Tensor, f_dir: Tensor, f_val: Tensor) -> Tensor:
 
 
 def load_flow(filename: str) -> Tensor:
+    return load_flow_raw(filename).float() # output: [c, h, w]
+
+
+def load_flow_raw(filename: str) -> Tensor:
     f = open(filename, 'rb')
     tag = struct.unpack('f', f.read(4))[0]
     assert tag == TAG, 'Unable to read ' + filename + ' because of wrong tag'
@@ -129,27 +135,21 @@ def load_flow(filename: str) -> Tensor:
     h = struct.unpack('i', f.read(4))[0]
     channels = 2
 
-    l = [] # in file: [h, w, c]
-    for i, val in enumerate(struct.iter_unpack('h', f.read())):
-        if not i % 2:
-            l.append([])
-        l[int(i/2)].append(val[0])
-
-    flow = torch.ShortTensor(l).reshape(h, w, channels)
+    l = np.fromfile(f, dtype=np.int16, count=h*w*channels) # in file: [h, w, c]
     f.close()
 
-    flow = flow.permute(2, 0, 1).float() # output: [c, h, w]
+    flow = torch.from_numpy(l).reshape(h, w, channels)
+    flow = flow.permute(2, 0, 1).contiguous() # output: [c, h, w], int16
     return flow
 
 
 def save_flow(filename: str, flow: Tensor) -> None:
-    flow = flow.short().permute(1, 2, 0).clone()
+    flow = flow.detach().short().permute(1, 2, 0).contiguous().cpu() # in file: [h, w, c]
     f = open(filename, 'wb')
     f.write(struct.pack('f', TAG))
     f.write(struct.pack('i', flow.size(1)))
     f.write(struct.pack('i', flow.size(0)))
-    for val in flow.reshape([flow.numel()]).tolist():
-        f.write(struct.pack('h', val))
+    f.write(flow.numpy().tobytes())
 
     f.close()
 
@@ -259,7 +259,7 @@ def grid_generator(flow: Tensor) -> Tensor:
     yy = torch.arange(0, H).view(-1,1).repeat(1,W)
     xx = xx.view(1,1,H,W).repeat(B,1,1,1)
     yy = yy.view(1,1,H,W).repeat(B,1,1,1)
-    grid = torch.cat((xx,yy),1).float().cuda()
+    grid = torch.cat((xx,yy),1).float().to(flow.device)
     
     flow = flow.div(H/2)
     flow_clo = flow.clone()
@@ -292,15 +292,76 @@ class EPELoss(nn.Module):
         return torch.norm(target-pred, dim=1).mean()
 
 
+class MultiScaleLoss(nn.Module):
+    # All loss terms of CoarseNet, weighted by 1/2**k per scale. Returns the total loss
+    # and a detached [ms_num * 4] tensor of its components, so that callers can
+    # accumulate them on the device and copy them to the host only when displaying.
+    def __init__(self, opt: Namespace) -> None:
+        super(MultiScaleLoss, self).__init__()
+        self.ms_num = opt.ms_num
+        self.mask_w = opt.mask_w
+        self.rho_w = opt.rho_w
+        self.flow_w = opt.flow_w
+        self.img_w = opt.img_w
+        self.mask_criterion = nn.CrossEntropyLoss()
+        self.rho_criterion = nn.MSELoss()
+        self.flow_criterion = EPELoss()
+        self.rec_criterion = nn.MSELoss()
+        self.names = [f'Scale {i} {k}' for i in range(self.ms_num) for k in ('mask', 'rho', 'flow', 'rec')]
+
+    def forward(
+        self,
+        output: List[List[Tensor]],
+        pred_images: List[Tensor],
+        ref_images: List[Tensor],
+        tar_images: List[Tensor],
+        masks: List[Tensor],
+        rhos: List[Tensor],
+        flows: List[Tensor]
+        ) -> Tuple[Tensor, Tensor]:
+        terms = []
+        for i in range(self.ms_num):
+            flow, mask_logits, rho = output[i][0], output[i][1], output[i][2]
+            mask_loss = self.mask_w * self.mask_criterion(mask_logits, masks[i].squeeze(1).long())
+            rho_loss = self.rho_w * self.rho_criterion(rho, rhos[i])
+            flow_loss = self.flow_w * self.flow_criterion(flow, flows[i], masks[i], rhos[i])
+            mask = get_mask(mask_logits)
+            final_pred = get_final_pred(ref_images[i], pred_images[i], mask, rho)
+            rec_loss = self.img_w * self.rec_criterion(final_pred, tar_images[i])
+            terms.append(torch.stack([mask_loss, rho_loss, flow_loss, rec_loss]) * (1 / 2 ** (self.ms_num - i - 1)))
+
+        terms = torch.stack(terms)
+        return terms.sum(), terms.detach().reshape(-1)
+
+    def to_dict(self, components: Tensor) -> Dict[str, float]:
+        return dict(zip(self.names, components.tolist()))
+
+
+class RefineLoss(nn.Module):
+    # Flow and mask loss of RefineNet, see MultiScaleLoss
+    def __init__(self, opt: Namespace) -> None:
+        super(RefineLoss, self).__init__()
+        self.mask_w = opt.r_mask_w
+        self.flow_w = opt.r_flow_w
+        self.mask_criterion = nn.CrossEntropyLoss()
+        self.flow_criterion = EPELoss()
+        self.names = ['mask', 'flow']
+
+    def forward(self, output: List[Tensor], masks: Tensor, rhos: Tensor, flows: Tensor) -> Tuple[Tensor, Tensor]:
+        mask_loss = self.mask_w * self.mask_criterion(output[1], masks.long())
+        flow_loss = self.flow_w * self.flow_criterion(output[0], flows, masks.unsqueeze(1), rhos.unsqueeze(1))
+        terms = torch.stack([mask_loss, flow_loss])
+        return terms.sum(), terms.detach()
+
+    def to_dict(self, components: Tensor) -> Dict[str, float]:
+        return dict(zip(self.names, components.tolist()))
+
+
 def get_final_pred(ref_img: Tensor, pred_img: Tensor, pred_mask: Tensor, pred_rho: Tensor) -> Tensor:
-    final_pred_img = torch.mul(1 - pred_mask, ref_img) + torch.mul(pred_mask, torch.mul(pred_img, pred_rho))
-    return final_pred_img
+    # pred_mask: bool, broadcast against the images
+    return torch.where(pred_mask, pred_img * pred_rho, ref_img)
 
 
 def get_mask(masks: Tensor) -> Tensor:
-    n, c, h, w = list(masks.size())
-    m = masks.transpose(1, 3).transpose(1,2)
-    m = m.reshape(int(m.numel()/m.size(3)), m.size(3))
-    _, pred = m.max(1)
-    pred = pred.reshape(n, 1, h, w)
-    return pred
+    # [n, 2, h, w] logits -> [n, 1, h, w] bool, the argmax over dim 1 (ties go to background)
+    return masks.narrow(1, 1, 1) > masks.narrow(1, 0, 1)